@@ -2,22 +2,42 @@
 
 To add a new feed, add a subclass of this to the `feed_sources` directory.
 """
-from bs4 import BeautifulSoup
 from datetime import datetime, timedelta
 import logging
+from multiprocessing.pool import ThreadPool
 import os
-import pickle
-import subprocess
+import threading
 import zipfile
 
 import requests
 
+from deadlines import DeadlineError, TimeBudget, CHECK_PHASE, DOWNLOAD_PHASE, VALIDATE_PHASE
+from digests import new_digest
+from effective_dates import effective_dates
+from http_client import (HostDownError, HostLimiter, iter_body, make_session, parse_http_date,
+                         range_start, range_validator)
+from instrumentation import Timings, DOWNLOAD, HEAD, VALIDATE
+from scraping import SCRAPE_KEY
+from status_store import StatusStore, STATUS_DB
+from structural_validation import validate_structure
+from update_cadence import is_check_due, next_check, record_update
+from validation import (estimate_validation_memory, run_feedvalidator, MemoryBudget,
+                        ValidatorError, FAST_VALIDATION, FULL_VALIDATION, VALIDATION_MODE)
+
 LOG = logging.getLogger(__name__)
 
+# default directory to download feeds into
+DOWNLOAD_DIRECTORY = os.path.join(os.getcwd(), 'gtfs')
 # format time checks like last-modified header
 TIMECHECK_FMT = '%a, %d %b %Y %H:%M:%S GMT'
-# valid date range format used in feedvalidator output
-EFFECTIVE_DATE_FMT = '%B %d, %Y'
+# default number of bytes to read and write at a time when streaming downloads
+CHUNK_SIZE = 1024 * 1024
+# suffix for a download in progress, next to where the feed will be saved
+PARTIAL_SUFFIX = '.part'
+# suffix for the file next to a download in progress holding the validator to resume it with
+VALIDATOR_SUFFIX = '.validator'
+# keys of a feed's status that are kept when it is set to an error, as they still hold after
+KEPT_ON_ERROR = ('update_history', SCRAPE_KEY)
 
 
 class FeedSource(object):
@@ -27,14 +47,37 @@ class FeedSource(object):
         - set class :urls: to a dictionary of { filename: url }:
             :filename: is the what the feed will be saved as (should end in .zip)
             :url: is the URL where the feed will be downloaded from
+        - override :resolve: method to look up :urls: that need network access to find;
+          constructors should not do network I/O.
         - override :fetch: method as necessary to fetch feeds for the agency.
+
+    Subclass constructors should accept and pass along keyword arguments, so that the
+    settings for a run (such as :workers:, :host_limiter: and :session:) reach this base class.
     """
-    def __init__(self, ddir=os.path.join(os.getcwd(), 'gtfs')):
+    def __init__(self, ddir=DOWNLOAD_DIRECTORY, workers=1, host_limiter=None, session=None,
+                 validation_pipeline=None, validator_service=None, status_store=None,
+                 chunk_size=CHUNK_SIZE, validation_mode=VALIDATION_MODE, profile_dir=None,
+                 memory_budget=None, poll_interval=None, check_all=False, time_budget=None):
         # set properties
         self._ddir = ddir
         self._urls = None
         self._status = {}
         self._status_file = os.path.join(self.ddir, self.__class__.__name__ + '.p')
+        self._workers = workers
+        self._chunk_size = chunk_size
+        self._host_limiter = host_limiter or HostLimiter()
+        self._session = session or make_session(max(workers, self._host_limiter.max_per_host))
+        self._validation_pipeline = validation_pipeline
+        self._validator_service = validator_service
+        self._validation_mode = validation_mode
+        self._memory_budget = memory_budget or MemoryBudget()
+        self._status_store = status_store or StatusStore(os.path.join(self.ddir, STATUS_DB))
+        self._timings = Timings(self.__class__.__name__, profile_dir)
+        self._poll_interval = poll_interval
+        self._check_all = check_all
+        self._time_budget = time_budget or TimeBudget()
+        # guards writing the status, which may happen from several fetch threads
+        self._status_lock = threading.RLock()
         # load file of feed statuses
         self.load_status()
 
@@ -63,8 +106,20 @@ class FeedSource(object):
             - effective_from
             - effective_to
             - posted_date (When feed was posted, or when retrieved, if post date unknown)
+            - etag, last_modified - validators from the server, used to check for changes
+            - digest - of the downloaded content, to skip validating byte-identical downloads
             - newly_effective - set if feed was not effective when retrieved, but is now
+            - timings - seconds spent, and bytes handled, in each stage of fetching the feed
+              on the last run, by :instrumentation: stage
+            - last_checked - when the feed was last checked for a new download
+            - update_history - posted dates of the most recent new versions of the feed,
+              from which :update_cadence: estimates how often to check it
+            - scrape - what was found on the page scraped to find the feed, with the page's
+              validators, so it is only parsed again once it changes; see :scraping:
             - error - message if error encountered in processing; other fields will be unset
+            - timed_out - set with error if processing was stopped for going over the run's
+              deadline, or a phase's time budget; set on its own, with the rest of the
+              previous status kept, if the run's deadline passed before the feed was checked
         """
         return self._status
     @status.setter
@@ -73,60 +128,314 @@ class FeedSource(object):
 
     @property
     def status_file(self):
-        """Pickle file where feed statuses and their time checks are stored.
+        """Pickle file where earlier versions stored feed statuses and their time checks.
 
+        Read once, to migrate its statuses into the :status_store:.
         Defaults to name file after class, and store it in :ddir:."""
         return self._status_file
     @status_file.setter
     def status_file(self, value):
         self._status_file = value
 
+    @property
+    def workers(self):
+        """Number of this source's URLs to fetch at the same time."""
+        return self._workers
+    @workers.setter
+    def workers(self, value):
+        self._workers = value
+
+    @property
+    def chunk_size(self):
+        """Number of bytes to read and write at a time when streaming downloads."""
+        return self._chunk_size
+    @chunk_size.setter
+    def chunk_size(self, value):
+        self._chunk_size = value
+
+    @property
+    def status_store(self):
+        """:StatusStore: where feed statuses are saved; may be shared across sources."""
+        return self._status_store
+    @status_store.setter
+    def status_store(self, value):
+        self._status_store = value
+
+    @property
+    def host_limiter(self):
+        """:HostLimiter: capping concurrent requests to each host; may be shared across sources."""
+        return self._host_limiter
+    @host_limiter.setter
+    def host_limiter(self, value):
+        self._host_limiter = value
+
+    @property
+    def session(self):
+        """:requests.Session: to make all HTTP requests with; may be shared across sources."""
+        return self._session
+    @session.setter
+    def session(self, value):
+        self._session = value
+
+    @property
+    def validation_pipeline(self):
+        """:ValidationPipeline: to hand downloaded feeds off to; if None, feeds are verified
+        in line with their download."""
+        return self._validation_pipeline
+    @validation_pipeline.setter
+    def validation_pipeline(self, value):
+        self._validation_pipeline = value
+
+    @property
+    def validator_service(self):
+        """:ValidatorService: of warm validator processes to verify feeds on; if None,
+        feedvalidator.py is started in a new process for each feed."""
+        return self._validator_service
+    @validator_service.setter
+    def validator_service(self, value):
+        self._validator_service = value
+
+    @property
+    def validation_mode(self):
+        """How to validate feeds: one of :validation.VALIDATION_MODES:."""
+        return self._validation_mode
+    @validation_mode.setter
+    def validation_mode(self, value):
+        self._validation_mode = value
+
+    @property
+    def memory_budget(self):
+        """:MemoryBudget: limiting how many feeds feedvalidator.py validates at once, by their
+        size; may be shared across sources."""
+        return self._memory_budget
+    @memory_budget.setter
+    def memory_budget(self, value):
+        self._memory_budget = value
+
+    @property
+    def timings(self):
+        """:Timings: of the stages of fetching each feed this run, saved with its status."""
+        return self._timings
+    @timings.setter
+    def timings(self, value):
+        self._timings = value
+
+    @property
+    def poll_interval(self):
+        """Seconds to wait between checks of this source when fetching continually;
+        if None, the default interval of the :feed_daemon: is used."""
+        return self._poll_interval
+    @poll_interval.setter
+    def poll_interval(self, value):
+        self._poll_interval = value
+
+    @property
+    def check_all(self):
+        """If True, check every feed for a new download, even those :update_cadence: says are
+        unlikely to have changed yet."""
+        return self._check_all
+    @check_all.setter
+    def check_all(self, value):
+        self._check_all = value
+
+    @property
+    def time_budget(self):
+        """:deadlines.TimeBudget: limiting how long the run, and each phase of fetching a feed,
+        may take."""
+        return self._time_budget
+    @time_budget.setter
+    def time_budget(self, value):
+        self._time_budget = value
+
+    def request(self, method, url, deadline=None, **kwargs):
+        """Make an HTTP request with the :session:, within the :host_limiter:'s limits for the
+        URL's host, retrying it if the host has trouble.
+
+        :param method: HTTP method, such as 'get' or 'head'
+        :param url: URL to request
+        :param deadline: :deadlines.Deadline: to give up on the request at; defaults to the
+                         :time_budget: for checking a feed for a new version
+        :param **kwargs: Additional arguments for :requests.Session.request:
+        :returns: :requests.Response:
+        :raises requests.RequestException: if the request could not be made, as described for
+                                           :HostLimiter.request:
+        :raises DeadlineError: if the request did not succeed by the deadline
+        """
+        deadline = deadline or self.time_budget.phase(CHECK_PHASE, 'Check of %s' % url)
+        return self.host_limiter.request(self.session, method, url, deadline, **kwargs)
 
     def fetch(self):
         """Modify this method in sub-class for importing feed(s) from agency.
 
-        By default, loops over given URLs, checks the last-modified header to see if a new
-        download is available, streams the download if so, and verifies the new GTFS.
+        By default, resolves and loops over given URLs, checks the last-modified header to see
+        if a new download is available, streams the download if so, and verifies the new GTFS.
+        Nothing is looked up or requested while none of the feeds are due to be checked.
         """
+        if not self.due_for_check():
+            return
+        self.resolve()
         if self.urls:
-            for filename in self.urls:
-                self.fetchone(filename, self.urls.get(filename))
-                self.write_status()
+            self.fetch_urls()
         else:
             LOG.warn('No URLs to download for %s.', self.__class__.__name__)
 
+    def resolve(self):
+        """Modify this method in sub-class to find :urls: that must be looked up first,
+        such as by scraping a web page. Called at the start of :fetch:.
+        """
+        pass
+
+    def fetch_urls(self):
+        """Fetch and validate each feed in :urls:, writing the status file after each one.
+
+        Feeds are fetched on a pool of :workers: threads when more than one worker is set.
+        """
+        def fetch_url(file_name):
+            """Fetch a single feed and save its status."""
+            self.fetchone(file_name, self.urls.get(file_name))
+            self.write_status()
+
+        file_names = list(self.urls)
+        if self.workers > 1 and len(file_names) > 1:
+            pool = ThreadPool(min(self.workers, len(file_names)))
+            try:
+                pool.map(fetch_url, file_names)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            for file_name in file_names:
+                fetch_url(file_name)
+
     def load_status(self):
-        """Read in pickled log of last times files were downloaded."""
-        if os.path.isfile(self.status_file):
-            with open(self.status_file, 'rb') as tcf:
-                self.status = pickle.load(tcf)
-                LOG.debug('Loaded status file.')
+        """Read in log of last times files were downloaded from the :status_store:.
+
+        Migrates the statuses from the pickled :status_file: if none are stored yet.
+        """
+        name = self.__class__.__name__
+        self.status = (self.status_store.load(name) or
+                       self.status_store.migrate(name, self.status_file) or {})
+        if self.status:
+            LOG.debug('Loaded statuses.')
             if self.status.has_key('last_check'):
                 last_fetch = self.status.get('last_check')
                 LOG.info('Last fetch at: %s', last_fetch)
                 elapsed = datetime.now() - last_fetch
                 LOG.info('Time since last fetch: %s', elapsed)
         else:
-            LOG.debug('Will create new feed status file.')
+            LOG.debug('Will create new feed statuses.')
 
         self.status['last_check'] = datetime.now()
 
+    @property
+    def feed_names(self):
+        """Names of the feeds this source saves, as kept in :status:.
+
+        By default, those in :urls: and those with a status; override for sources that save
+        feeds under other names, such as by extracting them from another download.
+        """
+        return set(self.urls or []) | set(name for name, stat in self.status.items()
+                                          if isinstance(stat, dict))
+
+    def next_check_due(self):
+        """Get when the next of this source's feeds is due to be checked for a new download.
+
+        :returns: :datetime:, or None if any feed should be checked now
+        """
+        feeds = self.feed_names
+        if self.check_all or not feeds:
+            return None
+        due = [next_check(self.status.get(name)) for name in feeds]
+        return None if None in due else min(due)
+
+    def due_for_check(self):
+        """Check if any of this source's feeds is due to be checked for a new download.
+
+        Call before looking up anything for a source, such as by scraping a page; if none of
+        its feeds are due, each one's status is updated as having no new download.
+
+        :returns: True if the source should be checked now
+        """
+        due = self.next_check_due()
+        if due is None or due <= datetime.now():
+            return True
+        LOG.info('Not checking %s until %s, as none of its feeds are likely to have changed.',
+                 self.__class__.__name__, due)
+        for file_name in self.feed_names:
+            self.update_existing_status(file_name)
+        self.write_status()
+        return False
+
+    def start_check(self):
+        """Start another check of this source, when one instance fetches it repeatedly.
+
+        Marks the time of the check, times the stages of fetching each feed anew, and starts
+        the clock over on the :time_budget:.
+        """
+        with self._status_lock:
+            self.status['last_check'] = datetime.now()
+        self.timings = Timings(self.timings.name, self.timings.profile_dir)
+        self.time_budget = self.time_budget.renewed()
+
     def write_status(self):
-        """Write pickled log of feed statuses and last times files were downloaded."""
-        LOG.debug('Downloading finished.  Writing status file %s...', self.status_file)
-        with open(self.status_file, 'wb') as tcf:
-            pickle.dump(self.status, tcf)
-            LOG.debug('Statuses written to %s.', self.status_file)
+        """Save log of feed statuses and last times files were downloaded to the :status_store:.
+
+        Only the statuses that changed since last written are saved.
+        """
+        LOG.debug('Downloading finished.  Writing statuses to %s...', self.status_store.path)
+        with self._status_lock:
+            self.apply_timings()
+            self.status_store.save(self.__class__.__name__, self.status_snapshot())
+            LOG.debug('Statuses written to %s.', self.status_store.path)
+
+    def apply_timings(self):
+        """Set the time spent on each stage of fetching a feed this run on the feed's status."""
+        for file_name in self.timings.file_names():
+            stat = self.status.get(file_name)
+            if isinstance(stat, dict):
+                stat['timings'] = self.timings.get(file_name)
+
+    def status_snapshot(self):
+        """Copy :status: so it can be written out while other threads continue updating it.
+
+        Copies each feed's status dictionary, as those are modified in place during a fetch.
+        """
+        return dict((key, dict(value) if isinstance(value, dict) else value)
+                    for key, value in self.status.items())
 
-    def fetchone(self, file_name, url, **stream):
+    def fetchone(self, file_name, url):
         """Download and validate a single feed.
 
         :param file_name: Name to which downloaded file should be saved in :ddir: (relative)
         :param url: Location where GTFS will be downloaded from
-        :param **stream: Additional arguments to pass to :download:
-        :returns: True if file was downloaded successfully and passed verification
+        :returns: True if file was downloaded successfully and passed verification,
+                  or was queued on the :validation_pipeline: for verification
         """
-        if self.download(file_name, url, **stream):
+        if self.time_budget.run().expired():
+            stat = self.status.get(file_name)
+            if isinstance(stat, dict) and not stat.has_key('error'):
+                # nothing was started, so what is known about the feed still holds
+                LOG.error('Run deadline passed before %s was checked.', file_name)
+                self.update_existing_status(file_name)
+                self.status[file_name]['timed_out'] = True
+            else:
+                self.set_error(file_name, 'Run deadline passed before feed was checked',
+                               timed_out=True)
+            return False
+        if not self.check_all and not is_check_due(self.status.get(file_name)):
+            LOG.info('Not checking %s yet, as it is unlikely to have changed since %s.',
+                     file_name, self.status[file_name]['last_checked'])
+            self.update_existing_status(file_name)
+            return False
+        stat = self.status.setdefault(file_name, {})
+        stat['last_checked'] = datetime.now()
+        # checked this time, so no longer behind from being skipped at a past run's deadline
+        stat.pop('timed_out', None)
+        if self.download(file_name, url):
+            if self.validation_pipeline:
+                # status gets set once the pipeline has verified the download
+                self.validation_pipeline.submit(self, file_name)
+                return True
             if self.verify(file_name):
                 LOG.info('GTFS verification succeeded.')
                 return True
@@ -137,7 +446,7 @@ class FeedSource(object):
             return False
 
     def verify(self, file_name):
-        """Verify downloaded file looks like a good GTFS, using Google's feedvalidator.py.
+        """Verify downloaded file looks like a good GTFS, checked as set by :validation_mode:.
 
         :param file_name: Name of GTFS to verify in :ddir: (relative)
         :returns: True if GTFS passed validation (excluding future effective date rule)
@@ -149,31 +458,32 @@ class FeedSource(object):
             self.set_error(file_name, 'File not found for validation')
             return False
 
-        # validation output for foo.zip will be saved as foo.html
-        validation_output_file = os.path.join(self.ddir, file_name[:-4] + '.html')
         LOG.info('Validating feed in %s...', file_name)
 
-        process_cmd = ['feedvalidator.py',
-                       '--output=' + validation_output_file,
-                       '--memory_db',
-                       '--noprompt',
-                       downloaded_file]
-
-        # Process returns failure on warnings, which most feeds have;
+        # Validator reports failure on warnings, which most feeds have;
         # we will return success here if there are only warnings and no errors.
         try:
-            out = subprocess.Popen(process_cmd, stdout=subprocess.PIPE).communicate()
-        except Exception as ex:
-            LOG.error('feedvalidator.py errorred processing %s.', file_name)
-            self.set_error(file_name, 'feedvalidator.py errored processing feed')
+            with self.timings.timed(file_name, VALIDATE):
+                result = self.validate(file_name)
+        except DeadlineError as ex:
+            self.set_error(file_name, str(ex), timed_out=True)
+            return False
+        except ValidatorError as ex:
+            LOG.error('Validator errored processing %s: %s', file_name, ex)
+            self.set_error(file_name, 'Validator errored processing feed')
             return False
 
-        errct = out[0].split('\n')[-2:-1][0] # output line with count of errors/warnings
-        if errct.find('error') > -1:
-            LOG.error('Feed validator found errors in %s: %s. ' +
-                      'Check transitfeedcrash.txt for details.', file_name, errct)
-        elif out[0].find('this feed is in the future,') > -1:
-            # will check for this again when we get the effective dates from the HTML output
+        errct = result['summary']
+        if result['has_errors']:
+            if result.get('problems'):
+                LOG.error('Feed structure check found errors in %s: %s.', file_name, errct)
+                for problem in result['problems']:
+                    LOG.warn('%s: %s', file_name, problem)
+            else:
+                LOG.error('Feed validator found errors in %s: %s. ' +
+                          'Check transitfeedcrash.txt for details.', file_name, errct)
+        elif result['in_future']:
+            # will check for this again when the effective dates are set from the calendar
             LOG.warn('Feed validator found GTFS not in service until future for %s.', file_name)
         else:
             is_valid = True
@@ -183,31 +493,75 @@ class FeedSource(object):
                 # have warnings
                 LOG.info('Feed %s looks ok:  %s.', file_name, errct[7:])
 
-
-        # look at HTML validation output to find effective date range
-        with open(validation_output_file, 'rb') as output:
-            soup = BeautifulSoup(output, 'html.parser')
-            effective_dates = soup.find(text='Effective:').findParent().findNextSibling().text
-            LOG.debug('Feed effective %s.', effective_dates)
-            if effective_dates and effective_dates.find(' to ') > -1:
-                from_date_str, to_date_str = effective_dates.split(' to ')
-                from_date = datetime.strptime(from_date_str, EFFECTIVE_DATE_FMT)
-                to_date = datetime.strptime(to_date_str, EFFECTIVE_DATE_FMT)
-            else:
-                LOG.debug('No effective dates found for feed %s.', file_name)
-                from_date = 'UNKNOWN'
-                to_date = 'UNKNOWN'
-
         # should have status with at least posted_date set at this point
         self.status[file_name]['is_new'] = True
         self.status[file_name]['is_valid'] = is_valid
-        self.status[file_name]['effective_from'] = from_date
-        self.status[file_name]['effective_to'] = to_date
-        # check if current once effective dates have been set
-        self.status[file_name]['is_current'] = self.is_current(file_name)
+        # dates usually already set when downloaded, for the same content
+        self.set_effective_dates(file_name)
 
         return is_valid
 
+    def validate(self, file_name):
+        """Run the checks :validation_mode: calls for on a downloaded feed.
+
+        In tiered mode, the feed's structure is checked first, and feedvalidator.py only runs
+        if the check found errors, or the feed was not valid (or not validated) before.
+
+        feedvalidator.py is stopped if it goes over the :time_budget: for validation. When it
+        does not run, any report it wrote for an earlier version of the feed is removed, as it
+        no longer describes the download.
+
+        :param file_name: Name of GTFS to validate in :ddir: (relative)
+        :returns: Dictionary of validation results, as described for :ValidatorService.validate:
+        :raises ValidatorError: if the feed could not be validated
+        :raises DeadlineError: if the feed could not be validated in time
+        """
+        downloaded_file = os.path.join(self.ddir, file_name)
+        if self.validation_mode != FULL_VALIDATION:
+            result = validate_structure(downloaded_file)
+            if self.validation_mode == FAST_VALIDATION:
+                self.discard_report(file_name)
+                return result
+            if not result['has_errors'] and self.status.get(file_name, {}).get('is_valid'):
+                LOG.debug('Structure check passed for %s; not running feedvalidator.py.',
+                          file_name)
+                self.discard_report(file_name)
+                return result
+            LOG.info('Running feedvalidator.py on %s, which %s.', file_name,
+                     'failed its structure check' if result['has_errors']
+                     else 'was not valid before')
+
+        validation_output_file = self.report_path(file_name)
+        def start_deadline():
+            """Start the clock on validating, once the feed is let in and has a validator."""
+            deadline = self.time_budget.phase(VALIDATE_PHASE, 'Validation of %s' % file_name)
+            deadline.check()
+            return deadline
+
+        with self.memory_budget.admit(estimate_validation_memory(downloaded_file), file_name):
+            if self.validator_service:
+                return self.validator_service.validate(downloaded_file, validation_output_file,
+                                                       start_deadline)
+            return run_feedvalidator(downloaded_file, validation_output_file, start_deadline())
+
+    def report_path(self, file_name):
+        """Get the path feedvalidator.py writes its report for a feed to.
+
+        :param file_name: Name of feed file, relative to :ddir:
+        :returns: Full path to the HTML report; the report for foo.zip is foo.html
+        """
+        return os.path.join(self.ddir, file_name[:-4] + '.html')
+
+    def discard_report(self, file_name):
+        """Remove a feed's feedvalidator.py report, if there is one, once it is out of date.
+
+        :param file_name: Name of feed file, relative to :ddir:
+        """
+        report_path = self.report_path(file_name)
+        if os.path.isfile(report_path):
+            LOG.debug('Removing validation report for an earlier version of %s.', file_name)
+            os.remove(report_path)
+
     def is_current(self, file_name):
         """Check if feed is currently effective.
 
@@ -237,6 +591,30 @@ class FeedSource(object):
         LOG.debug('Feed %s is currently effective.', file_name)
         return True
 
+    def set_effective_dates(self, file_name):
+        """Set a feed's effective date range on its status, read from its calendar files.
+
+        The dates are cached by the feed's content digest, so a feed is only read once.
+        Sets effective_from and effective_to to 'UNKNOWN' if the feed has no service dates.
+
+        :param file_name: Name of downloaded GTFS file (relative to :ddir:)
+        """
+        stat = self.status.get(file_name, {})
+        try:
+            from_date, to_date = effective_dates(os.path.join(self.ddir, file_name),
+                                                 stat.get('digest'))
+        except (IOError, zipfile.BadZipfile) as ex:
+            LOG.error('Could not read calendar for %s: %s', file_name, ex)
+            from_date = to_date = None
+        if not from_date or not to_date:
+            LOG.debug('No effective dates found for feed %s.', file_name)
+            from_date = to_date = 'UNKNOWN'
+        stat['effective_from'] = from_date
+        stat['effective_to'] = to_date
+        self.status[file_name] = stat
+        # check if current once effective dates have been set
+        stat['is_current'] = self.is_current(file_name)
+
     def update_existing_status(self, file_name):
         """Update the status entry for a file when no new download is available."""
         stat = self.status.get(file_name)
@@ -256,17 +634,27 @@ class FeedSource(object):
     def check_header_newer(self, url, file_name):
         """Check if last-modified header indicates a new download is available.
 
+        .. note::
+           :download: makes a conditional request instead, which needs only one round trip.
+
         :param url: Where GTFS is downloaded from
         :param file_name: Name of downloaded file (relative to :ddir:)
         :returns: 1 if newer GTFS available; 0 if info missing; -1 if already have most recent
         """
         if self.status.has_key(file_name) and self.status[file_name].has_key('posted_date'):
             last_fetch = self.status[file_name]['posted_date']
-            hdr = requests.head(url)
+            try:
+                with self.timings.timed(file_name, HEAD):
+                    hdr = self.request('head', url)
+            except (requests.RequestException, DeadlineError) as ex:
+                LOG.warn('Could not check headers for %s: %s', file_name, ex)
+                return 0
             hdr = hdr.headers
-            if hdr.get('last-modified'):
+            last_fetch_date = parse_http_date(last_fetch)
+            last_mod_date = parse_http_date(hdr.get('last-modified'))
+            if last_fetch_date and last_mod_date:
                 last_mod = hdr.get('last-modified')
-                if last_fetch >= last_mod:
+                if last_fetch_date >= last_mod_date:
                     LOG.info('No new download available for %s.', file_name)
                     self.update_existing_status(file_name)
                     return -1
@@ -283,47 +671,248 @@ class FeedSource(object):
             LOG.debug('Time check entry for %s not found.', file_name)
             return 0
 
-    def download(self, file_name, url, do_stream=True):
+    def conditional_headers(self, file_name):
+        """Get headers to make a download conditional on the feed having changed.
+
+        Uses the ETag and Last-Modified values the server sent with the previous download,
+        if that download is still on disk.
+
+        :param file_name: Name of downloaded file (relative to :ddir:)
+        :returns: Dictionary of If-None-Match and If-Modified-Since headers; empty if none apply
+        """
+        headers = {}
+        stat = self.status.get(file_name)
+        if not stat or not os.path.isfile(os.path.join(self.ddir, file_name)):
+            return headers
+        if stat.get('etag'):
+            headers['If-None-Match'] = stat['etag']
+        if stat.get('last_modified'):
+            headers['If-Modified-Since'] = stat['last_modified']
+        return headers
+
+    def partial_path(self, file_name):
+        """Get the full path to a feed's download in progress.
+
+        :param file_name: Name of feed file, relative to :ddir:
+        """
+        return os.path.join(self.ddir, file_name) + PARTIAL_SUFFIX
+
+    def resume_point(self, file_name):
+        """Find where to resume an interrupted download of a feed.
+
+        :param file_name: Name of feed file, relative to :ddir:
+        :returns: Tuple of (bytes already downloaded, validator to send in If-Range),
+                  or (0, None) if there is no interrupted download to resume
+        """
+        partial_path = self.partial_path(file_name)
+        validator_path = partial_path + VALIDATOR_SUFFIX
+        if not os.path.isfile(partial_path) or not os.path.isfile(validator_path):
+            return 0, None
+        with open(validator_path) as validator_file:
+            validator = validator_file.read().strip()
+        size = os.path.getsize(partial_path)
+        if not validator or not size:
+            return 0, None
+        return size, validator
+
+    def keep_resume_validator(self, file_name, validator):
+        """Save the validator for a download in progress, so it may be resumed if interrupted.
+
+        :param file_name: Name of feed file, relative to :ddir:
+        :param validator: ETag or Last-Modified value of the download; if None, the download
+                          will not be resumed, and any saved validator is removed
+        """
+        validator_path = self.partial_path(file_name) + VALIDATOR_SUFFIX
+        if validator:
+            with open(validator_path, 'w') as validator_file:
+                validator_file.write(validator)
+        elif os.path.isfile(validator_path):
+            os.remove(validator_path)
+
+    def discard_partial(self, file_name):
+        """Remove a feed's interrupted download and its validator, if there are any.
+
+        :param file_name: Name of feed file, relative to :ddir:
+        """
+        partial_path = self.partial_path(file_name)
+        for path in (partial_path, partial_path + VALIDATOR_SUFFIX):
+            if os.path.isfile(path):
+                os.remove(path)
+
+    def download(self, file_name, url):
         """Download feed.
 
+        Makes a conditional request when the previous download's ETag or Last-Modified is known,
+        so finding there is nothing new to fetch takes a single round trip.
+        The download is streamed to disk in chunks of :chunk_size: bytes.
+
+        If a previous download of the feed was interrupted, asks the server for only the rest of
+        it, as long as the feed has not changed since; if the server sends the whole feed instead,
+        the download starts over. The request times out, and is retried, as set by the
+        :host_limiter:, and holds a slot for its host until the whole body is read; the feed is
+        set to an error without a request once its host is down.
+        A download that goes over the :time_budget: for downloading is stopped (checked after
+        each chunk), with the bytes received so far kept to resume from if the server allows it.
+
         :param file_name: File name to save download as, relative to :ddir:
         :param url: Where to download the GTFS from
-        :param do_stream: If True, stream the download
-                :returns: True if download was successful
+        :returns: True if download was successful
         """
         LOG.debug('In get_stream to get file %s from URL %s.', file_name, url)
-        if self.check_header_newer(url, file_name) == -1:
-            # Nothing new to fetch; done here
+        LOG.info('Getting file %s...from...%s', os.path.join(self.ddir, file_name), url)
+        headers = self.conditional_headers(file_name)
+        offset, validator = self.resume_point(file_name)
+        if offset:
+            LOG.info('Resuming download of %s from byte %s.', file_name, offset)
+            headers['Range'] = 'bytes=%d-' % offset
+            headers['If-Range'] = validator
+
+        deadline = self.time_budget.phase(DOWNLOAD_PHASE, 'Download of %s' % file_name)
+        with self.timings.timed(file_name, DOWNLOAD) as counter:
+            try:
+                request = self.request('get', url, deadline, stream=True, headers=headers)
+            except DeadlineError as ex:
+                self.set_error(file_name, str(ex), timed_out=True)
+                return False
+            except HostDownError as ex:
+                LOG.error('Not downloading %s: %s', file_name, ex)
+                self.set_error(file_name, 'Host is down')
+                return False
+            except requests.RequestException as ex:
+                LOG.error('Request for %s failed: %s', file_name, ex)
+                self.set_error(file_name, 'Download failed')
+                return False
+            if request.status_code == 304:
+                request.close()
+                self.discard_partial(file_name)
+                LOG.info('No new download available for %s.', file_name)
+                self.update_existing_status(file_name)
+                # Nothing new to fetch; done here
+                return False
+            restart = request.status_code == 416 or (request.status_code == 206 and
+                                                     range_start(request.headers) != offset)
+            if restart:
+                # kept bytes do not line up with what the server has; start over below
+                request.close()
+            elif not request.ok:
+                request.close()
+                self.set_error(file_name, 'Download failed')
+                return False
+            else:
+                if request.status_code != 206 and offset:
+                    LOG.info('Feed %s changed or server cannot resume; downloading all of it.',
+                             file_name)
+                    offset = 0
+                validator = range_validator(request.headers)
+                self.keep_resume_validator(file_name, validator)
+                try:
+                    digest = self.save_download(file_name,
+                                                counter.count(deadline.guard(
+                                                    iter_body(request, self.chunk_size))),
+                                                offset=offset,
+                                                keep_partial=bool(validator))
+                except DeadlineError as ex:
+                    self.set_error(file_name, str(ex), timed_out=True)
+                    return False
+                except IOError as ex:
+                    if deadline.expired():
+                        # a read timed out at the deadline
+                        self.set_error(file_name, '%s ran out of time' % deadline.what,
+                                       timed_out=True)
+                        return False
+                    LOG.error('Download of %s interrupted: %s', file_name, ex)
+                    self.set_error(file_name, 'Download interrupted')
+                    return False
+                finally:
+                    # frees the host's request slot, held while the body streamed in
+                    request.close()
+
+        if restart:
+            LOG.warn('Could not resume download of %s; downloading it again.', file_name)
+            self.discard_partial(file_name)
+            return self.download(file_name, url)
+        if not digest:
             return False
-        # file_name is local to download directory
+        posted_date = request.headers.get('last-modified')
+        if not posted_date:
+            LOG.debug('No last-modified header set')
+            posted_date = datetime.utcnow().strftime(TIMECHECK_FMT)
+        self.set_posted_date(file_name, posted_date)
+        self.set_validators(file_name, request.headers)
+        LOG.info('Download completed successfully.')
+        if self.is_unchanged(file_name, digest):
+            return False
+        # dates are known while the feed waits to be validated
+        self.set_effective_dates(file_name)
+        return True
+
+    def save_download(self, file_name, chunks, offset=0, keep_partial=False):
+        """Write a download to file as it streams in, computing its content digest on the way.
+
+        The download is written to a temporary file next to the feed, which only replaces
+        the previous download once it has been checked to be a zip file, so a failed download
+        leaves the last good feed in place.
+
+        :param file_name: Name of feed file to save the download as, relative to :ddir:
+        :param chunks: Iterable of the downloaded data
+        :param offset: Number of bytes of the temporary file kept from an interrupted download,
+                       which the downloaded data follows on from
+        :param keep_partial: If True, keep the temporary file if the download is interrupted,
+                             so it may be resumed
+        :returns: Hex digest of the downloaded content, or None if it was not a zip file
+        """
         file_path = os.path.join(self.ddir, file_name)
-        LOG.info('Getting file %s...from...%s', file_path, url)
-        request = requests.get(url, stream=do_stream)
-
-        if request.ok:
-            with open(file_path, 'wb') as download_file:
-                if do_stream:
-                    for chunk in request.iter_content(chunk_size=1024):
-                        download_file.write(chunk)
-                else:
-                    download_file.write(request.content)
-
-            info = os.stat(file_path)
-            if info.st_size < 10000:
-                # file smaller than 10K; may not be a GTFS
-                LOG.warn('Download for %s is only %s bytes.', file_path, str(info.st_size))
-            if not zipfile.is_zipfile(file_path):
-                self.set_error(file_name, 'Download is not a zip file')
-                return False
-            posted_date = request.headers.get('last-modified')
-            if not posted_date:
-                LOG.debug('No last-modified header set')
-                posted_date = datetime.utcnow().strftime(TIMECHECK_FMT)
-            self.set_posted_date(file_name, posted_date)
-            LOG.info('Download completed successfully.')
+        partial_path = self.partial_path(file_name)
+        digest = new_digest()
+        if offset:
+            with open(partial_path, 'r+b') as partial_file:
+                partial_file.truncate(offset)
+                for chunk in iter(lambda: partial_file.read(self.chunk_size), b''):
+                    digest.update(chunk)
+        try:
+            with open(partial_path, 'ab' if offset else 'wb') as download_file:
+                for chunk in chunks:
+                    download_file.write(chunk)
+                    digest.update(chunk)
+        except:
+            if keep_partial:
+                LOG.info('Kept %s bytes of %s to resume from.',
+                         os.path.getsize(partial_path), file_name)
+            else:
+                os.remove(partial_path)
+            raise
+
+        size = os.path.getsize(partial_path)
+        if size < 10000:
+            # file smaller than 10K; may not be a GTFS
+            LOG.warn('Download for %s is only %s bytes.', file_path, str(size))
+        if not zipfile.is_zipfile(partial_path):
+            self.discard_partial(file_name)
+            self.set_error(file_name, 'Download is not a zip file')
+            return None
+        os.rename(partial_path, file_path)
+        self.discard_partial(file_name)
+        return digest.hexdigest()
+
+    def is_unchanged(self, file_name, digest):
+        """Check if a new download is byte-identical to the feed's previous download.
+
+        If it is, the previous validation results still hold, so :update_existing_status: is
+        used instead of validating it again. Otherwise, the new digest is saved to the status.
+
+        :param file_name: Name of feed file, relative to :ddir:
+        :param digest: Hex digest of the new download's content
+        :returns: True if the download is unchanged and need not be validated
+        """
+        stat = self.status.get(file_name, {})
+        if stat.get('digest') == digest and stat.has_key('is_valid'):
+            LOG.info('Download for %s is unchanged since last fetched; not validating again.',
+                     file_name)
+            self.update_existing_status(file_name)
             return True
-        else:
-            self.set_error(file_name, 'Download failed')
+        stat['digest'] = digest
+        record_update(stat, stat.get('posted_date'))
+        self.status[file_name] = stat
         return False
 
     def set_posted_date(self, file_name, posted_date):
@@ -336,13 +925,33 @@ class FeedSource(object):
         stat['posted_date'] = posted_date
         self.status[file_name] = stat
 
-    def set_error(self, file_name, msg):
+    def set_validators(self, file_name, headers):
+        """Keep the ETag and Last-Modified response headers, to make the next download conditional.
+
+        :param file_name: Name of feed file, relative to :ddir:
+        :param headers: Headers from the download response
+        """
+        stat = self.status.get(file_name, {})
+        for key, header in (('etag', 'etag'), ('last_modified', 'last-modified')):
+            if headers.get(header):
+                stat[key] = headers.get(header)
+            elif key in stat:
+                del stat[key]
+        self.status[file_name] = stat
+
+    def set_error(self, file_name, msg, timed_out=False):
         """If error encountered in processing, set status error message, and unset other fields.
 
         :param file_name: Name of feed file, relative to :ddir:
         :param msg: Error message to save with status
+        :param timed_out: If True, the error was from stopping work that went over its deadline
         """
-        LOG.error('Error processing %s: %s', file_name, msg)
-        self.status[file_name] = {'error': msg}
+        LOG.error('%s processing %s: %s', 'Timed out' if timed_out else 'Error', file_name, msg)
+        stat = self.status.get(file_name, {})
+        # keep learning how often the feed is updated, and what was scraped for it, across errors
+        kept = dict((key, stat[key]) for key in KEPT_ON_ERROR if stat.get(key))
+        self.status[file_name] = dict(kept, error=msg)
+        if timed_out:
+            self.status[file_name]['timed_out'] = True
         # write out status file immediately
         self.write_status()
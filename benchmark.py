@@ -0,0 +1,597 @@
+#!/usr/bin/env python
+"""Benchmark fetching, validating and extending feeds, without touching any agency's servers.
+
+Synthetic feeds are served from a local HTTP server that can be made slow, bandwidth-limited
+or unreliable, and the feeds are fetched, verified and extended end to end. Each phase runs in
+its own process, so its peak memory use can be measured apart from the others.
+"""
+import argparse
+import BaseHTTPServer
+from email.utils import formatdate, mktime_tz, parsedate_tz
+import json
+import logging
+import multiprocessing
+import os
+import random
+import resource
+import shutil
+import socket
+import SocketServer
+import sys
+import tempfile
+import threading
+import time
+import urlparse
+
+from prettytable import PrettyTable
+
+from digests import file_digest
+from extend_effective_dates import extend_feeds, EFFECTIVE_DAYS, EXTENDED
+from FeedSource import FeedSource
+from fetch_feeds import fetch_all
+from synthetic_gtfs import write_sized_feed, FEED_SIZES
+from validation import VALIDATION_MODE, VALIDATION_MODES
+
+# validators the server sends with each feed, for conditional and resumed requests
+BOTH_VALIDATORS = 'both'
+ETAG_VALIDATOR = 'etag'
+LAST_MODIFIED_VALIDATOR = 'last-modified'
+NO_VALIDATORS = 'none'
+SERVER_VALIDATORS = (BOTH_VALIDATORS, ETAG_VALIDATOR, LAST_MODIFIED_VALIDATOR, NO_VALIDATORS)
+
+# failures the server can inject: an error response, or a body cut off halfway
+FAIL_ERROR = 'error'
+FAIL_TRUNCATE = 'truncate'
+FAILURE_MODES = (FAIL_ERROR, FAIL_TRUNCATE)
+
+# number of bytes the server writes at a time
+SEND_CHUNK_SIZE = 64 * 1024
+
+# fetch all the feeds into an empty download directory
+FETCH_PHASE = 'fetch'
+# fetch them all again, when none have changed
+REFETCH_PHASE = 'refetch'
+# verify all the downloaded feeds
+VERIFY_PHASE = 'verify'
+# extend the effective dates of all the downloaded feeds
+EXTEND_PHASE = 'extend'
+PHASES = (FETCH_PHASE, REFETCH_PHASE, VERIFY_PHASE, EXTEND_PHASE)
+
+# name of the feed source the synthetic feeds are fetched through
+SOURCE_NAME = 'Benchmark'
+
+logging.basicConfig()
+LOG = logging.getLogger()
+LOG.setLevel(logging.INFO)
+
+
+class FeedRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Serve the feeds in the :FeedServer:'s directory, as its settings direct."""
+    # keep connections open, so connection pooling is exercised as it would be for real
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):  # pylint: disable=invalid-name
+        """Send a feed."""
+        self.send_feed(True)
+
+    def do_HEAD(self):  # pylint: disable=invalid-name
+        """Send a feed's headers."""
+        self.send_feed(False)
+
+    def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+        """Log requests at debug level, rather than to standard error."""
+        LOG.debug('%s - %s', self.address_string(), format % args)
+
+    def send_feed(self, with_body):
+        """Respond to a request for a feed.
+
+        :param with_body: If False, only send the headers
+        """
+        server = self.server
+        if server.latency:
+            time.sleep(server.latency)
+        file_name = os.path.basename(urlparse.urlparse(self.path).path)
+        feed_path = os.path.join(server.directory, file_name)
+        if not file_name or not os.path.isfile(feed_path):
+            self.send_empty(404)
+            return
+
+        failure = server.inject_failure()
+        if failure == FAIL_ERROR:
+            self.send_empty(503)
+            return
+
+        size = os.path.getsize(feed_path)
+        mtime = int(os.path.getmtime(feed_path))
+        etag = last_modified = None
+        if server.validators in (BOTH_VALIDATORS, ETAG_VALIDATOR):
+            etag = server.etag(feed_path)
+        if server.validators in (BOTH_VALIDATORS, LAST_MODIFIED_VALIDATOR):
+            last_modified = formatdate(mtime, usegmt=True)
+
+        if self.is_not_modified(etag, last_modified and mtime):
+            server.count('not_modified')
+            self.send_response(304)
+            self.send_validators(etag, last_modified)
+            self.end_headers()
+            return
+
+        start = self.range_start(etag, last_modified)
+        if start is not None and start >= size:
+            self.send_empty(416)
+            return
+        if start is None:
+            self.send_response(200)
+            start = 0
+        else:
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes %d-%d/%d' % (start, size - 1, size))
+        self.send_header('Content-Type', 'application/zip')
+        self.send_header('Content-Length', str(size - start))
+        if etag or last_modified:
+            self.send_header('Accept-Ranges', 'bytes')
+        self.send_validators(etag, last_modified)
+        self.end_headers()
+        if with_body:
+            self.send_body(feed_path, start, size, failure == FAIL_TRUNCATE)
+
+    def send_empty(self, code):
+        """Send a response with no body."""
+        self.send_response(code)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def send_validators(self, etag, last_modified):
+        """Send the ETag and Last-Modified headers the server is set to send."""
+        if etag:
+            self.send_header('ETag', etag)
+        if last_modified:
+            self.send_header('Last-Modified', last_modified)
+
+    def is_not_modified(self, etag, mtime):
+        """Check if the request's conditional headers match the feed being sent.
+
+        :param etag: ETag of the feed, or None if the server does not send one
+        :param mtime: When the feed was last modified, or None if the server does not send it
+        """
+        if_none_match = self.headers.get('If-None-Match')
+        if if_none_match:
+            return bool(etag) and if_none_match == etag
+        if_modified_since = parsedate_tz(self.headers.get('If-Modified-Since') or '')
+        return bool(mtime and if_modified_since) and mtime <= mktime_tz(if_modified_since)
+
+    def range_start(self, etag, last_modified):
+        """Find where to start sending the feed from, for a request to resume a download.
+
+        :returns: Byte to start from, or None if the whole feed should be sent
+        """
+        requested = self.headers.get('Range', '')
+        if not requested.startswith('bytes=') or not (etag or last_modified):
+            return None
+        if_range = self.headers.get('If-Range')
+        if if_range and if_range not in (etag, last_modified):
+            return None
+        start = requested[len('bytes='):].split('-')[0]
+        return int(start) if start.isdigit() else None
+
+    def send_body(self, feed_path, start, size, truncate):
+        """Send a feed's content, limited to the server's bandwidth.
+
+        :param feed_path: Full path to the feed
+        :param start: Byte to start sending from
+        :param size: Size of the feed
+        :param truncate: If True, drop the connection halfway through
+        """
+        server = self.server
+        end = start + (size - start) // 2 if truncate else size
+        sent = 0
+        began = time.time()
+        server.sending(1)
+        try:
+            with open(feed_path, 'rb') as feed_file:
+                feed_file.seek(start)
+                while start + sent < end:
+                    chunk = feed_file.read(min(SEND_CHUNK_SIZE, end - start - sent))
+                    self.wfile.write(chunk)
+                    sent += len(chunk)
+                    # no wait after the last chunk, so the body is done once it is all sent
+                    if server.bandwidth and start + sent < end:
+                        ahead = sent / float(server.bandwidth) - (time.time() - began)
+                        if ahead > 0:
+                            time.sleep(ahead)
+        except socket.error as ex:
+            LOG.debug('Client went away while sending %s: %s', feed_path, ex)
+            self.close_connection = True
+        finally:
+            server.sending(-1)
+            server.count('bytes_sent', sent)
+        if truncate:
+            self.close_connection = True
+
+
+class FeedServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """Local HTTP server for the feeds in a directory, on a port chosen by the system.
+
+    Can add latency to each response, limit the bandwidth of each download, choose which
+    validators to send, and fail a share of requests.
+    """
+    daemon_threads = True
+
+    def __init__(self, directory, latency=0.0, bandwidth=None, validators=BOTH_VALIDATORS,
+                 failure_rate=0.0, failure_mode=FAIL_ERROR, seed=None):
+        """Open the server; call :start: to begin serving.
+
+        :param directory: Directory of feeds to serve
+        :param latency: Seconds to wait before each response
+        :param bandwidth: Bytes per second to send each download at; if None, no limit
+        :param validators: Which validators to send; one of :SERVER_VALIDATORS:
+        :param failure_rate: Share of requests, from 0 to 1, to fail
+        :param failure_mode: How to fail requests; one of :FAILURE_MODES:
+        :param seed: Seed for choosing the requests to fail, so runs can be reproduced
+        """
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0), FeedRequestHandler)
+        self.directory = directory
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.validators = validators
+        self.failure_rate = failure_rate
+        self.failure_mode = failure_mode
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        # ETag of each feed, by (path, size, modified time)
+        self._etags = {}
+        self._thread = None
+        # number of bodies being sent right now
+        self._sending = 0
+        self.stats = None
+        self.reset_stats()
+
+    def start(self):
+        """Serve requests on a background thread.
+
+        :returns: This server
+        """
+        self._thread = threading.Thread(target=self.serve_forever, name='FeedServer')
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def close(self):
+        """Stop serving and close the server's socket."""
+        if self._thread:
+            self.shutdown()
+            self._thread.join()
+        self.server_close()
+
+    def url(self, file_name):
+        """Get the URL a feed is served at."""
+        return 'http://%s:%d/%s' % (self.server_address[0], self.server_address[1], file_name)
+
+    def etag(self, feed_path):
+        """Get the ETag of a feed, computed once for each version of it."""
+        key = (feed_path, os.path.getsize(feed_path), os.path.getmtime(feed_path))
+        with self._lock:
+            etag = self._etags.get(key)
+        if not etag:
+            etag = '"%s"' % file_digest(feed_path)
+            with self._lock:
+                self._etags[key] = etag
+        return etag
+
+    def inject_failure(self):
+        """Decide whether to fail a request.
+
+        :returns: Failure mode to fail the request with, or None to serve it
+        """
+        with self._lock:
+            self.stats['requests'] += 1
+            if self.failure_rate and self._random.random() < self.failure_rate:
+                self.stats['failures'] += 1
+                return self.failure_mode
+        return None
+
+    def count(self, stat, amount=1):
+        """Add to one of the server's :stats:."""
+        with self._lock:
+            self.stats[stat] += amount
+
+    def sending(self, change):
+        """Note a body starting (1) or finishing (-1) being sent, keeping the peak number
+        sent at once in :stats:."""
+        with self._lock:
+            self._sending += change
+            self.stats['peak_sending'] = max(self.stats['peak_sending'], self._sending)
+
+    def reset_stats(self):
+        """Start counting requests, failures, not modified responses, bytes sent and the peak
+        number of bodies sent at once anew."""
+        with self._lock:
+            self.stats = dict.fromkeys(('requests', 'failures', 'not_modified', 'bytes_sent',
+                                        'peak_sending'), 0)
+
+
+def make_source_class(urls):
+    """Make a :FeedSource: subclass that fetches the given feeds.
+
+    :param urls: Dictionary of { file name: url } of the feeds
+    :returns: The class, named :SOURCE_NAME:
+    """
+    def __init__(self, **kwargs):
+        FeedSource.__init__(self, **kwargs)
+        self.urls = dict(urls)
+    return type(SOURCE_NAME, (FeedSource,), {'__init__': __init__,
+                                             '__doc__': 'Fetch synthetic benchmark feeds.'})
+
+
+def generate_feeds(directory, sizes, count):
+    """Write synthetic feeds to serve.
+
+    :param directory: Directory to write the feeds to
+    :param sizes: List of names of :FEED_SIZES: to write feeds of
+    :param count: Number of feeds of each size to write
+    :returns: List of the feeds' file names
+    """
+    file_names = []
+    for size in sizes:
+        for idx in range(count):
+            file_name = '%s_%d.zip' % (size, idx)
+            start = time.time()
+            write_sized_feed(os.path.join(directory, file_name), size, seed=idx)
+            LOG.info('Generated %s in %.2f seconds.', file_name, time.time() - start)
+            file_names.append(file_name)
+    return file_names
+
+
+def feeds_size(ddir, file_names):
+    """Get the total size of the feeds on disk in a directory."""
+    paths = [os.path.join(ddir, file_name) for file_name in file_names]
+    return sum(os.path.getsize(path) for path in paths if os.path.isfile(path))
+
+
+def run_fetch(settings):
+    """Fetch all the feeds.
+
+    :returns: Dictionary of the number of feeds fetched and errors
+    """
+    # the local feed server needs no protecting from the fetcher, so do not slow it down
+    statuses = fetch_all(sources=[settings['source']], workers=settings['workers'],
+                         validation_mode=settings['validation_mode'], ddir=settings['ddir'],
+                         rate_limit=0)
+    return {'feeds': len(statuses),
+            'errors': len([stat for stat in statuses.values() if stat.has_key('error')])}
+
+
+def run_verify(settings):
+    """Verify all the downloaded feeds.
+
+    :returns: Dictionary of the number of feeds verified, errors, and bytes read
+    """
+    source = settings['source'](ddir=settings['ddir'],
+                                validation_mode=settings['validation_mode'])
+    file_names = [file_name for file_name in sorted(source.urls)
+                  if os.path.isfile(os.path.join(settings['ddir'], file_name))]
+    try:
+        valid = len([file_name for file_name in file_names if source.verify(file_name)])
+        source.write_status()
+    finally:
+        source.status_store.close()
+    return {'feeds': len(file_names), 'errors': len(file_names) - valid,
+            'bytes': feeds_size(settings['ddir'], file_names)}
+
+
+def run_extend(settings):
+    """Extend the effective dates of all the downloaded feeds.
+
+    :returns: Dictionary of the number of feeds extended, errors, and bytes read
+    """
+    results = extend_feeds(settings['ddir'], EFFECTIVE_DAYS, workers=settings['workers'])
+    return {'feeds': len(results),
+            'errors': len([result for result in results if result[1] != EXTENDED]),
+            'bytes': feeds_size(settings['ddir'],
+                                [os.path.basename(result[0]) for result in results])}
+
+
+# function to run each phase
+PHASE_RUNNERS = {
+    FETCH_PHASE: run_fetch,
+    REFETCH_PHASE: run_fetch,
+    VERIFY_PHASE: run_verify,
+    EXTEND_PHASE: run_extend,
+}
+
+
+def _run_phase_process(results, phase, settings):
+    """Run a phase and put its results, with its time taken and peak memory use, on a queue."""
+    if not settings['verbose']:
+        # only warnings from the code being benchmarked
+        LOG.setLevel(logging.WARN)
+    start = time.time()
+    try:
+        result = PHASE_RUNNERS[phase](settings)
+    except Exception as ex:  # report the failed phase, and carry on with the rest
+        LOG.exception('Benchmark phase %s failed.', phase)
+        result = {'failed': str(ex)}
+    result['seconds'] = time.time() - start
+    # ru_maxrss is in kilobytes on Linux
+    result['peak_rss'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    result['children_peak_rss'] = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * 1024
+    results.put(result)
+
+
+def run_phase(phase, settings, server):
+    """Run a phase of the benchmark in a new process, so its peak memory use is its own.
+
+    :param phase: One of :PHASES:
+    :param settings: Dictionary of the source class, download directory, workers,
+                     validation mode, and whether to log everything the phase does
+    :param server: :FeedServer: the feeds are fetched from
+    :returns: Dictionary of results for the phase
+    """
+    server.reset_stats()
+    results = multiprocessing.Queue()
+    process = multiprocessing.Process(target=_run_phase_process,
+                                      args=(results, phase, settings))
+    process.start()
+    process.join()
+    if process.exitcode or results.empty():
+        result = {'failed': 'exited with code %s' % process.exitcode}
+    else:
+        result = results.get()
+    result['phase'] = phase
+    result['server'] = dict(server.stats)
+    if 'bytes' not in result:
+        result['bytes'] = server.stats['bytes_sent']
+    return result
+
+
+def report(results):
+    """Log a table of the results of each phase."""
+    ptable = PrettyTable()
+    ptable.field_names = ['phase', 'seconds', 'feeds', 'errors', 'MB', 'MB/s', 'peak RSS MB',
+                          'children peak RSS MB', 'requests', 'not modified', 'failures']
+    for result in results:
+        if 'failed' in result:
+            LOG.error('Phase %s failed: %s', result['phase'], result['failed'])
+        seconds = result.get('seconds')
+        megabytes = result['bytes'] / 1048576.0
+        ptable.add_row([result['phase'],
+                        '%.2f' % seconds if seconds is not None else '',
+                        result.get('feeds', ''),
+                        result.get('errors', ''),
+                        '%.1f' % megabytes,
+                        '%.1f' % (megabytes / seconds) if seconds else '',
+                        '%.0f' % (result.get('peak_rss', 0) / 1048576.0),
+                        '%.0f' % (result.get('children_peak_rss', 0) / 1048576.0),
+                        result['server']['requests'],
+                        result['server']['not_modified'],
+                        result['server']['failures']])
+    LOG.info('Results:\n%s', ptable.get_string())
+
+
+def benchmark(sizes, count=1, phases=PHASES, workers=1, validation_mode=VALIDATION_MODE,
+              work_directory=None, latency=0.0, bandwidth=None, validators=BOTH_VALIDATORS,
+              failure_rate=0.0, failure_mode=FAIL_ERROR, seed=None, verbose=False):
+    """Generate feeds, serve them locally, and time fetching, verifying and extending them.
+
+    :param sizes: List of names of :FEED_SIZES: to generate feeds of
+    :param count: Number of feeds of each size to generate
+    :param phases: Phases to run, in order; from :PHASES:
+    :param workers: Number of feeds to fetch, or extend, at the same time
+    :param validation_mode: How to validate feeds; one of :validation.VALIDATION_MODES:
+    :param work_directory: Directory to generate and download feeds in; if None,
+                           a temporary directory is used, and removed afterwards
+    :param latency: Seconds the server waits before each response
+    :param bandwidth: Bytes per second the server sends each download at; if None, no limit
+    :param validators: Which validators the server sends; one of :SERVER_VALIDATORS:
+    :param failure_rate: Share of requests, from 0 to 1, the server fails
+    :param failure_mode: How the server fails requests; one of :FAILURE_MODES:
+    :param seed: Seed for choosing the requests to fail
+    :param verbose: If True, show the info messages logged by the code being benchmarked
+    :returns: List of dictionaries of results, one for each phase
+    """
+    temporary = not work_directory
+    work_directory = work_directory or tempfile.mkdtemp(prefix='gtfs-benchmark-')
+    served_directory = os.path.join(work_directory, 'served')
+    ddir = os.path.join(work_directory, 'gtfs')
+    for directory in (served_directory, ddir):
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    server = None
+    try:
+        file_names = generate_feeds(served_directory, sizes, count)
+        server = FeedServer(served_directory, latency, bandwidth, validators, failure_rate,
+                            failure_mode, seed).start()
+        LOG.info('Serving %s feeds (%.1f MB) at %s.', len(file_names),
+                 feeds_size(served_directory, file_names) / 1048576.0, server.url(''))
+        settings = {
+            'source': make_source_class(dict((file_name, server.url(file_name))
+                                             for file_name in file_names)),
+            'ddir': ddir,
+            'workers': workers,
+            'validation_mode': validation_mode,
+            'verbose': verbose,
+        }
+        results = []
+        for phase in phases:
+            LOG.info('Running %s phase...', phase)
+            results.append(run_phase(phase, settings, server))
+        report(results)
+        return results
+    finally:
+        if server:
+            server.close()
+        if temporary:
+            shutil.rmtree(work_directory)
+
+
+def main():
+    """Main entry point for command line interface."""
+    parser = argparse.ArgumentParser(description='Benchmark fetching, validating and extending ' +
+                                     'synthetic feeds from a local server.')
+    parser.add_argument('--sizes', default='small',
+                        help='Comma-separated sizes of feeds to generate, from: %s ' %
+                        ', '.join(FEED_SIZES) + '(default: small)')
+    parser.add_argument('--count', '-n', type=int, default=1,
+                        help='Number of feeds of each size to generate (default: 1)')
+    parser.add_argument('--phases', default=','.join(PHASES),
+                        help='Comma-separated phases to run, in order, from: %s (default: all)' %
+                        ', '.join(PHASES))
+    parser.add_argument('--workers', '-w', type=int, default=1,
+                        help='Number of feeds to fetch or extend in parallel (default: 1)')
+    parser.add_argument('--validation', choices=VALIDATION_MODES, default=VALIDATION_MODE,
+                        help='How to validate feeds (default: %s)' % VALIDATION_MODE)
+    parser.add_argument('--work-directory',
+                        help='Directory to generate and download feeds in, which is kept ' +
+                        '(default: a temporary directory, removed afterwards)')
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='Seconds the server waits before each response (default: 0)')
+    parser.add_argument('--bandwidth', type=float,
+                        help='Kilobytes per second the server sends each download at ' +
+                        '(default: unlimited)')
+    parser.add_argument('--server-validators', choices=SERVER_VALIDATORS,
+                        default=BOTH_VALIDATORS,
+                        help='Validators the server sends for conditional and resumed ' +
+                        'requests (default: %s)' % BOTH_VALIDATORS)
+    parser.add_argument('--failure-rate', type=float, default=0.0,
+                        help='Share of requests, from 0 to 1, the server fails (default: 0)')
+    parser.add_argument('--failure-mode', choices=FAILURE_MODES, default=FAIL_ERROR,
+                        help='Fail requests with an error response, or by cutting the ' +
+                        'download off halfway (default: %s)' % FAIL_ERROR)
+    parser.add_argument('--seed', type=int,
+                        help='Seed for choosing the requests to fail (default: random)')
+    parser.add_argument('--json', metavar='PATH',
+                        help='Also write the results to this file as JSON')
+    parser.add_argument('--verbose', '-v', action='count',
+                        help='Show the log messages of the code being benchmarked')
+
+    args = parser.parse_args()
+    sizes = args.sizes.split(',')
+    phases = args.phases.split(',')
+    unknown = [size for size in sizes if size not in FEED_SIZES]
+    unknown += [phase for phase in phases if phase not in PHASES]
+    if unknown:
+        LOG.error('Unknown sizes or phases: %s. Exiting.', ', '.join(unknown))
+        sys.exit(2)
+    if min(args.count, args.workers) < 1:
+        LOG.error('--count and --workers must be positive integers. Exiting.')
+        sys.exit(2)
+    if not 0 <= args.failure_rate <= 1:
+        LOG.error('--failure-rate must be between 0 and 1. Exiting.')
+        sys.exit(2)
+
+    if args.verbose > 1:
+        LOG.setLevel(logging.DEBUG)
+
+    results = benchmark(sizes, args.count, phases, args.workers, args.validation,
+                        args.work_directory, args.latency,
+                        args.bandwidth * 1024 if args.bandwidth else None,
+                        args.server_validators, args.failure_rate, args.failure_mode, args.seed,
+                        bool(args.verbose))
+    if args.json:
+        with open(args.json, 'w') as json_file:
+            json.dump({'settings': vars(args), 'results': results}, json_file, indent=2,
+                      sort_keys=True)
+
+if __name__ == '__main__':
+    main()
@@ -1,15 +1,67 @@
 #!/usr/bin/env python
-"""Command line interface for reporting on downloaded feed statuses."""
+"""Command line interface for reporting on downloaded feed statuses.
+
+All the statuses are loaded at once, into a summary table with a row for each feed,
+which is then logged or written out as JSON, CSV or Prometheus text exposition format.
+"""
 import argparse
-from datetime import datetime, timedelta
+import csv
+from datetime import date, datetime, timedelta
+import json
 import logging
+from multiprocessing.pool import ThreadPool
 import os
 import pickle
 import sys
+import time
+
+from status_store import StatusStore, STATUS_DB
 
 DOWNLOAD_DIRECTORY = 'gtfs'
 # warn if feed is within this many days of expiring
 WARN_DAYS = 30
+# number of pickled status files to read at the same time
+WORKERS = 8
+
+# report formats
+LOG_FORMAT = 'log'
+JSON_FORMAT = 'json'
+CSV_FORMAT = 'csv'
+PROMETHEUS_FORMAT = 'prometheus'
+REPORT_FORMATS = (LOG_FORMAT, JSON_FORMAT, CSV_FORMAT, PROMETHEUS_FORMAT)
+
+# feed states, in order of precedence when more than one applies
+STATE_TIMED_OUT = 'timed out'
+STATE_ERROR = 'error'
+STATE_INVALID = 'invalid'
+STATE_EXPIRED = 'expired'
+STATE_NOT_EFFECTIVE = 'not effective'
+STATE_EXPIRING = 'expiring'
+STATE_NO_DATES = 'no dates'
+STATE_OK = 'ok'
+STATES = (STATE_TIMED_OUT, STATE_ERROR, STATE_INVALID, STATE_EXPIRED, STATE_NOT_EFFECTIVE,
+          STATE_EXPIRING, STATE_NO_DATES, STATE_OK)
+
+# columns of the summary table, in the order written to CSV
+FIELDS = ('source', 'feed', 'state', 'last_check', 'posted_date', 'is_new', 'is_valid',
+          'is_current', 'newly_effective', 'effective_from', 'effective_to', 'days_to_expiry',
+          'error')
+
+# Prometheus gauges for each feed: (name, help, summary table column)
+FEED_METRICS = (
+    ('gtfs_feed_error', 'Whether the feed could not be fetched or processed.', 'error'),
+    ('gtfs_feed_valid', 'Whether the feed passed validation.', 'is_valid'),
+    ('gtfs_feed_current', 'Whether the feed is currently in effect.', 'is_current'),
+    ('gtfs_feed_new', 'Whether the feed was new on the last check.', 'is_new'),
+    ('gtfs_feed_newly_effective', 'Whether the feed has come into effect since it was fetched.',
+     'newly_effective'),
+    ('gtfs_feed_days_to_expiry', 'Days until the last date of service in the feed.',
+     'days_to_expiry'),
+    ('gtfs_feed_effective_from_timestamp_seconds', 'First date of service in the feed.',
+     'effective_from'),
+    ('gtfs_feed_effective_to_timestamp_seconds', 'Last date of service in the feed.',
+     'effective_to'),
+)
 
 logging.basicConfig()
 LOG = logging.getLogger()
@@ -18,55 +70,121 @@ LOG.setLevel(logging.WARN)
 
 def check_current(file_name, stat, warn_days):
     """Check effective date range on feed."""
-    today = datetime.today()
-    try:
-        if not stat.get('effective_from') or not stat.get('effective_to'):
-            LOG.warn('No effective date range for %s.', file_name)
-        elif stat['effective_from'] > today:
-            LOG.warn('Feed %s not effective until %s.', file_name, stat['effective_from'])
-            return False
-        elif stat['effective_to'] < today:
-            LOG.warn('Feed %s expired %s.', file_name, stat['efective_to'])
-            return False
-        elif stat['effective_to'] <= (today + timedelta(days=warn_days)):
-            LOG.warn('Feed %s will expire %s.', file_name, stat['effective_to'])
-        LOG.info('Feed %s is currently effective.', file_name)
-    except TypeError:
-        LOG.warn('No effective date range for %s.', file_name)
+    row = feed_row(None, file_name, stat, warn_days, None)
+    log_row(row, warn_days)
+    return row['state'] not in (STATE_EXPIRED, STATE_NOT_EFFECTIVE)
+
+
+def feed_row(source, feed, stat, warn_days, last_check, today=None):
+    """Summarize the status of a single feed.
+
+    :param source: Name of the source the feed belongs to
+    :param feed: File name of the feed
+    :param stat: Status dictionary for the feed
+    :param warn_days: Count a feed as expiring if it expires within this many days
+    :param last_check: When the source was last checked
+    :param today: Date to check the feed's effective dates against; defaults to today
+    :returns: Dictionary with a value for each of :FIELDS:
+    """
+    if today is None:
+        today = datetime.combine(date.today(), datetime.min.time())
+    row = dict.fromkeys(FIELDS)
+    row.update(source=source, feed=feed, last_check=last_check)
+    if isinstance(stat, basestring):
+        row.update(state=STATE_ERROR, error=stat)
+        return row
+    if not isinstance(stat, dict):
+        row.update(state=STATE_ERROR, error='Status is not in dictionary format.')
+        return row
+    if stat.has_key('error'):
+        row.update(state=STATE_TIMED_OUT if stat.get('timed_out') else STATE_ERROR,
+                   error=stat['error'])
+        return row
+
+    row.update(posted_date=stat.get('posted_date'),
+               is_new=bool(stat.get('is_new')),
+               is_valid=bool(stat.get('is_valid')),
+               is_current=bool(stat.get('is_current')),
+               newly_effective=bool(stat.get('newly_effective')))
+    effective_from, effective_to = stat.get('effective_from'), stat.get('effective_to')
+    if isinstance(effective_from, datetime) and isinstance(effective_to, datetime):
+        row.update(effective_from=effective_from, effective_to=effective_to,
+                   days_to_expiry=(effective_to - today).days)
+        if effective_to < today:
+            row['state'] = STATE_EXPIRED
+        elif effective_from > today:
+            row['state'] = STATE_NOT_EFFECTIVE
+        elif effective_to <= today + timedelta(days=warn_days):
+            row['state'] = STATE_EXPIRING
+        else:
+            row['state'] = STATE_OK
+    else:
+        row['state'] = STATE_NO_DATES
+    if not row['is_valid'] and row['state'] not in (STATE_EXPIRED, STATE_NOT_EFFECTIVE):
+        row['state'] = STATE_INVALID
+    return row
+
+
+def source_rows(source, statuses, warn_days, today=None):
+    """Summarize the statuses of all the feeds from one source.
+
+    Problems with one feed's status do not stop the rest of the source's feeds being reported.
+
+    :param source: Name of the source
+    :param statuses: Status dictionary for the source, as written by :FeedSource.write_status:
+    :param warn_days: Count a feed as expiring if it expires within this many days
+    :param today: Date to check the feeds' effective dates against; defaults to today
+    :returns: List of summary rows, one for each feed, sorted by feed
+    """
+    if not isinstance(statuses, dict):
+        return [feed_row(source, None, statuses, warn_days, None, today)]
+    last_check = statuses.get('last_check')
+    return [feed_row(source, feed, statuses[feed], warn_days, last_check, today)
+            for feed in sorted(statuses) if feed != 'last_check']
+
 
 def read_status(file_name, statuses, warn_days):
     """Read and log messages about passed status dictionary."""
-    if not isinstance(statuses, dict):
-        LOG.error('Status is not in dictionary format.')
-        return
+    log_report(source_rows(file_name, statuses, warn_days), warn_days)
+
+
+def read_status_file(status_path):
+    """Load a pickled status file written by earlier versions.
 
+    :param status_path: Full path to the status file
+    :returns: Tuple of (source name, status dictionary); the status is the error message
+              if the file could not be read
+    """
+    source = os.path.splitext(os.path.basename(status_path))[0]
+    LOG.debug('Reading status file %s...', status_path)
     try:
-        last = statuses.pop('last_check')
-        LOG.info('%s last checked %s.', file_name, last)
-        for feed in statuses:
-            LOG.debug('Checking status for feed %s...', feed)
-            stat = statuses[feed]
-            if stat.has_key('error'):
-                LOG.error('Error processing %s: %s', feed, stat['error'])
-                return
-            if stat['is_new']:
-                LOG.info('Feed %s is new.', feed)
-            else:
-                LOG.debug('Feed %s is not new.', feed)
-            if stat['is_valid']:
-                LOG.debug('Feed %s is valid.', feed)
-            else:
-                LOG.warn('Feed %s is not valid.', feed)
-            check_current(feed, stat, warn_days)
-            if stat.get('newly_effective'):
-                LOG.warn('Feed %s has become effective since the preceeding check.', feed)
+        with open(status_path, 'rb') as statfile:
+            return source, pickle.load(statfile)
+    except Exception as ex:  # unpickling can raise almost anything on a corrupt file
+        LOG.error('Could not read status file %s: %s', status_path, ex)
+        return source, 'Could not read status file: %s' % ex
+
 
-    except KeyError as ex:
-        LOG.error('Status for %s not in expected format.  Missing key: %s', file_name, ex.message)
+def load_statuses(status_directory, workers=WORKERS):
+    """Load the statuses of all the sources in a download directory.
+
+    Reads the status database, and any status files not yet migrated into it,
+    with the status files read in parallel.
+
+    :param status_directory: Directory with the status database and files
+    :param workers: Number of status files to read at the same time
+    :returns: Dictionary of { source name: status dictionary }
+    """
+    statuses = {}
+    status_db = os.path.join(status_directory, STATUS_DB)
+    if os.path.isfile(status_db):
+        LOG.debug('Reading status database %s...', status_db)
+        store = StatusStore(status_db)
+        try:
+            statuses.update(store.load_all())
+        finally:
+            store.close()
 
-def check_status(status_directory, warn_days):
-    """Report on the status of the downloaded feeds, according to their status files in the
-    download directory."""
     status_files = []
     for pdir, dirs, feed_files in os.walk(status_directory):
         if dirs:
@@ -77,13 +195,199 @@ def check_status(status_directory, warn_days):
 
     LOG.debug(status_files)
 
-    for status_path in status_files:
-        with open(status_path, 'rb') as statfile:
-            LOG.debug('Reading status file %s...', status_path)
-            status = pickle.load(statfile)
-            read_status(os.path.basename(status_path), status, warn_days)
+    if workers > 1 and len(status_files) > 1:
+        pool = ThreadPool(min(workers, len(status_files)))
+        try:
+            results = pool.map(read_status_file, status_files)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = [read_status_file(status_path) for status_path in status_files]
+    statuses.update(results)
+    return statuses
+
+
+def build_report(statuses, warn_days, today=None):
+    """Build the summary table for the statuses of all the sources.
+
+    :param statuses: Dictionary of { source name: status dictionary }
+    :param warn_days: Count a feed as expiring if it expires within this many days
+    :param today: Date to check the feeds' effective dates against; defaults to today
+    :returns: List of summary rows, one for each feed, sorted by source and feed
+    """
+    if today is None:
+        today = datetime.combine(date.today(), datetime.min.time())
+    rows = []
+    for source in sorted(statuses):
+        rows.extend(source_rows(source, statuses[source], warn_days, today))
+    return rows
+
 
+def log_row(row, warn_days):
+    """Log messages about a row of the summary table."""
+    feed = row['feed'] or row['source']
+    if row['state'] == STATE_TIMED_OUT:
+        LOG.error('Timed out processing %s: %s', feed, row['error'])
+        return
+    if row['state'] == STATE_ERROR:
+        LOG.error('Error processing %s: %s', feed, row['error'])
+        return
+    if row['is_new']:
+        LOG.info('Feed %s is new.', feed)
+    else:
+        LOG.debug('Feed %s is not new.', feed)
+    if row['is_valid']:
+        LOG.debug('Feed %s is valid.', feed)
+    else:
+        LOG.warn('Feed %s is not valid.', feed)
+    if row['effective_to'] is None:
+        LOG.warn('No effective date range for %s.', feed)
+    elif row['state'] == STATE_NOT_EFFECTIVE:
+        LOG.warn('Feed %s not effective until %s.', feed, row['effective_from'])
+    elif row['state'] == STATE_EXPIRED:
+        LOG.warn('Feed %s expired %s.', feed, row['effective_to'])
+    elif row['days_to_expiry'] <= warn_days:
+        LOG.warn('Feed %s will expire %s.', feed, row['effective_to'])
+    else:
+        LOG.info('Feed %s is currently effective.', feed)
+    if row['newly_effective']:
+        LOG.warn('Feed %s has become effective since the preceeding check.', feed)
+
+
+def log_report(rows, warn_days):
+    """Log messages about each row of the summary table."""
+    source = None
+    for row in rows:
+        if row['source'] != source:
+            source = row['source']
+            if row['last_check']:
+                LOG.info('%s last checked %s.', source, row['last_check'])
+        log_row(row, warn_days)
+
+
+def format_value(value):
+    """Format a summary table value for JSON or CSV output."""
+    if isinstance(value, datetime):
+        return value.isoformat()
+    return value
+
+
+def write_json(rows, out):
+    """Write the summary table as a JSON list of objects, one per feed."""
+    json.dump([dict((field, format_value(row[field])) for field in FIELDS) for row in rows],
+              out, indent=2, sort_keys=True)
+    out.write('\n')
+
+
+def write_csv(rows, out):
+    """Write the summary table as CSV, with a header row of :FIELDS:."""
+    writer = csv.writer(out)
+    writer.writerow(FIELDS)
+    for row in rows:
+        writer.writerow(['' if row[field] is None else format_value(row[field])
+                         for field in FIELDS])
+
+
+def prometheus_label(value):
+    """Escape a Prometheus label value."""
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def prometheus_value(value):
+    """Convert a summary table value to a Prometheus sample value.
+
+    :returns: Number, or None if the value is unknown and the sample should be left out
+    """
+    if value is None:
+        return None
+    if isinstance(value, datetime):
+        return int(time.mktime(value.timetuple()))
+    return int(value)
+
+
+def write_prometheus(rows, out):
+    """Write the summary table in Prometheus text exposition format."""
+    lines = []
+    for name, help_text, field in FEED_METRICS:
+        lines.append('# HELP %s %s' % (name, help_text))
+        lines.append('# TYPE %s gauge' % name)
+        for row in rows:
+            if field == 'error':
+                value = int(bool(row['error']))
+            else:
+                value = prometheus_value(row[field])
+            if value is not None:
+                lines.append('%s{source="%s",feed="%s"} %s' % (
+                    name, prometheus_label(row['source']), prometheus_label(row['feed'] or ''),
+                    value))
+
+    lines.append('# HELP gtfs_source_last_check_timestamp_seconds When the source was last '
+                 'checked.')
+    lines.append('# TYPE gtfs_source_last_check_timestamp_seconds gauge')
+    last_checks = dict((row['source'], row['last_check']) for row in rows if row['last_check'])
+    for source in sorted(last_checks):
+        lines.append('gtfs_source_last_check_timestamp_seconds{source="%s"} %s' % (
+            prometheus_label(source), prometheus_value(last_checks[source])))
+
+    lines.append('# HELP gtfs_feeds Number of feeds in each state.')
+    lines.append('# TYPE gtfs_feeds gauge')
+    for state in STATES:
+        lines.append('gtfs_feeds{state="%s"} %s' % (
+            state, sum(1 for row in rows if row['state'] == state)))
+    out.write('\n'.join(lines))
+    out.write('\n')
+
+
+# writer for each report format other than the log
+REPORT_WRITERS = {
+    JSON_FORMAT: write_json,
+    CSV_FORMAT: write_csv,
+    PROMETHEUS_FORMAT: write_prometheus,
+}
+
+
+def write_report(rows, report_format, output_path=None):
+    """Write the summary table out in a machine-readable format.
+
+    The report is written to a partial file renamed into place once complete,
+    so a monitor reading it never sees half a report.
+
+    :param rows: Summary table, from :build_report:
+    :param report_format: One of :JSON_FORMAT:, :CSV_FORMAT: or :PROMETHEUS_FORMAT:
+    :param output_path: File to write to; defaults to standard output
+    """
+    writer = REPORT_WRITERS[report_format]
+    if not output_path:
+        writer(rows, sys.stdout)
+        return
+    partial_path = output_path + '.part'
+    with open(partial_path, 'wb') as out:
+        writer(rows, out)
+    os.rename(partial_path, output_path)
+
+
+def check_status(status_directory, warn_days, report_format=LOG_FORMAT, output_path=None,
+                 workers=WORKERS):
+    """Report on the status of the downloaded feeds, according to the status database and any
+    status files not yet migrated into it in the download directory.
+
+    :param status_directory: Directory with the status database and files
+    :param warn_days: Warn if a feed will expire within this many days
+    :param report_format: One of :REPORT_FORMATS:
+    :param output_path: File to write a machine-readable report to; defaults to standard output
+    :param workers: Number of status files to read at the same time
+    :returns: Summary table, with a row for each feed
+    """
+    start = time.time()
+    rows = build_report(load_statuses(status_directory, workers), warn_days)
+    LOG.debug('Loaded statuses for %s feeds in %.3f seconds.', len(rows), time.time() - start)
+    if report_format == LOG_FORMAT:
+        log_report(rows, warn_days)
+    else:
+        write_report(rows, report_format, output_path)
     LOG.info('All done!')
+    return rows
 
 def main():
     """Main entry point for command line interface."""
@@ -96,6 +400,14 @@ def main():
                         default=WARN_DAYS,
                         help='Warn if feed will expire within this many days (default: %s)' %
                         WARN_DAYS)
+    parser.add_argument('--format', choices=REPORT_FORMATS, default=LOG_FORMAT,
+                        help='Log messages about each feed, or write a summary of all of them '
+                        '(default: %s)' % LOG_FORMAT)
+    parser.add_argument('--output', '-o',
+                        help='File to write the summary to (default: standard output)')
+    parser.add_argument('--workers', type=int, default=WORKERS,
+                        help='Number of status files to read at the same time (default: %s)' %
+                        WORKERS)
     parser.add_argument('--verbose', '-v',
                         action='count',
                         help='Increase log level verbosity (default log level: warn)')
@@ -112,7 +424,8 @@ def main():
         sys.exit(1)
     else:
         LOG.debug('Checking statuses in %s...', args.download_directory)
-        check_status(args.download_directory, args.warn_expiry_days)
+        check_status(args.download_directory, args.warn_expiry_days, args.format, args.output,
+                     args.workers)
 
 if __name__ == '__main__':
     main()
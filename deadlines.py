@@ -0,0 +1,146 @@
+"""Time limits on a run, and on each phase of fetching a feed within it.
+
+A run may have a deadline, and each phase (checking for a new version, downloading it and
+validating it) a budget of seconds. The time a phase may take is the lesser of its budget and
+what is left of the run, so one slow host or feed cannot hold up the whole run.
+"""
+import re
+import time
+
+# looking up and checking for a new version of a feed, such as by scraping a page
+CHECK_PHASE = 'check'
+# requesting and saving a download of the feed
+DOWNLOAD_PHASE = 'download'
+# validating the downloaded feed
+VALIDATE_PHASE = 'validate'
+PHASES = (CHECK_PHASE, DOWNLOAD_PHASE, VALIDATE_PHASE)
+
+# default seconds each phase of fetching a feed may take
+PHASE_BUDGETS = {
+    CHECK_PHASE: 5 * 60,
+    DOWNLOAD_PHASE: 30 * 60,
+    VALIDATE_PHASE: 60 * 60,
+}
+
+# seconds in each unit a duration may be given in
+DURATION_UNITS = {'': 1, 's': 1, 'm': 60, 'h': 60 * 60}
+
+
+class DeadlineError(Exception):
+    """Raised when work is stopped for going over its time limit."""
+    pass
+
+
+def parse_duration(value):
+    """Parse a duration given as a number of seconds, minutes or hours, such as '20m'.
+
+    :param value: Number followed by 's', 'm' or 'h'; seconds if no unit is given
+    :returns: Seconds
+    :raises ValueError: if the duration could not be parsed
+    """
+    match = re.match(r'^\s*(\d+(?:\.\d*)?)\s*([smh]?)\s*$', value.lower())
+    if not match:
+        raise ValueError('Could not parse duration %s' % value)
+    return float(match.group(1)) * DURATION_UNITS[match.group(2)]
+
+
+class Deadline(object):
+    """A point in time by which some work must be done."""
+    def __init__(self, expires=None, what='Work'):
+        """Set the deadline.
+
+        :param expires: Time, in seconds since the epoch, by which the work must be done;
+                        if None, it has no time limit
+        :param what: Description of the work, for error messages
+        """
+        self.expires = expires
+        self.what = what
+
+    def remaining(self):
+        """Get the seconds left before the deadline.
+
+        :returns: Seconds, which may be negative, or None if there is no time limit
+        """
+        if self.expires is None:
+            return None
+        return self.expires - time.time()
+
+    def expired(self):
+        """Check if the deadline has passed."""
+        remaining = self.remaining()
+        return remaining is not None and remaining <= 0
+
+    def check(self):
+        """Check there is still time left.
+
+        :raises DeadlineError: if the deadline has passed
+        """
+        if self.expired():
+            raise DeadlineError('%s ran out of time' % self.what)
+
+    def timeout(self, timeout):
+        """Shorten a :requests: timeout so it does not go past the deadline.
+
+        :param timeout: Seconds, or tuple of seconds to wait to connect and for each read
+        :returns: Timeout in the same form, with each value at most the time remaining
+        """
+        remaining = self.remaining()
+        if remaining is None:
+            return timeout
+        remaining = max(remaining, 0.001)
+        if isinstance(timeout, tuple):
+            return tuple(min(value, remaining) if value else remaining for value in timeout)
+        return min(timeout, remaining) if timeout else remaining
+
+    def guard(self, chunks):
+        """Stop iterating over data once the deadline passes.
+
+        :param chunks: Iterable of data
+        :returns: Generator of the same data
+        :raises DeadlineError: if the deadline passes before the data runs out
+        """
+        for chunk in chunks:
+            self.check()
+            yield chunk
+
+
+class TimeBudget(object):
+    """The deadline for a run, and the budget for each phase of fetching a feed within it."""
+    def __init__(self, deadline=None, phase_budgets=None):
+        """Start the clock on the run.
+
+        :param deadline: Seconds the run may take; if None, the run has no time limit
+        :param phase_budgets: Dictionary of { phase: seconds each time it runs may take },
+                              for any of :PHASES:; defaults to :PHASE_BUDGETS:. Phases given
+                              None have no limit of their own.
+        """
+        self.deadline = deadline
+        self.phase_budgets = dict(PHASE_BUDGETS)
+        self.phase_budgets.update(phase_budgets or {})
+        self.started = time.time()
+
+    @property
+    def expires(self):
+        """Time, in seconds since the epoch, the run must be done by, or None if no time limit."""
+        return self.started + self.deadline if self.deadline is not None else None
+
+    def run(self):
+        """Get the :Deadline: for the run as a whole."""
+        return Deadline(self.expires, 'Run')
+
+    def phase(self, phase, what=None):
+        """Start the clock on a phase.
+
+        :param phase: One of :PHASES:
+        :param what: Description of the work, for error messages; defaults to the phase
+        :returns: :Deadline: for the phase, which is never later than the run's
+        """
+        limits = [expires for expires in (self.expires,) if expires is not None]
+        if self.phase_budgets.get(phase) is not None:
+            limits.append(time.time() + self.phase_budgets[phase])
+        return Deadline(min(limits) if limits else None, what or phase.capitalize())
+
+    def renewed(self):
+        """Get a budget with the same limits, with the clock started over, such as for
+        the next check of a source when fetching continually."""
+        return TimeBudget(self.deadline, self.phase_budgets)
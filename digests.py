@@ -0,0 +1,23 @@
+"""Content digests, used to tell whether a feed has changed since it was last processed."""
+import hashlib
+
+# read files in chunks of this many bytes when computing their digests
+CHUNK_SIZE = 1024 * 1024
+
+
+def new_digest():
+    """Start a new content digest; feed it data with `update`, then call `hexdigest`."""
+    return hashlib.sha1()
+
+
+def file_digest(file_path):
+    """Compute the content digest of a file, reading it in chunks.
+
+    :param file_path: Full path to the file
+    :returns: Hex digest of the file's content
+    """
+    digest = new_digest()
+    with open(file_path, 'rb') as infile:
+        for chunk in iter(lambda: infile.read(CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
@@ -0,0 +1,83 @@
+"""Find the range of dates a GTFS feed is in effect, straight from its calendar files.
+
+Reads calendar.txt and calendar_dates.txt from the zip a row at a time, without extracting it
+or running the validator. The feed is effective from the earliest service start date (or added
+service date) to the latest service end date (or added service date), as feedvalidator.py reports.
+"""
+from collections import OrderedDict
+from datetime import datetime
+import itertools
+import logging
+import threading
+import zipfile
+
+from gtfs_tables import read_gtfs_columns
+
+LOG = logging.getLogger(__name__)
+
+# number of feeds to remember the effective dates for, by content digest
+MAX_CACHED = 256
+# calendar_dates.txt exception_type for a date service was added on
+SERVICE_ADDED = '1'
+
+_CACHE = OrderedDict()
+_CACHE_LOCK = threading.Lock()
+
+
+def parse_gtfs_date(value):
+    """Parse a GTFS date, such as 20170131.
+
+    :returns: Parsed :datetime:, or None if value is not a valid GTFS date
+    """
+    # sliced by hand; quicker than strptime, which also is not safe to first call from threads
+    if not value or len(value) != 8 or not value.isdigit():
+        return None
+    try:
+        return datetime(int(value[:4]), int(value[4:6]), int(value[6:]))
+    except ValueError:
+        return None
+
+
+def feed_effective_dates(feed_path):
+    """Find the effective date range of a feed from its calendar.txt and calendar_dates.txt.
+
+    :param feed_path: Full path to the GTFS zip
+    :returns: Tuple of (effective from, effective to) :datetime:s,
+              or (None, None) if the feed has no valid service dates
+    """
+    from_date = to_date = None
+    with zipfile.ZipFile(feed_path) as feedzip:
+        periods = ((parse_gtfs_date(start), parse_gtfs_date(end))
+                   for start, end in read_gtfs_columns(feedzip, 'calendar.txt',
+                                                       ('start_date', 'end_date')))
+        added = ((parse_gtfs_date(date),) * 2
+                 for date, exception_type in read_gtfs_columns(feedzip, 'calendar_dates.txt',
+                                                               ('date', 'exception_type'))
+                 if exception_type == SERVICE_ADDED)
+        for start, end in itertools.chain(periods, added):
+            if start and (not from_date or start < from_date):
+                from_date = start
+            if end and (not to_date or end > to_date):
+                to_date = end
+    return from_date, to_date
+
+
+def effective_dates(feed_path, digest=None):
+    """Find the effective date range of a feed, reusing the result found for the same content.
+
+    :param feed_path: Full path to the GTFS zip
+    :param digest: Content digest of the feed; if not set, the result is not cached
+    :returns: Tuple of (effective from, effective to), as for :feed_effective_dates:
+    """
+    if digest:
+        with _CACHE_LOCK:
+            if digest in _CACHE:
+                return _CACHE[digest]
+    dates = feed_effective_dates(feed_path)
+    LOG.debug('Feed %s effective from %s to %s.', feed_path, dates[0], dates[1])
+    if digest:
+        with _CACHE_LOCK:
+            if len(_CACHE) >= MAX_CACHED:
+                _CACHE.popitem(last=False)
+            _CACHE[digest] = dates
+    return dates
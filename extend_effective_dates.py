@@ -1,124 +1,275 @@
 #!/usr/bin/env python
 """Command line interface for extending feed effective dates."""
 import argparse
-import csv
-from datetime import datetime, timedelta
 import logging
+from multiprocessing import Pool
 import os
-import shutil
 import sys
+import time
 import zipfile
 
+from prettytable import PrettyTable
+
+from digests import file_digest
+from gtfs_transforms import (DropExpiredDates, ExtendCalendar, FilterAgencies, StripUnusedShapes,
+                             extension_window, transform_feed, GTFS_DATE_FMT)
+from status_store import StatusStore
+
 DOWNLOAD_DIRECTORY = 'gtfs'
 # extend feed effective date range this far into the past and future
 EFFECTIVE_DAYS = 365
-GTFS_DATE_FMT = '%Y%m%d'
+# extended feed for foo.zip is written to foo_extended.zip
+EXTENDED_SUFFIX = '_extended.zip'
+
+# outcomes of extending a feed
+EXTENDED = 'extended'
+NOT_NEEDED = 'does not need extension'
+NO_CALENDAR = 'no calendar.txt'
+NOT_ZIP = 'not a valid zip file'
+FAILED = 'failed'
+SKIPPED = 'up to date'
+
+# database in the feed directory recording the feeds extended, for --incremental runs
+EXTENSIONS_DB = 'extensions.db'
+# name the extension records are kept under in the database
+EXTENSIONS_SOURCE = 'extensions'
 
 logging.basicConfig()
 LOG = logging.getLogger()
 LOG.setLevel(logging.INFO)
 
 
-def extend_feed(feed_path, effective_days):
+def extend_feed(feed_path, effective_days, transforms=()):
     """Extend feed effective date range.
 
+    Writes the extended feed next to the original, in one pass over the original zip:
+    calendar.txt is rewritten, along with the tables any other transforms work on,
+    and the other members are copied over still compressed.
+
     :param feed_path: Full path to the GTFS to extend
     :param effective_days Number of days from today the feed should extend into future and past
+    :param transforms: List of other :gtfs_transforms.Transform:s to apply in the same pass
+    :returns: Outcome; one of :EXTENDED:, :NOT_NEEDED:, :NO_CALENDAR: or :NOT_ZIP:
     """
     file_name = os.path.basename(feed_path)
-    tmpdir = os.path.join(os.path.dirname(feed_path), 'tmp')
-    if os.path.isdir(tmpdir):
-        shutil.rmtree(tmpdir)
-    os.mkdir(tmpdir)
+    extended_path = os.path.join(os.path.dirname(feed_path), file_name[:-4] + EXTENDED_SUFFIX)
+    pipeline = [ExtendCalendar(effective_days)] + list(transforms)
     try:
         with zipfile.ZipFile(feed_path, 'r') as feedzip:
-            if 'calendar.txt' not in feedzip.namelist():
-                LOG.warn('Feed %s has no calendar.txt; cannot extend effective date range.',
-                         file_name)
-                return
-
-            LOG.debug('calendar.txt found for %s. Extracting zip.', file_name)
-            feedzip.extractall(tmpdir)
+            has_calendar = 'calendar.txt' in feedzip.namelist()
+        if not has_calendar:
+            LOG.warn('Feed %s has no calendar.txt; cannot extend effective date range.',
+                     file_name)
+        if transform_feed(feed_path, extended_path, pipeline):
+            LOG.info('Done writing extended feed for %s.', file_name)
+            return EXTENDED
     except zipfile.BadZipfile:
         LOG.error('Could not process zip file %s.', file_name)
+        return NOT_ZIP
+
+    if not has_calendar:
+        return NO_CALENDAR
+    LOG.info('Feed %s does not need extension.', file_name)
+    return NOT_NEEDED
+
+
+class ExtensionCache(object):
+    """Record of the feeds extended in a directory, to skip feeds that are already up to date.
+
+    For each source feed, keeps its size, modification time and content digest, the outcome of
+    extending it, the window of dates its extended feed was made to cover, and the other
+    transforms applied to it.
+    The digest is only computed again when the feed's size or modification time changes.
+    """
+    def __init__(self, feed_directory):
+        """Open the record for a directory of feeds.
+
+        :param feed_directory: Full path to the directory containing the GTFS to extend
+        """
+        self.feed_directory = feed_directory
+        self._store = StatusStore(os.path.join(feed_directory, EXTENSIONS_DB))
+        self._records = self._store.load(EXTENSIONS_SOURCE)
+        # content of each feed checked this run, by feed path
+        self._checked = {}
+
+    def _key(self, feed_path):
+        """Name a feed is recorded under: its path relative to the feed directory."""
+        return os.path.relpath(feed_path, self.feed_directory)
+
+    def _content(self, feed_path, record):
+        """Get the size, modification time and digest of a feed's content.
+
+        Reuses the recorded digest if the feed's size and modification time are unchanged.
+        """
+        info = os.stat(feed_path)
+        if record.get('size') == info.st_size and record.get('mtime') == info.st_mtime:
+            digest = record.get('digest')
+        else:
+            digest = file_digest(feed_path)
+        content = {'size': info.st_size, 'mtime': info.st_mtime, 'digest': digest}
+        self._checked[feed_path] = content
+        return content
+
+    def is_up_to_date(self, feed_path, window, transforms=()):
+        """Check if a feed is unchanged since it was last extended, to cover at least the window.
+
+        :param feed_path: Full path to the source GTFS
+        :param window: Tuple of (start, end) GTFS date strings the feed should be effective between
+        :param transforms: List of the other :Transform:s the feed should have had applied
+        :returns: True if the feed need not be extended again
+        """
+        record = self._records.get(self._key(feed_path), {})
+        if self._content(feed_path, record)['digest'] != record.get('digest'):
+            return False
+        if record.get('transforms', []) != [transform.describe() for transform in transforms]:
+            return False
+        outcome = record.get('outcome')
+        if outcome == NO_CALENDAR:
+            return True
+        if outcome == EXTENDED:
+            extended_path = feed_path[:-4] + EXTENDED_SUFFIX
+            if not os.path.isfile(extended_path):
+                return False
+        elif outcome != NOT_NEEDED:
+            return False
+        covered_start, covered_end = record.get('window', (None, None))
+        return covered_start <= window[0] and covered_end >= window[1]
+
+    def record(self, feed_path, outcome, window, transforms=()):
+        """Record the outcome of extending a feed to cover the window.
+
+        :param feed_path: Full path to the source GTFS
+        :param outcome: Outcome of extending it
+        :param window: Tuple of (start, end) GTFS date strings it was extended to cover
+        :param transforms: List of the other :Transform:s applied to it
+        """
+        key = self._key(feed_path)
+        content = self._checked.get(feed_path)
+        if outcome not in (EXTENDED, NOT_NEEDED, NO_CALENDAR) or not content:
+            self._records.pop(key, None)
+            return
+        record = dict(content)
+        record['outcome'] = outcome
+        record['window'] = window
+        record['transforms'] = [transform.describe() for transform in transforms]
+        self._records[key] = record
+
+    def close(self):
+        """Save the records and close the database."""
+        self._store.save(EXTENSIONS_SOURCE, self._records)
+        self._store.close()
+
+
+def timed_extend_feed(feed_path, effective_days, transforms=()):
+    """Extend a feed, timing how long it takes and catching any failure.
+
+    Each call works only on its own feed and its own output file, so many may run at once.
 
-    with open(os.path.join(tmpdir, 'calendar.txt'), 'rb') as cal_file:
-        csvdict = csv.DictReader(cal_file, skipinitialspace=True)
-        fldnames = csvdict.fieldnames
-        cal = [x for x in csvdict]
-    # flag to track whether this feed's effective dates have actually been extended
-    cal = extended_calendar(cal, effective_days)
-    if cal:
-        with open(os.path.join(tmpdir, 'calendar.txt'), 'wb') as cal_file:
-            csvdict = csv.DictWriter(cal_file, fieldnames=fldnames)
-            csvdict.writeheader()
-            csvdict.writerows(cal)
-            LOG.info('Done writing new calendar file for %s.', file_name)
-        # now re-zip and move the zip back to the download directory
-        lastdir = os.getcwd()
-        os.chdir(tmpdir)
-        with zipfile.ZipFile(os.path.join(os.path.dirname(feed_path),
-                                          file_name[:-4] + '_extended.zip'),
-                             'w',
-                             zipfile.ZIP_DEFLATED) as feedzip:
-            for _, _, files in os.walk(tmpdir):
-                for filename in files:
-                    if filename.endswith('.txt'):
-                        feedzip.write(filename)
-        os.chdir(lastdir)
+    :param feed_path: Full path to the GTFS to extend
+    :param effective_days: Number of days from today the feed should extend into future and past
+    :param transforms: List of other :gtfs_transforms.Transform:s to apply in the same pass
+    :returns: Tuple of (feed path, outcome, seconds taken)
+    """
+    start = time.time()
+    try:
+        outcome = extend_feed(feed_path, effective_days, transforms)
+    except Exception as ex:  # pylint: disable=broad-except
+        LOG.exception('Extending feed %s failed.', feed_path)
+        outcome = '%s: %s' % (FAILED, ex)
+    return feed_path, outcome, time.time() - start
+
+
+def _timed_extend_feed_args(args):
+    """Unpack arguments for :timed_extend_feed: sent to a pool process."""
+    return timed_extend_feed(*args)
+
+
+def extend_feed_paths(feed_paths, effective_days, workers=1, cache=None, transforms=()):
+    """Extend the given feeds, on a pool of processes if more than one worker is set.
+
+    Logs a table of the outcome and time taken for each feed.
+
+    :param feed_paths: List of full paths to the GTFS to extend
+    :param effective_days: Number of days from today into future and past to extend the feeds
+    :param workers: Number of feeds to extend at the same time
+    :param cache: :ExtensionCache: to skip feeds already up to date, and record the feeds
+                  extended, for incremental runs; if None, all feeds are extended
+    :param transforms: List of other :gtfs_transforms.Transform:s to apply in the same pass
+    :returns: List of (feed path, outcome, seconds taken) for each feed
+    """
+    start = time.time()
+    window = tuple(day.strftime(GTFS_DATE_FMT) for day in extension_window(effective_days))
+    results = []
+    tasks = []
+    for feed_path in feed_paths:
+        if (cache and os.path.isfile(feed_path) and
+                cache.is_up_to_date(feed_path, window, transforms)):
+            LOG.debug('Feed %s is up to date; not extending it again.', feed_path)
+            results.append((feed_path, SKIPPED, 0))
+        else:
+            tasks.append((feed_path, effective_days, transforms))
+
+    if workers > 1 and len(tasks) > 1:
+        pool = Pool(min(workers, len(tasks)))
+        try:
+            extended = pool.map(_timed_extend_feed_args, tasks, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
     else:
-        LOG.info('Feed %s does not need extension.', file_name)
+        extended = [timed_extend_feed(*task) for task in tasks]
+    if cache:
+        for feed_path, outcome, _ in extended:
+            cache.record(feed_path, outcome, window, transforms)
+    results.extend(extended)
 
-    # delete tmp directory when done
-    shutil.rmtree(tmpdir)
+    ptable = PrettyTable()
+    ptable.field_names = ['file', 'outcome', 'seconds']
+    ptable.align['file'] = 'l'
+    ptable.align['outcome'] = 'l'
+    for feed_path, outcome, seconds in sorted(results):
+        ptable.add_row([os.path.basename(feed_path), outcome, '%.2f' % seconds])
+    LOG.info('Results:\n%s', ptable.get_string())
+    LOG.info('Extended %s of %s feeds (%s up to date) in %.2f seconds.',
+             len([result for result in results if result[1] == EXTENDED]),
+             len(results),
+             len(results) - len(extended),
+             time.time() - start)
+    return results
 
 
-def extend_feeds(feed_directory, effective_days):
+def extend_feeds(feed_directory, effective_days, workers=1, incremental=False, transforms=()):
     """Extend effective dates for all fees found in given directory.
 
+    Extended feeds written by earlier runs are not extended again themselves.
+
     :param feed_directory: Full path to the directory containing the GTFS to extend
     :param effective_days: Number of days from today into future and past to extend the feeds
+    :param workers: Number of feeds to extend at the same time
+    :param incremental: If True, skip feeds unchanged since their extended feed was written
+                        that still covers the window asked for
+    :param transforms: List of other :gtfs_transforms.Transform:s to apply in the same pass
+    :returns: List of (feed path, outcome, seconds taken) for each feed
     """
     LOG.debug('Extending effective dates for feeds in %s...', feed_directory)
+    feed_paths = []
     for pdir, _, feed_files in os.walk(feed_directory):
         for feed_file in feed_files:
-            if feed_file.endswith('.zip'):
+            if feed_file.endswith('.zip') and not feed_file.endswith(EXTENDED_SUFFIX):
                 feed_path = os.path.join(pdir, feed_file)
                 if zipfile.is_zipfile(feed_path):
-                    extend_feed(feed_path, effective_days)
+                    feed_paths.append(feed_path)
                 else:
                     LOG.warn('File %s does not look like a valid zip file.', feed_file)
 
+    cache = ExtensionCache(feed_directory) if incremental else None
+    try:
+        results = extend_feed_paths(feed_paths, effective_days, workers, cache, transforms)
+    finally:
+        if cache:
+            cache.close()
     LOG.info('All done!')
-
-
-def extended_calendar(cal, effective_days):
-    """Extends the effective date range for the given calendar.
-
-    :param cal Dictionary of calendar.txt values
-    :param effective_days Number of days from today the effective dates should extend
-    :returns Extended calendar, or False if calendar does not require extension.
-    """
-    past_start = datetime.today() - timedelta(days=effective_days)
-    future_end = datetime.today() + timedelta(days=effective_days)
-    LOG.debug('Extending feed to be effective from %s to %s.', past_start, future_end)
-    modified = False
-    for entry in cal:
-        start_date_str = entry['start_date']
-        end_date_str = entry['end_date']
-        start_date = datetime.strptime(start_date_str, GTFS_DATE_FMT)
-        end_date = datetime.strptime(end_date_str, GTFS_DATE_FMT)
-        if start_date <= past_start:
-            LOG.debug('Start date %s already includes %s in period.', start_date, past_start)
-        else:
-            modified = True
-            entry['start_date'] = past_start.strftime(GTFS_DATE_FMT)
-        if end_date >= future_end:
-            LOG.debug('End date %s already includes %s in period.', end_date, future_end)
-        else:
-            modified = True
-            entry['end_date'] = future_end.strftime(GTFS_DATE_FMT)
-    return cal if modified else modified
+    return results
 
 
 def main():
@@ -135,6 +286,18 @@ def main():
     parser.add_argument('--feeds', '-f',
                         default=None,
                         help='Comma-separated list of feeds to get (optional; default: all)')
+    parser.add_argument('--workers', '-w', type=int, default=1,
+                        help='Number of feeds to extend in parallel processes (default: 1)')
+    parser.add_argument('--incremental', '-i', action='store_true',
+                        help='Skip feeds unchanged since they were last extended, if their ' +
+                        'extended feed still covers the --extend-days window')
+    parser.add_argument('--drop-expired-dates', action='store_true',
+                        help='Also drop calendar_dates.txt entries for dates already past')
+    parser.add_argument('--agencies',
+                        help='Also drop all but these comma-separated agency_ids, ' +
+                        'with their routes, trips and stop times')
+    parser.add_argument('--strip-unused-shapes', action='store_true',
+                        help='Also drop shapes no trip uses')
     parser.add_argument('--verbose', '-v',
                         action='count',
                         help='Increase log level verbosity (default log level: info)')
@@ -151,14 +314,36 @@ def main():
         LOG.error('--extend-days must be a positive integer. Exiting.')
         sys.exit(2)
 
+    if args.workers < 1:
+        LOG.error('--workers must be a positive integer. Exiting.')
+        sys.exit(2)
+
+    # other transforms to apply in the same pass as extending the calendar
+    transforms = []
+    if args.drop_expired_dates:
+        transforms.append(DropExpiredDates())
+    if args.agencies:
+        transforms.append(FilterAgencies(args.agencies.split(',')))
+    if args.strip_unused_shapes:
+        transforms.append(StripUnusedShapes())
+
     if args.feeds:
         feeds = args.feeds.split(',')
-        for feed in feeds:
-            LOG.debug('Going to extend feed %s...', feed)
-            extend_feed(os.path.join(args.download_directory, feed), args.extend_days)
+        LOG.debug('Going to extend feeds %s...', feeds)
+        cache = ExtensionCache(args.download_directory) if args.incremental else None
+        try:
+            extend_feed_paths([os.path.join(args.download_directory, feed) for feed in feeds],
+                              args.extend_days,
+                              args.workers,
+                              cache,
+                              transforms)
+        finally:
+            if cache:
+                cache.close()
         LOG.info('All done!')
     else:
-        extend_feeds(args.download_directory, args.extend_days)
+        extend_feeds(args.download_directory, args.extend_days, args.workers, args.incremental,
+                     transforms)
 
 if __name__ == '__main__':
     main()
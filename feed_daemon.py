@@ -0,0 +1,257 @@
+#!/usr/bin/env python
+"""Command line interface for fetching GTFS continually, checking each source on its own schedule.
+
+Unlike running :fetch_feeds: from cron, the feed source modules are imported, their statuses
+loaded, and connections and validator workers started only once; they are kept in memory
+between checks. Each source is checked every :FeedSource.poll_interval: seconds, or every
+:POLL_INTERVAL: seconds if it sets none, or later still if :update_cadence: says none of its
+feeds are due to be checked yet. Checks are moved earlier or later at random by up to :JITTER: of
+the wait, so that sources do not all come due at the same moment.
+"""
+import argparse
+from datetime import datetime, timedelta
+import heapq
+import itertools
+import logging
+from multiprocessing.pool import ThreadPool
+import random
+import signal
+import sys
+import threading
+import time
+
+from fetch_feeds import add_fetch_arguments, fetch_settings, make_source, FetchServices
+import feed_sources
+
+# default seconds between checks of each source
+POLL_INTERVAL = 6 * 60 * 60
+# greatest fraction of its poll interval by which each check is moved earlier or later at random
+JITTER = 0.1
+# seconds over which the first checks of the sources are spread out after starting
+STARTUP_SPREAD = 60
+# longest to wait at a time for the next check to come due, so a stop is noticed promptly
+MAX_WAIT = 60
+
+logging.basicConfig()
+LOG = logging.getLogger()
+LOG.setLevel(logging.INFO)
+
+
+def jittered(interval, jitter=JITTER):
+    """Move an interval earlier or later at random.
+
+    :param interval: Seconds
+    :param jitter: Greatest fraction of the interval to move it by
+    :returns: Seconds
+    """
+    return interval * (1 + random.uniform(-jitter, jitter))
+
+
+class PollScheduler(object):
+    """Priority queue of the times at which each source is next due to be checked.
+
+    Safe to share across threads. A source is taken off the queue while it is being checked,
+    and put back on once done, so the same source is never checked twice at once.
+    """
+    def __init__(self):
+        self._cond = threading.Condition()
+        # heap of (time due, sequence, source name); the sequence keeps ties in the order added
+        self._heap = []
+        self._sequence = itertools.count()
+        self._stopped = False
+
+    def schedule(self, name, due):
+        """Queue a source to be checked.
+
+        :param name: Name of the source
+        :param due: Time to check it at, in seconds since the epoch
+        """
+        with self._cond:
+            heapq.heappush(self._heap, (due, next(self._sequence), name))
+            self._cond.notify()
+
+    def next_due(self):
+        """Wait for the next source to come due, and take it off the queue.
+
+        :returns: Name of the source, or None once the scheduler is stopped
+        """
+        with self._cond:
+            while not self._stopped:
+                now = time.time()
+                if self._heap and self._heap[0][0] <= now:
+                    return heapq.heappop(self._heap)[2]
+                wait = self._heap[0][0] - now if self._heap else MAX_WAIT
+                self._cond.wait(min(wait, MAX_WAIT))
+            return None
+
+    def stop(self):
+        """Stop handing out sources, waking anything waiting for one."""
+        with self._cond:
+            self._stopped = True
+            self._cond.notify_all()
+
+    @property
+    def stopped(self):
+        """Whether the scheduler has been stopped."""
+        return self._stopped
+
+
+class FeedDaemon(object):
+    """Checks sources over and over, each on its own schedule, until stopped."""
+    def __init__(self, sources=None, poll_interval=POLL_INTERVAL, jitter=JITTER,
+                 source_intervals=None, **settings):
+        """Start the shared services, and instantiate each source once.
+
+        :param sources: List of :FeedSource: modules to fetch; if not set, will fetch all
+                        available.
+        :param poll_interval: Seconds between checks of sources that do not set their own
+                              :FeedSource.poll_interval:
+        :param jitter: Greatest fraction of its poll interval by which each check is moved
+                       earlier or later at random
+        :param source_intervals: Dictionary of { source name: seconds between checks }
+                                 overriding the sources' own intervals
+        :param **settings: Keyword arguments for :FetchServices:
+        """
+        self.poll_interval = poll_interval
+        self.jitter = jitter
+        self.workers = settings.get('workers', 1)
+        self.services = FetchServices(**settings)
+        self.scheduler = PollScheduler()
+        # { source name: :FeedSource: instance }, kept for the life of the daemon
+        self.sources = {}
+        for src in sources or feed_sources.__all__:
+            inst = make_source(src, **self.services.source_settings)
+            if inst:
+                name = inst.__class__.__name__
+                if source_intervals and name in source_intervals:
+                    inst.poll_interval = source_intervals[name]
+                self.sources[name] = inst
+        LOG.info('Going to check feeds from sources: %s', sorted(self.sources))
+
+    def interval(self, name):
+        """Get the seconds between checks of a source, before jitter."""
+        return self.sources[name].poll_interval or self.poll_interval
+
+    def wait(self, name):
+        """Get the seconds until a source's next check, before jitter.
+
+        Waits out the source's interval, or longer if none of its feeds are due to be checked
+        again until later, given how often they are updated.
+        """
+        due = self.sources[name].next_check_due()
+        until_due = (due - datetime.now()).total_seconds() if due else 0
+        return max(self.interval(name), until_due)
+
+    def check(self, name):
+        """Check a source once, then queue its next check.
+
+        Errors are logged, and do not stop the source from being checked again. Checks still
+        waiting for a worker when the daemon is stopped are dropped.
+
+        :param name: Name of the source
+        """
+        if self.scheduler.stopped:
+            return
+        source = self.sources[name]
+        start = time.time()
+        try:
+            source.start_check()
+            source.fetch()
+        except Exception:
+            LOG.exception('Checking %s failed.', name)
+        finally:
+            wait = jittered(self.wait(name), self.jitter)
+            LOG.info('Checked %s in %.1f seconds. Next check in %s.', name, time.time() - start,
+                     timedelta(seconds=int(wait)))
+            if not self.scheduler.stopped:
+                self.scheduler.schedule(name, time.time() + wait)
+
+    def run(self):
+        """Check sources as they come due, until :stop: is called.
+
+        The first checks are spread over :STARTUP_SPREAD: seconds. Once stopped, waits for
+        checks in progress, and the validation of the feeds they downloaded, to finish.
+        """
+        now = time.time()
+        for name in self.sources:
+            self.scheduler.schedule(name, now + random.uniform(0, STARTUP_SPREAD))
+        pool = ThreadPool(max(self.workers, 1))
+        try:
+            while True:
+                name = self.scheduler.next_due()
+                if name is None:
+                    break
+                pool.apply_async(self.check, (name,))
+        finally:
+            LOG.info('Stopping; waiting for checks in progress to finish...')
+            pool.close()
+            pool.join()
+            self.services.close()
+        LOG.info('All done!')
+
+    def stop(self):
+        """Stop checking sources; :run: returns once the checks in progress finish."""
+        self.scheduler.stop()
+
+
+def parse_intervals(values):
+    """Parse --interval options.
+
+    :param values: List of strings of NAME=MINUTES
+    :returns: Dictionary of { source name: seconds }
+    :raises ValueError: If an option is not of that form, or the minutes are not positive
+    """
+    intervals = {}
+    for value in values or []:
+        name, _, minutes = value.partition('=')
+        try:
+            seconds = float(minutes) * 60
+        except ValueError:
+            seconds = 0
+        if not name or seconds <= 0:
+            raise ValueError(value)
+        intervals[name] = seconds
+    return intervals
+
+
+def main():
+    """Main entry point for command line interface."""
+    parser = argparse.ArgumentParser(description='Fetch GTFS feeds and validate them ' +
+                                     'continually, checking each source on its own schedule.')
+    add_fetch_arguments(parser)
+    parser.add_argument('--poll-interval', type=float, default=POLL_INTERVAL / 60,
+                        help='Minutes between checks of each source that does not set its ' +
+                        'own interval (default: %(default)s)')
+    parser.add_argument('--interval', action='append', metavar='NAME=MINUTES',
+                        help='Minutes between checks of one source, overriding its own ' +
+                        'interval; may be given more than once')
+    parser.add_argument('--jitter', type=float, default=JITTER,
+                        help='Greatest fraction of its interval by which each check is moved ' +
+                        'earlier or later at random (default: %(default)s)')
+
+    args = parser.parse_args()
+    sources, settings = fetch_settings(args)
+    try:
+        source_intervals = parse_intervals(args.interval)
+    except ValueError as ex:
+        LOG.error('--interval must be NAME=MINUTES, with positive minutes, not %s. Exiting.', ex)
+        sys.exit(2)
+    if args.poll_interval <= 0 or not 0 <= args.jitter < 1:
+        LOG.error('--poll-interval must be positive, and --jitter at least 0 and less than 1. ' +
+                  'Exiting.')
+        sys.exit(2)
+
+    daemon = FeedDaemon(sources, args.poll_interval * 60, args.jitter, source_intervals,
+                        **settings)
+
+    def handle_signal(signum, _):
+        """Stop gracefully on SIGINT or SIGTERM."""
+        LOG.info('Received signal %s.', signum)
+        daemon.stop()
+
+    signal.signal(signal.SIGINT, handle_signal)
+    signal.signal(signal.SIGTERM, handle_signal)
+    daemon.run()
+
+if __name__ == '__main__':
+    main()
@@ -10,6 +10,6 @@ LOG = logging.getLogger(__name__)
 
 class AlbanyNy(FeedSource):
     """Fetch CDTA feed."""
-    def __init__(self):
-        super(AlbanyNy, self).__init__()
+    def __init__(self, **kwargs):
+        super(AlbanyNy, self).__init__(**kwargs)
         self.urls = {'albany_ny.zip': URL}
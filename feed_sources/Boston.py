@@ -10,6 +10,6 @@ LOG = logging.getLogger(__name__)
 
 class Boston(FeedSource):
     """Fetch MBTA feed."""
-    def __init__(self):
-        super(Boston, self).__init__()
+    def __init__(self, **kwargs):
+        super(Boston, self).__init__(**kwargs)
         self.urls = {'boston.zip': URL}
@@ -12,8 +12,8 @@ HARTFORD_URL = 'http://www.hartfordline.com/files/gtfs/gtfs.zip'
 
 class CTTransit(FeedSource):
     """Fetch PATH feed."""
-    def __init__(self):
-        super(CTTransit, self).__init__()
+    def __init__(self, **kwargs):
+        super(CTTransit, self).__init__(**kwargs)
         self.urls = {
             'ct_transit.zip': BASE_URL,
             'ct_shoreline_east.zip': SHORELINE_EAST_URL,
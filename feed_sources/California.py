@@ -9,8 +9,8 @@ LOG = logging.getLogger(__name__)
 
 class California(FeedSource):
     """Fetch various feeds in California."""
-    def __init__(self):
-        super(California, self).__init__()
+    def __init__(self, **kwargs):
+        super(California, self).__init__(**kwargs)
 
         self.urls = {
             'amador.zip': 'http://data.trilliumtransit.com/gtfs/amador-ca-us/amador-ca-us.zip',
@@ -74,10 +74,3 @@ class California(FeedSource):
             'yosemite.zip': 'http://data.trilliumtransit.com/gtfs/yosemite-ca-us/yosemite-ca-us.zip',
             'yuba.zip': 'http://data.trilliumtransit.com/gtfs/yubasutter-ca-us/yubasutter-ca-us.zip'
  }
-
-
-    def fetch(self):
-        for filename in self.urls:
-            url = self.urls.get(filename)
-            self.fetchone(filename, url)
-            self.write_status()
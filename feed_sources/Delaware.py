@@ -10,6 +10,6 @@ LOG = logging.getLogger(__name__)
 
 class Delaware(FeedSource):
     """Fetch DART feed."""
-    def __init__(self):
-        super(Delaware, self).__init__()
+    def __init__(self, **kwargs):
+        super(Delaware, self).__init__(**kwargs)
         self.urls = {'dart.zip': URL}
@@ -14,8 +14,8 @@ LOG = logging.getLogger(__name__)
 
 class Massdot(FeedSource):
     """Fetch MassDOT (MA, non-Boston) feeds."""
-    def __init__(self):
-        super(Massdot, self).__init__()
+    def __init__(self, **kwargs):
+        super(Massdot, self).__init__(**kwargs)
 
         berkshire_url = '%sbrta_google_transit.zip' % BASE_URL
         brockton_url = '%sbat_google_transit.zip' % BASE_URL
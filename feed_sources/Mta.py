@@ -10,8 +10,8 @@ LOG = logging.getLogger(__name__)
 
 class Mta(FeedSource):
     """Fetch MTA (NYC) feeds."""
-    def __init__(self):
-        super(Mta, self).__init__()
+    def __init__(self, **kwargs):
+        super(Mta, self).__init__(**kwargs)
 
         nyc_sub_url = '%snyct/subway/google_transit.zip' % BASE_URL
         bronx_bus_url = '%snyct/bus/google_transit_bronx.zip' % BASE_URL
@@ -34,9 +34,3 @@ class Mta(FeedSource):
             'metro_north.zip': metro_north_url,
             'busco.zip': busco_url
         }
-
-    def fetch(self):
-        """MTA downloads do not stream."""
-        for filename in self.urls:
-            self.fetchone(filename, self.urls.get(filename), do_stream=False)
-            self.write_status()
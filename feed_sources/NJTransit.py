@@ -16,8 +16,8 @@ URL = 'https://www.njtransit.com/'
 
 class NJTransit(FeedSource):
     """Create session to fetch NJ TRANSIT feed bus and rail feeds."""
-    def __init__(self):
-        super(NJTransit, self).__init__()
+    def __init__(self, **kwargs):
+        super(NJTransit, self).__init__(**kwargs)
         self.urls = {'nj_rail.zip': URL + 'rail_data.zip', 'nj_bus.zip': URL + 'bus_data.zip'}
 
 
@@ -26,10 +26,7 @@ class NJTransit(FeedSource):
 
         First logs on to create session before fetching and validating downloads.
         """
-        for filename in self.urls:
-            url = self.urls.get(filename)
-            self.fetchone(filename, url)
-            self.write_status()
+        self.fetch_urls()
 
 
 
@@ -2,10 +2,12 @@
 from datetime import datetime
 import logging
 
-from bs4 import BeautifulSoup
+from bs4 import SoupStrainer
 import requests
 
+from deadlines import DeadlineError
 from FeedSource import FeedSource, TIMECHECK_FMT
+from scraping import scrape
 
 URL = 'http://www.portauthority.org/GeneralTransitFeed/'
 FILE_NAME = 'paac.zip'
@@ -13,21 +15,31 @@ FILE_NAME = 'paac.zip'
 LOG = logging.getLogger(__name__)
 
 
+def find_download(soup):
+    """Find the name of the zip file linked to from the directory listing.
+
+    :param soup: Links in the directory listing
+    :returns: Download file name, or None if not found
+    """
+    file_name = None
+    for anchor in soup.findAll('a'):
+        if anchor.text.endswith('.zip'):
+            file_name = anchor.text
+    return file_name
+
+
 class Paac(FeedSource):
     """Fetch Pittsburgh feed."""
-    def __init__(self):
-        super(Paac, self).__init__()
-        # Go scrape the directory listing to find out what download file name is
-        response = requests.get(URL)
-        if response.ok:
-            soup = BeautifulSoup(response.text, 'html.parser')
-            # go find the zip file link
-            anchors = soup.findAll('a')
-            for anchor in anchors:
-                if anchor.text.endswith('.zip'):
-                    LOG.debug('Found PAAC download file named %s', anchor.text)
-                    self.urls = {FILE_NAME: URL + anchor.text}
-            if not self.urls:
-                LOG.error('Could not parse directory listing for PAAC.')
+    def resolve(self):
+        """Go scrape the directory listing to find out what download file name is."""
+        try:
+            # only the links are parsed
+            file_name = scrape(self, FILE_NAME, URL, find_download, SoupStrainer('a'))
+        except (requests.RequestException, DeadlineError) as ex:
+            LOG.error('Could not get directory listing for PAAC: %s', ex)
+            return
+        if file_name:
+            LOG.debug('Found PAAC download file named %s', file_name)
+            self.urls = {FILE_NAME: URL + file_name}
         else:
-            LOG.error('Could not get directory listing for PAAC.')
+            LOG.error('Could not parse directory listing for PAAC.')
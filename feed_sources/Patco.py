@@ -1,38 +1,56 @@
 """Fetch official PATCO feed."""
 
 import logging
+from bs4 import SoupStrainer
 import requests
-from bs4 import BeautifulSoup
 
+from deadlines import DeadlineError
 from FeedSource import FeedSource
+from scraping import scrape
 
 DEVPAGE_URL = 'http://www.ridepatco.org/developers/'
 FILE_NAME = 'PortAuthorityTransitCorporation.zip'
+# name the downloaded feed is saved as
+SAVE_FILE_NAME = 'patco.zip'
 
 LOG = logging.getLogger(__name__)
 
 
+def find_download(soup):
+    """Find the GTFS download link in the right column of the developer's page.
+
+    :param soup: Right column of the developer's page
+    :returns: Download URL, or None if not found
+    """
+    rt = soup.find(id='rightcolumn')
+    if not rt:
+        return None
+    for anchor in rt.findAll('a'):
+        href = anchor.attrs.get('href', '')
+        if href.endswith('.zip'):
+            return href
+
+    # if got this far, no GTFS download link found
+    return None
+
+
 class Patco(FeedSource):
     """Fetch official PATCO feed."""
-    def __init__(self):
-        super(Patco, self).__init__()
+    def resolve(self):
+        """Look up the download URL, which changes."""
         url = self.find_download_url()
         if url:
-            self.urls = {'patco.zip': url}
+            self.urls = {SAVE_FILE_NAME: url}
         else:
             LOG.error('Could not scrape PATCO GTFS download URL from developer page')
             self.urls = {}
 
     def find_download_url(self):
         """Helper to scrape developer's page for the download URL, which changes"""
-        devpage = requests.get(DEVPAGE_URL)
-        soup = BeautifulSoup(devpage.text, 'html.parser')
-        rt = soup.find(id='rightcolumn')
-        anchors = rt.findAll('a')
-        for anchor in anchors:
-            href = anchor.attrs['href']
-            if href.endswith('.zip'):
-                return href
-
-        # if got this far, no GTFS download link found
-        return None
+        try:
+            # only the right column of the page is parsed
+            return scrape(self, SAVE_FILE_NAME, DEVPAGE_URL, find_download,
+                          SoupStrainer(id='rightcolumn'))
+        except (requests.RequestException, DeadlineError) as ex:
+            LOG.error('Could not get PATCO developer page: %s', ex)
+            return None
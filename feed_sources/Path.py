@@ -3,10 +3,12 @@
 from datetime import datetime
 import logging
 
-from bs4 import BeautifulSoup
+from bs4 import SoupStrainer
 import requests
 
+from deadlines import DeadlineError
 from FeedSource import FeedSource, TIMECHECK_FMT
+from scraping import scrape
 
 URL = 'http://trilliumtransit.com/transit_feeds/path-nj-us/'
 FILE_NAME = 'path.zip'
@@ -15,51 +17,71 @@ LAST_UPDATED_FMT = '%Y-%m-%d %H:%M'
 LOG = logging.getLogger(__name__)
 
 
+def find_download(soup):
+    """Find the download in the directory listing.
+
+    :param soup: Rows of the directory listing table
+    :returns: Tuple of (download file name, last updated time string), or None if not found
+    """
+    anchors = soup.findAll('a')
+    if not anchors:
+        return None
+    # last link on the page shoud be our download
+    lastlink = anchors[-1]
+    # last updated time is in next column in table (last-modified header not set)
+    return lastlink.text, lastlink.findParent().findNextSibling().text.strip()
+
+
 class Path(FeedSource):
     """Fetch PATH feed."""
-    def __init__(self):
-        super(Path, self).__init__()
-        # The name of the download file changes on occasion.
-        # Go scrape the directory listing to find out what it is now, and update url if found.
+    def __init__(self, **kwargs):
+        super(Path, self).__init__(**kwargs)
         self.urls = {FILE_NAME: URL + 'path-nj-us.zip'}
-        response = requests.get(URL)
-        if response.ok:
-            soup = BeautifulSoup(response.text, 'html.parser')
-            anchors = soup.findAll('a')
-            if len(anchors):
-                # last link on the page shoud be our download
-                lastlink = anchors[len(anchors)-1]
-                # last updated time is in next column in table (last-modified header not set)
-                last_updated_str = lastlink.findParent().findNextSibling().text.strip()
-                self.last_updated = datetime.strptime(last_updated_str, LAST_UPDATED_FMT)
-                filename = lastlink.text
-                LOG.debug('Found PATH download file named %s, last updated: %s',
-                          filename,
-                          self.last_updated)
-                download_url = URL + filename
-                self.urls = {FILE_NAME: download_url}
-            else:
-                LOG.error('Could not parse directory listing for PATH.')
+        self.last_updated = None
+
+    def resolve(self):
+        """The name of the download file changes on occasion.
+
+        Go scrape the directory listing to find out what it is now, and update url if found.
+        """
+        try:
+            # only the rows of the listing table are parsed
+            found = scrape(self, FILE_NAME, URL, find_download, SoupStrainer('tr'))
+        except (requests.RequestException, DeadlineError) as ex:
+            LOG.error('Could not get directory listing for PATH: %s', ex)
+            return
+        if found:
+            filename, last_updated_str = found
+            self.last_updated = datetime.strptime(last_updated_str, LAST_UPDATED_FMT)
+            LOG.debug('Found PATH download file named %s, last updated: %s',
+                      filename,
+                      self.last_updated)
+            download_url = URL + filename
+            self.urls = {FILE_NAME: download_url}
         else:
-            LOG.error('Could not get directory listing for PATH.')
+            LOG.error('Could not parse directory listing for PATH.')
 
     def fetch(self):
         """No last-modified header set; check update time here."""
+        if not self.due_for_check():
+            return
+        self.resolve()
+        if not self.last_updated:
+            # without it, there is no telling if there is a new download, or when it was posted
+            self.set_error(FILE_NAME, 'No last updated time found for PATH')
+            return
         stat = self.status.get(FILE_NAME)
-        if stat:
+        if stat and stat.get('posted_date'):
             got_last = datetime.strptime(stat['posted_date'], TIMECHECK_FMT)
-            if self.last_updated:
-                if got_last >= self.last_updated:
-                    LOG.info('No new download found for PATH.')
-                    self.update_existing_status(FILE_NAME)
-                    return
-                else:
-                    LOG.info('New download found for PATH posted: %s; last retrieved: %s',
-                             self.last_updated,
-                             got_last)
+            if got_last >= self.last_updated:
+                LOG.info('No new download found for PATH.')
+                self.update_existing_status(FILE_NAME)
+                self.write_status()
+                return
             else:
-                LOG.error('No last updated time found for PATH.')
-                self.last_updated = datetime.utcnow()
+                LOG.info('New download found for PATH posted: %s; last retrieved: %s',
+                         self.last_updated,
+                         got_last)
         else:
             LOG.info('No previous download found for PATH.')
 
@@ -13,6 +13,6 @@ LOG = logging.getLogger(__name__)
 
 class Pocono(FeedSource):
     """Fetch Monroe County feed."""
-    def __init__(self):
-        super(Pocono, self).__init__()
+    def __init__(self, **kwargs):
+        super(Pocono, self).__init__(**kwargs)
         self.urls = {'pocono.zip': URL}
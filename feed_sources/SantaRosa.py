@@ -1,8 +1,7 @@
 """Fetch Santa Rosa, CA feed via FTP."""
 from datetime import datetime
 import logging
-import os
-import urllib
+import urllib2
 
 from FeedSource import FeedSource, TIMECHECK_FMT
 
@@ -12,8 +11,8 @@ LOG = logging.getLogger(__name__)
 
 class SantaRosa(FeedSource):
     """Fetch Santa Rosa, CA feed via FTP."""
-    def __init__(self):
-        super(SantaRosa, self).__init__()
+    def __init__(self, **kwargs):
+        super(SantaRosa, self).__init__(**kwargs)
 
         self.urls = {
             'santa_rosa.zip': 'ftp://ftp.ci.santa-rosa.ca.us/SantaRosaCityBus/google_transit.zip'
@@ -23,11 +22,21 @@ class SantaRosa(FeedSource):
         for filename in self.urls:
             try:
                 # download file into download directory
-                download_path = os.path.join(self.ddir, filename)
-                urllib.urlretrieve(self.urls.get(filename), download_path)
+                response = urllib2.urlopen(self.urls.get(filename))
+                try:
+                    digest = self.save_download(filename,
+                                                iter(lambda: response.read(self.chunk_size), ''))
+                finally:
+                    response.close()
+                if not digest:
+                    self.write_status()
+                    return False
                 # TODO: does FTP preserve post date?
                 posted_date = datetime.utcnow().strftime(TIMECHECK_FMT)
                 self.set_posted_date(filename, posted_date)
+                if self.is_unchanged(filename, digest):
+                    self.write_status()
+                    return True
                 if self.verify(filename):
                     LOG.info('GTFS verification succeeded.')
                     self.write_status()
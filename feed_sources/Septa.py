@@ -7,7 +7,10 @@ import zipfile
 
 import requests
 
+from deadlines import DeadlineError
+from digests import file_digest
 from FeedSource import FeedSource, TIMECHECK_FMT
+from instrumentation import SCRAPE
 
 URL = 'https://api.github.com/repos/septadev/GTFS/releases/latest'
 LAST_UPDATED_FMT = '%Y-%m-%dT%H:%M:%SZ'
@@ -26,15 +29,30 @@ LOG = logging.getLogger(__name__)
 
 class Septa(FeedSource):
     """Fetch SEPTA feeds."""
-    def __init__(self):
-        super(Septa, self).__init__()
+    def __init__(self, **kwargs):
+        super(Septa, self).__init__(**kwargs)
         self.urls = {DOWNLOAD_FILE_NAME: URL}
 
+    @property
+    def feed_names(self):
+        """The bus and rail feeds, which are extracted from the one download."""
+        return set([BUS_FILE, RAIL_FILE])
+
     def fetch(self):
         """Fetch SEPTA bus and rail feeds.
         """
+        if not self.due_for_check():
+            return
         # Check GitHub latest release page to see if there is a newer download available.
-        request = requests.get(URL)
+        try:
+            with self.timings.timed(DOWNLOAD_FILE_NAME, SCRAPE) as counter:
+                request = self.request('get', URL)
+                counter.bytes = len(request.content)
+        except (requests.RequestException, DeadlineError) as ex:
+            LOG.error('Could not check for a new SEPTA release: %s', ex)
+            return
+        # the release check and download are timed for both the feeds they hold
+        self.timings.share(DOWNLOAD_FILE_NAME, [BUS_FILE, RAIL_FILE])
         if request.ok:
             response = request.json()
             download_url = response['assets'][0]['browser_download_url']
@@ -57,7 +75,9 @@ class Septa(FeedSource):
             self.set_posted_date(RAIL_FILE, posted_date)
 
 
-            if self.download(DOWNLOAD_FILE_NAME, download_url, do_stream=False):
+            downloaded = self.download(DOWNLOAD_FILE_NAME, download_url)
+            self.timings.share(DOWNLOAD_FILE_NAME, [BUS_FILE, RAIL_FILE])
+            if downloaded:
                 # remove posted date status for parent zip
                 del self.status[DOWNLOAD_FILE_NAME]
                 septa_file = os.path.join(self.ddir, DOWNLOAD_FILE_NAME)
@@ -88,11 +108,11 @@ class Septa(FeedSource):
                     os.rename(bus_path, os.path.join(self.ddir, BUS_FILE))
 
                     rail_good = bus_good = False
-                    if self.verify(BUS_FILE):
+                    if self.verify_changed(BUS_FILE):
                         bus_good = True
                     else:
                         LOG.warn('SEPTA bus GTFS verification failed.')
-                    if self.verify(RAIL_FILE):
+                    if self.verify_changed(RAIL_FILE):
                         rail_good = True
                     else:
                         LOG.warn('SEPTA rail GTFS verification failed.')
@@ -113,3 +133,12 @@ class Septa(FeedSource):
 
         LOG.error('How did we get here? In SEPTA extract.')
         return False # should be unreachable
+
+    def verify_changed(self, file_name):
+        """Verify an extracted feed, unless it is identical to the one extracted last time.
+
+        The bus and rail feeds are not always both updated in a new release.
+        """
+        if self.is_unchanged(file_name, file_digest(os.path.join(self.ddir, file_name))):
+            return self.status[file_name].get('is_valid', False)
+        return self.verify(file_name)
@@ -1,6 +1,11 @@
-"""Import all non-system modules in this directory."""
+"""Registry of the non-system modules in this directory.
+
+Modules are listed in `__all__` without being imported; use :get_source: to import just
+the ones needed.
+"""
 import os
 import glob
+import importlib
 
 MODULES = glob.glob(os.path.dirname(__file__) + '/*.py')
 
@@ -8,3 +13,15 @@ __all__ = []
 for module in MODULES:
     if os.path.isfile(module) and not os.path.basename(module).startswith('_'):
         __all__.append(os.path.basename(module)[:-3])
+
+
+def get_source(name):
+    """Import a single feed source module, and get the class of the same name defined in it.
+
+    :param name: Name of the feed source module, as listed in `__all__`
+    :returns: The class, or None if there is no such feed source
+    """
+    if name not in __all__:
+        return None
+    module = importlib.import_module('.' + name, __name__)
+    return getattr(module, name, None)
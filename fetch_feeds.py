@@ -3,24 +3,140 @@
 import argparse
 import getpass
 import logging
+from multiprocessing.pool import ThreadPool
+import os
 import sys
 
 from prettytable import PrettyTable
 
-from FeedSource import FeedSource
+from deadlines import (parse_duration, TimeBudget, CHECK_PHASE, DOWNLOAD_PHASE, PHASE_BUDGETS,
+                       VALIDATE_PHASE)
+from FeedSource import FeedSource, CHUNK_SIZE, DOWNLOAD_DIRECTORY
+from http_client import HostLimiter, make_session, MAX_PER_HOST, RATE_LIMIT, RETRIES
+from instrumentation import stage_bytes, stage_seconds, DOWNLOAD, PARSE, SCRAPE, STAGES, VALIDATE
+from status_store import StatusStore, STATUS_DB
+from validation import (MemoryBudget, ValidationPipeline, ValidatorError, ValidatorService,
+                        FAST_VALIDATION, QUEUE_SIZE, VALIDATION_MEMORY, VALIDATION_MODE,
+                        VALIDATION_MODES, VALIDATORS)
 import feed_sources
-# import all the available feed sources
-# pylint: disable=I0011,wildcard-import
-from feed_sources import *
 
 logging.basicConfig()
 LOG = logging.getLogger()
 LOG.setLevel(logging.INFO)
 
-def fetch_all(sources=None):
+def make_source(src, **kwargs):
+    """Instantiate a single FeedSource in the feed_sources directory.
+
+    :param src: Name of the :FeedSource: module, or a :FeedSource: subclass
+                defined elsewhere, such as for benchmarking
+    :param **kwargs: Additional arguments to pass to the :FeedSource: constructor
+    :returns: The :FeedSource: instance, or None if the source could not be found
+    """
+    # expect a class with the same name as the module; only that module gets imported
+    klass = src if isinstance(src, type) else feed_sources.get_source(src)
+    if not klass:
+        LOG.error('Skipping feed %s, which could not be found.', src)
+    elif issubclass(klass, FeedSource):
+        return klass(**kwargs)
+    else:
+        LOG.warn('Skipping class %s, which does not subclass FeedSource.', klass.__name__)
+    return None
+
+def fetch_source(src, **kwargs):
+    """Fetch the feeds from a single FeedSource in the feed_sources directory.
+
+    :param src: Name of the :FeedSource: module to fetch, or a :FeedSource: subclass
+                defined elsewhere, such as for benchmarking
+    :param **kwargs: Additional arguments to pass to the :FeedSource: constructor
+    :returns: Status dictionary for the source's feeds, or None if source could not be fetched
+    """
+    LOG.debug('Going to start fetch for %s...', src)
+    inst = make_source(src, **kwargs)
+    if inst:
+        inst.fetch()
+        return inst.status
+    return None
+
+class FetchServices(object):
+    """The limiter, session, status store and validation services shared by all the sources
+    fetched in a process, so the per-host cap applies across sources, connections to each host
+    get reused, and validator workers stay warm.
+    """
+    def __init__(self, workers=1, max_per_host=MAX_PER_HOST, validators=VALIDATORS,
+                 validation_queue=QUEUE_SIZE, chunk_size=CHUNK_SIZE,
+                 validation_mode=VALIDATION_MODE, profile_dir=None, ddir=DOWNLOAD_DIRECTORY,
+                 validation_memory=VALIDATION_MEMORY, check_all=False, rate_limit=RATE_LIMIT,
+                 retries=RETRIES, deadline=None, phase_budgets=None):
+        """Start the services, and the clock on the run; see :fetch_all: for the parameters."""
+        if profile_dir and not os.path.isdir(profile_dir):
+            os.makedirs(profile_dir)
+        self.host_limiter = HostLimiter(max_per_host, rate_limit, retries)
+        self.memory_budget = MemoryBudget(validation_memory)
+        self.time_budget = TimeBudget(deadline, phase_budgets)
+        self.session = make_session(max(workers, max_per_host))
+        self.status_store = StatusStore(os.path.join(ddir, STATUS_DB))
+        # validator workers are new interpreters, so need not be started before any threads;
+        # they are started first so a failure to start them is reported before any downloads
+        self.validator_service = None
+        if validation_mode != FAST_VALIDATION:
+            try:
+                self.validator_service = ValidatorService(validators)
+            except ValidatorError as ex:
+                LOG.warn('Could not start validator workers; ' +
+                         'will run feedvalidator.py per feed: %s', ex)
+        self.pipeline = ValidationPipeline(validators, validation_queue).start()
+        # constructor arguments for each :FeedSource:
+        self.source_settings = dict(workers=workers, host_limiter=self.host_limiter,
+                                    session=self.session, validation_pipeline=self.pipeline,
+                                    validator_service=self.validator_service,
+                                    status_store=self.status_store, chunk_size=chunk_size,
+                                    validation_mode=validation_mode, profile_dir=profile_dir,
+                                    ddir=ddir, memory_budget=self.memory_budget,
+                                    check_all=check_all, time_budget=self.time_budget)
+
+    def close(self):
+        """Wait for all queued feeds to be validated, then stop the services."""
+        self.pipeline.join()
+        if self.validator_service:
+            self.validator_service.close()
+        self.session.close()
+        self.status_store.close()
+
+def fetch_all(sources=None, workers=1, max_per_host=MAX_PER_HOST, validators=VALIDATORS,
+              validation_queue=QUEUE_SIZE, chunk_size=CHUNK_SIZE,
+              validation_mode=VALIDATION_MODE, profile_dir=None, ddir=DOWNLOAD_DIRECTORY,
+              validation_memory=VALIDATION_MEMORY, check_all=False, rate_limit=RATE_LIMIT,
+              retries=RETRIES, deadline=None, phase_budgets=None):
     """Fetch from all FeedSources in the feed_sources directory.
 
+    Downloads are handed off to a validation pipeline, so validating one feed does not hold up
+    downloading the next. Feeds are validated on warm validator worker processes, unless
+    those cannot be started, in which case feedvalidator.py is run anew for each feed.
+
     :param sources: List of :FeedSource: modules to fetch; if not set, will fetch all available.
+    :param workers: Number of sources, and of URLs within each source, to fetch at the same time
+    :param max_per_host: Maximum number of requests to make to any one host at the same time
+    :param validators: Number of feeds to validate at the same time
+    :param validation_queue: Number of downloaded feeds that may wait for validation
+                             before downloads pause
+    :param chunk_size: Number of bytes to read and write at a time when downloading
+    :param validation_mode: How to validate feeds; one of :validation.VALIDATION_MODES:
+    :param profile_dir: Directory to write cProfile output for each stage of fetching each feed
+                        to; if None, the stages are only timed
+    :param ddir: Directory to download feeds, and keep their statuses, in
+    :param validation_memory: Bytes of memory that feedvalidator.py may use between all the
+                              feeds it validates at the same time, as estimated from their size
+    :param check_all: If True, check every feed for a new download, even those that
+                      :update_cadence: says are unlikely to have changed yet
+    :param rate_limit: Requests per second to make to any one host; 0 for no limit
+    :param retries: Number of times to retry a request that failed with a connection error,
+                    timeout or server error, backing off between attempts
+    :param deadline: Seconds the whole run may take; feeds still being worked on then are
+                     stopped and marked as timed out. If None, the run has no time limit.
+    :param phase_budgets: Dictionary of { phase: seconds } each phase of fetching a feed may
+                          take, for any of :deadlines.PHASES:; defaults to
+                          :deadlines.PHASE_BUDGETS:
+    :returns: Dictionary of { file name: status } for all the feeds fetched
     """
     statuses = {}  # collect the statuses for all the files
 
@@ -31,26 +147,53 @@ def fetch_all(sources=None):
 
     LOG.info('Going to fetch feeds from sources: %s', sources)
 
-    for src in sources:
-        LOG.debug('Going to start fetch for %s...', src)
+    # one set of services for the whole run, shared by all the sources
+    services = FetchServices(workers, max_per_host, validators, validation_queue, chunk_size,
+                             validation_mode, profile_dir, ddir, validation_memory, check_all,
+                             rate_limit, retries, deadline, phase_budgets)
+
+    def fetch(src):
+        """Fetch one source with the settings for this run.
+
+        Errors are logged, and do not stop the other sources from being fetched.
+        """
         try:
-            mod = getattr(feed_sources, src)
-            # expect a class with the same name as the module; instantiate and fetch its feeds
-            klass = getattr(mod, src)
-            if issubclass(klass, FeedSource):
-                inst = klass()
-                inst.fetch()
-                statuses.update(inst.status)
-            else:
-                LOG.warn('Skipping class %s, which does not subclass FeedSource.', klass.__name__)
-        except AttributeError:
-            LOG.error('Skipping feed %s, which could not be found.', src)
+            return fetch_source(src, **services.source_settings)
+        except Exception:  # pylint: disable=broad-except
+            LOG.exception('Fetching %s failed.', src)
+            return None
+
+    try:
+        if workers > 1 and len(sources) > 1:
+            pool = ThreadPool(min(workers, len(sources)))
+            try:
+                results = pool.map(fetch, sources)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            results = [fetch(src) for src in sources]
+    finally:
+        # statuses are complete once the last queued feeds have been validated
+        services.close()
+
+    for status in results:
+        if status:
+            statuses.update(status)
 
     # remove last check key set at top level of each status dictionary
     if statuses.has_key('last_check'):
         del statuses['last_check']
 
-    # display results
+    log_results(statuses)
+    LOG.info('All done!')
+    return statuses
+
+def log_results(statuses):
+    """Log a table of the status of each feed, and the time spent on each stage of fetching them.
+
+    :param statuses: Dictionary of { file name: status }
+    """
     ptable = PrettyTable()
 
     for file_name in statuses:
@@ -61,33 +204,135 @@ def fetch_all(sources=None):
         msg.append('x' if stat.has_key('is_valid') and stat['is_valid'] else '')
         msg.append('x' if stat.has_key('is_current') and stat['is_current'] else '')
         msg.append('x' if stat.has_key('newly_effective') and stat.get('newly_effective') else '')
+        msg.append(format_seconds(stage_seconds(stat, SCRAPE, PARSE)))
+        msg.append(format_seconds(stage_seconds(stat, DOWNLOAD)))
+        downloaded = stage_bytes(stat, DOWNLOAD)
+        msg.append('%.1f' % (downloaded / 1048576.0) if downloaded is not None else '')
+        msg.append(format_seconds(stage_seconds(stat, VALIDATE)))
         if stat.has_key('error'):
              msg.append(stat['error'])
         else:
              msg.append('')
         ptable.add_row(msg)
 
-    ptable.field_names = ['file', 'new?', 'valid?', 'current?', 'newly effective?', 'error']
+    ptable.field_names = ['file', 'new?', 'valid?', 'current?', 'newly effective?',
+                          'scrape s', 'download s', 'MB', 'validate s', 'error']
     LOG.info('Results:\n%s', ptable.get_string())
-    LOG.info('All done!')
+    stage_totals = ['%s %.2f' % (stage, sum(stage_seconds(stat, stage) or 0
+                                            for stat in statuses.values()))
+                    for stage in STAGES]
+    LOG.info('Seconds spent in each stage, over all feeds: %s', ', '.join(stage_totals))
 
-def main():
-    """Main entry point for command line interface."""
-    parser = argparse.ArgumentParser(description='Fetch GTFS feeds and validate them.')
+def format_seconds(seconds):
+    """Format a stage duration for the results table; blank if the stage was not timed."""
+    return '%.2f' % seconds if seconds is not None else ''
+
+def add_fetch_arguments(parser):
+    """Add the command line options for how to fetch feeds to a parser.
+
+    :param parser: :argparse.ArgumentParser: to add the options to
+    """
     parser.add_argument('--feeds', '-f',
                         help='Comma-separated list of feeds to get (optional; default: all)')
+    parser.add_argument('--workers', '-w', type=int, default=1,
+                        help='Number of sources and feeds to fetch in parallel (default: 1)')
+    parser.add_argument('--max-per-host', type=int, default=MAX_PER_HOST,
+                        help='Maximum concurrent requests to any one host (default: %s)' %
+                        MAX_PER_HOST)
+    parser.add_argument('--rate-limit', type=float, default=RATE_LIMIT,
+                        help='Maximum requests per second to any one host; 0 for no limit ' +
+                        '(default: %s)' % RATE_LIMIT)
+    parser.add_argument('--retries', type=int, default=RETRIES,
+                        help='Number of times to retry a request that failed with a ' +
+                        'connection error, timeout or server error (default: %s)' % RETRIES)
+    parser.add_argument('--validators', type=int, default=VALIDATORS,
+                        help='Number of feeds to validate in parallel (default: %s)' % VALIDATORS)
+    parser.add_argument('--validation-memory', type=int,
+                        default=VALIDATION_MEMORY // (1024 * 1024),
+                        help='Megabytes of memory feedvalidator.py may use between the feeds ' +
+                        'it validates in parallel, estimated from their size; larger feeds ' +
+                        'wait for memory to free up (default: %s)' %
+                        (VALIDATION_MEMORY // (1024 * 1024)))
+    parser.add_argument('--validation-queue', type=int, default=QUEUE_SIZE,
+                        help='Number of downloaded feeds that may wait for validation ' +
+                        'before downloads pause (default: %s)' % QUEUE_SIZE)
+    parser.add_argument('--validation', choices=VALIDATION_MODES, default=VALIDATION_MODE,
+                        help='How to validate feeds: tiered checks feed structure, and runs ' +
+                        'feedvalidator.py on feeds failing the check or not valid before; ' +
+                        'full always runs feedvalidator.py; fast only checks structure ' +
+                        '(default: %s)' % VALIDATION_MODE)
+    parser.add_argument('--chunk-size', type=int, default=CHUNK_SIZE,
+                        help='Bytes to read and write at a time when downloading (default: %s)' %
+                        CHUNK_SIZE)
+    parser.add_argument('--profile', metavar='DIRECTORY',
+                        help='Run each stage of fetching each feed under cProfile, and write ' +
+                        'the profiles to this directory (default: only time the stages)')
+    parser.add_argument('--deadline', type=parse_duration,
+                        help='Time the whole run may take, in seconds or with a unit, such as ' +
+                        '20m or 1h; feeds still being worked on then are marked as timed out. ' +
+                        'When fetching continually, the time each check of a source may take ' +
+                        '(default: no limit)')
+    for phase, description in ((CHECK_PHASE, 'checking a feed for a new version'),
+                               (DOWNLOAD_PHASE, 'downloading a feed'),
+                               (VALIDATE_PHASE, 'validating a feed')):
+        parser.add_argument('--%s-budget' % phase, type=parse_duration,
+                            default=PHASE_BUDGETS[phase],
+                            help='Time %s may take, in seconds or with a unit; 0 for no ' %
+                            description + 'limit (default: %ss)' % PHASE_BUDGETS[phase])
+    parser.add_argument('--check-all', action='store_true',
+                        help='Check every feed for a new download, including those not ' +
+                        'expected to have changed yet given how often they are updated')
     parser.add_argument('--verbose', '-v', action='count',
                         help='Set output log level to debug (default log level: info)')
 
-    args = parser.parse_args()
+def fetch_settings(args):
+    """Check the command line options added by :add_fetch_arguments:, and set the log level.
+
+    Exits if any option is out of range.
+
+    :param args: Parsed command line options
+    :returns: Tuple of (list of sources to fetch, or None for all; dictionary of keyword arguments
+              for :fetch_all: or :FetchServices:)
+    """
     if args.verbose:
         LOG.setLevel(logging.DEBUG)
 
-    if args.feeds:
-        sources = args.feeds.split(',')
-        fetch_all(sources=sources)
-    else:
-        fetch_all()
+    if min(args.workers, args.max_per_host, args.validators, args.validation_queue,
+           args.chunk_size, args.validation_memory) < 1:
+        LOG.error('--workers, --max-per-host, --validators, --validation-queue, ' +
+                  '--chunk-size and --validation-memory ' +
+                  'must be positive integers. Exiting.')
+        sys.exit(2)
+    if args.rate_limit < 0 or args.retries < 0:
+        LOG.error('--rate-limit and --retries must not be negative. Exiting.')
+        sys.exit(2)
+    if args.deadline is not None and args.deadline <= 0:
+        LOG.error('--deadline must be a positive duration. Exiting.')
+        sys.exit(2)
+
+    settings = dict(workers=args.workers,
+                    max_per_host=args.max_per_host,
+                    validators=args.validators,
+                    validation_queue=args.validation_queue,
+                    chunk_size=args.chunk_size,
+                    validation_mode=args.validation,
+                    profile_dir=args.profile,
+                    validation_memory=args.validation_memory * 1024 * 1024,
+                    check_all=args.check_all,
+                    rate_limit=args.rate_limit,
+                    retries=args.retries,
+                    deadline=args.deadline,
+                    phase_budgets=dict((phase, getattr(args, phase + '_budget') or None)
+                                       for phase in (CHECK_PHASE, DOWNLOAD_PHASE,
+                                                     VALIDATE_PHASE)))
+    return (args.feeds.split(',') if args.feeds else None), settings
+
+def main():
+    """Main entry point for command line interface."""
+    parser = argparse.ArgumentParser(description='Fetch GTFS feeds and validate them.')
+    add_fetch_arguments(parser)
+    sources, settings = fetch_settings(parser.parse_args())
+    fetch_all(sources=sources, **settings)
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,59 @@
+"""Read GTFS tables straight out of a feed zip, a row at a time, without extracting it."""
+import csv
+
+UTF8_BOM = '\xef\xbb\xbf'
+
+
+def read_gtfs_header(feedzip, table_name):
+    """Read the column names of a GTFS table from an open zip.
+
+    :param feedzip: Open :zipfile.ZipFile: of the feed
+    :param table_name: Name of the table file in the zip, such as calendar.txt
+    :returns: List of column names, or None if the table is not in the zip or is empty
+    """
+    if table_name not in feedzip.namelist():
+        return None
+    with feedzip.open(table_name) as table_file:
+        return read_header(csv.reader(table_file, skipinitialspace=True))
+
+
+def read_gtfs_columns(feedzip, table_name, columns):
+    """Read the given columns of a GTFS table from an open zip, one row at a time.
+
+    Only the values asked for are kept from each row, so large tables such as stop_times.txt
+    can be read through without building a dictionary for every row.
+
+    :param feedzip: Open :zipfile.ZipFile: of the feed
+    :param table_name: Name of the table file in the zip, such as calendar.txt
+    :param columns: Sequence of the column names to read
+    :returns: Generator of tuples of the values of :columns: in each row, with '' for columns
+              the table or row does not have; empty if the table is not in the zip
+    """
+    if table_name not in feedzip.namelist():
+        return
+    with feedzip.open(table_name) as table_file:
+        reader = csv.reader(table_file, skipinitialspace=True)
+        header = read_header(reader)
+        if not header:
+            return
+        indexes = [header.index(column) if column in header else len(header)
+                   for column in columns]
+        for row in reader:
+            if not row:
+                continue
+            yield tuple(row[idx].strip() if idx < len(row) else '' for idx in indexes)
+
+
+def read_header(reader):
+    """Read the header row of a GTFS table.
+
+    :param reader: :csv.reader: over the table, positioned at its start
+    :returns: List of column names, stripped of the byte order mark and stray whitespace
+              some agencies leave in them; None if the table is empty
+    """
+    header = next(reader, None)
+    if not header:
+        return None
+    if header[0].startswith(UTF8_BOM):
+        header[0] = header[0][len(UTF8_BOM):]
+    return [column.strip() for column in header]
@@ -0,0 +1,448 @@
+"""Rewrite GTFS feeds in a single streaming pass, applying a pipeline of row-level transforms.
+
+Each :Transform: names the tables it works on, and is handed their rows one at a time as the
+feed is copied. Rows it yields are written to the new feed; rows it drops are left out.
+Tables no transform works on are copied over still compressed, so the cost of a pass is close
+to that of copying the zip, however many transforms are in the pipeline.
+
+Tables are passed through in an order where the tables others refer to come first (agencies,
+then routes, then trips), so a transform can collect the IDs it keeps from one table, and use
+them to filter the tables that come after it.
+"""
+import csv
+from datetime import datetime, timedelta
+import logging
+import os
+from StringIO import StringIO
+import struct
+import time
+import zipfile
+import zlib
+
+from effective_dates import parse_gtfs_date
+from gtfs_tables import read_header
+
+LOG = logging.getLogger(__name__)
+
+GTFS_DATE_FMT = '%Y%m%d'
+# suffix for a transformed feed while it is being written
+PARTIAL_SUFFIX = '.part'
+# bytes to copy or compress at a time when writing the new feed
+CHUNK_SIZE = 1024 * 1024
+# tables are passed through transforms in this order, before any other tables
+TABLE_ORDER = ('agency.txt', 'routes.txt', 'trips.txt')
+# positions of the file name and extra field lengths in a zip member's local header
+FH_FILENAME_LENGTH = 10
+FH_EXTRA_FIELD_LENGTH = 11
+# zip member flag set when its sizes and CRC follow its data, instead of being in its header
+DATA_DESCRIPTOR_FLAG = 0x08
+DATA_DESCRIPTOR_SIGNATURE = 0x08074b50
+# factor a written zip member may grow by over its expected size; ZIP64 sizes are used for it
+# if it could then pass the ZIP64 limit
+ZIP64_MARGIN = 1.05
+
+
+class Transform(object):
+    """Base class for a row-level transform of GTFS tables.
+
+    Subclass this class and:
+        - set :tables: to the names of the tables the transform works on
+        - override :start: to reset any state and check the transform applies to a feed
+        - override :rows: to yield the rows to keep for a table, changed as needed,
+          and set :changed: if any row was changed or dropped
+    """
+    tables = ()
+
+    def __init__(self):
+        self.changed = False
+
+    def start(self, feedzip):
+        """Get ready to transform a feed, before its tables are passed through.
+
+        :param feedzip: Open :zipfile.ZipFile: of the feed; small tables may be read from it
+        :returns: True if the transform may change the feed; if no transform in a pipeline
+                  might, the feed is not rewritten
+        """
+        self.changed = False
+        return True
+
+    def describe(self):
+        """Describe the transform and its settings, to tell feeds transformed the same way."""
+        return self.__class__.__name__
+
+    def rows(self, table_name, rows):
+        """Transform the rows of one of :tables:.
+
+        :param table_name: Name of the table, such as calendar.txt
+        :param rows: Iterable of dictionaries of { column name: value } for each row
+        :returns: Iterable of the rows to write
+        """
+        return rows
+
+
+def extension_window(effective_days):
+    """Get the dates feeds should be effective between, extended from today.
+
+    :param effective_days: Number of days from today into future and past to extend the feeds
+    :returns: Tuple of (start, end) :datetime:s
+    """
+    today = datetime.today()
+    return today - timedelta(days=effective_days), today + timedelta(days=effective_days)
+
+
+def extend_calendar_entry(entry, past_start, future_end):
+    """Extends the date range of a calendar.txt entry to cover the given window.
+
+    :param entry: Dictionary of calendar.txt values; changed in place
+    :param past_start: Date the entry should start on or before
+    :param future_end: Date the entry should end on or after
+    :returns: True if the entry was changed
+    """
+    modified = False
+    start_date = datetime.strptime(entry['start_date'], GTFS_DATE_FMT)
+    end_date = datetime.strptime(entry['end_date'], GTFS_DATE_FMT)
+    if start_date <= past_start:
+        LOG.debug('Start date %s already includes %s in period.', start_date, past_start)
+    else:
+        modified = True
+        entry['start_date'] = past_start.strftime(GTFS_DATE_FMT)
+    if end_date >= future_end:
+        LOG.debug('End date %s already includes %s in period.', end_date, future_end)
+    else:
+        modified = True
+        entry['end_date'] = future_end.strftime(GTFS_DATE_FMT)
+    return modified
+
+
+def extended_calendar(cal, effective_days):
+    """Extends the effective date range for the given calendar.
+
+    :param cal Dictionary of calendar.txt values
+    :param effective_days Number of days from today the effective dates should extend
+    :returns Extended calendar, or False if calendar does not require extension.
+    """
+    past_start, future_end = extension_window(effective_days)
+    LOG.debug('Extending feed to be effective from %s to %s.', past_start, future_end)
+    modified = False
+    for entry in cal:
+        if extend_calendar_entry(entry, past_start, future_end):
+            modified = True
+    return cal if modified else modified
+
+
+class ExtendCalendar(Transform):
+    """Extend the date range of each calendar.txt entry to :effective_days: around today."""
+    tables = ('calendar.txt',)
+
+    def __init__(self, effective_days):
+        super(ExtendCalendar, self).__init__()
+        self.effective_days = effective_days
+        self.window = None
+
+    def describe(self):
+        return 'ExtendCalendar(%s)' % self.effective_days
+
+    def start(self, feedzip):
+        super(ExtendCalendar, self).start(feedzip)
+        if 'calendar.txt' not in feedzip.namelist():
+            return False
+        self.window = extension_window(self.effective_days)
+        # calendar is small; check now if it needs extending, to skip rewriting feeds that do not
+        with feedzip.open('calendar.txt') as cal_file:
+            cal = [entry for entry in csv.DictReader(cal_file, skipinitialspace=True)]
+        return extended_calendar(cal, self.effective_days) is not False
+
+    def rows(self, table_name, rows):
+        for entry in rows:
+            if extend_calendar_entry(entry, *self.window):
+                self.changed = True
+            yield entry
+
+
+class DropExpiredDates(Transform):
+    """Drop calendar_dates.txt entries for dates before :as_of: (default: today)."""
+    tables = ('calendar_dates.txt',)
+
+    def __init__(self, as_of=None):
+        super(DropExpiredDates, self).__init__()
+        self.as_of = as_of
+
+    def start(self, feedzip):
+        super(DropExpiredDates, self).start(feedzip)
+        return 'calendar_dates.txt' in feedzip.namelist()
+
+    def rows(self, table_name, rows):
+        as_of = self.as_of or datetime.today().replace(hour=0, minute=0, second=0, microsecond=0)
+        for entry in rows:
+            date = parse_gtfs_date(entry.get('date'))
+            if date and date < as_of:
+                self.changed = True
+                continue
+            yield entry
+
+
+class FilterAgencies(Transform):
+    """Keep only the given agencies, with their routes, and the trips and stop times on them."""
+    tables = ('agency.txt', 'routes.txt', 'trips.txt', 'stop_times.txt', 'frequencies.txt')
+
+    def __init__(self, agency_ids):
+        super(FilterAgencies, self).__init__()
+        self.agency_ids = set(agency_ids)
+        self._only_agency = None
+        self._route_ids = set()
+        self._trip_ids = set()
+
+    def describe(self):
+        return 'FilterAgencies(%s)' % ','.join(sorted(self.agency_ids))
+
+    def start(self, feedzip):
+        super(FilterAgencies, self).start(feedzip)
+        self._only_agency = None
+        self._route_ids = set()
+        self._trip_ids = set()
+        return True
+
+    def _keep(self, keep):
+        """Note if a row is dropped."""
+        if not keep:
+            self.changed = True
+        return keep
+
+    def rows(self, table_name, rows):
+        if table_name == 'agency.txt':
+            agencies = list(rows)
+            if len(agencies) == 1:
+                # routes in single agency feeds may leave out agency_id
+                self._only_agency = agencies[0].get('agency_id', '')
+            return (entry for entry in agencies
+                    if self._keep(entry.get('agency_id', '') in self.agency_ids))
+        elif table_name == 'routes.txt':
+            return (entry for entry in rows if self._keep_route(entry))
+        elif table_name == 'trips.txt':
+            return (entry for entry in rows if self._keep_trip(entry))
+        return (entry for entry in rows
+                if self._keep(entry.get('trip_id') in self._trip_ids))
+
+    def _keep_route(self, entry):
+        """Keep a route if its agency is kept, noting its ID."""
+        agency_id = entry.get('agency_id') or self._only_agency
+        if self._keep(agency_id in self.agency_ids):
+            self._route_ids.add(entry.get('route_id'))
+            return True
+        return False
+
+    def _keep_trip(self, entry):
+        """Keep a trip if its route is kept, noting its ID."""
+        if self._keep(entry.get('route_id') in self._route_ids):
+            self._trip_ids.add(entry.get('trip_id'))
+            return True
+        return False
+
+
+class StripUnusedShapes(Transform):
+    """Drop the points of shapes no trip uses."""
+    tables = ('trips.txt', 'shapes.txt')
+
+    def __init__(self):
+        super(StripUnusedShapes, self).__init__()
+        self._shape_ids = set()
+
+    def start(self, feedzip):
+        super(StripUnusedShapes, self).start(feedzip)
+        self._shape_ids = set()
+        return 'shapes.txt' in feedzip.namelist()
+
+    def rows(self, table_name, rows):
+        if table_name == 'trips.txt':
+            return self._note_shapes(rows)
+        return self._used_shapes(rows)
+
+    def _note_shapes(self, trips):
+        """Pass trips through, noting the shapes they use."""
+        for entry in trips:
+            self._shape_ids.add(entry.get('shape_id'))
+            yield entry
+
+    def _used_shapes(self, shapes):
+        """Keep the points of the shapes trips use."""
+        for entry in shapes:
+            if entry.get('shape_id') in self._shape_ids:
+                yield entry
+            else:
+                self.changed = True
+
+
+def table_order(info):
+    """Sort key to pass tables through the pipeline in :TABLE_ORDER:, then zip order."""
+    if info.filename in TABLE_ORDER:
+        return TABLE_ORDER.index(info.filename)
+    return len(TABLE_ORDER)
+
+
+def transform_feed(feed_path, output_path, transforms):
+    """Write a copy of a feed with the transforms applied, in one pass over the feed.
+
+    The new feed is written to a temporary file next to it, then moved into place.
+    Only the top-level .txt tables of the feed are copied.
+
+    :param feed_path: Full path to the GTFS to transform
+    :param output_path: Full path to write the transformed GTFS to
+    :param transforms: List of :Transform:s to apply, in order, to the rows of each table
+    :returns: True if the transforms changed the feed, and the new feed was written
+    """
+    with zipfile.ZipFile(feed_path, 'r') as feedzip:
+        active = [transform for transform in transforms if transform.start(feedzip)]
+        if not active:
+            return False
+        table_transforms = {}
+        for transform in active:
+            for table_name in transform.tables:
+                table_transforms.setdefault(table_name, []).append(transform)
+
+        partial_path = output_path + PARTIAL_SUFFIX
+        try:
+            with open(feed_path, 'rb') as feed_file, \
+                    zipfile.ZipFile(partial_path, 'w', zipfile.ZIP_DEFLATED,
+                                    allowZip64=True) as new_zip:
+                for info in sorted(feedzip.infolist(), key=table_order):
+                    if not info.filename.endswith('.txt') or '/' in info.filename:
+                        continue
+                    if info.filename in table_transforms:
+                        transform_table(feedzip, info, new_zip, table_transforms[info.filename])
+                    else:
+                        copy_zip_member(feed_file, info, new_zip)
+        except:
+            if os.path.isfile(partial_path):
+                os.remove(partial_path)
+            raise
+
+    if not any(transform.changed for transform in active):
+        os.remove(partial_path)
+        return False
+    os.rename(partial_path, output_path)
+    return True
+
+
+def transform_table(feedzip, info, new_zip, transforms):
+    """Pass the rows of a table through transforms, writing the rows kept to the new zip.
+
+    :param feedzip: Open :zipfile.ZipFile: of the feed
+    :param info: :zipfile.ZipInfo: of the table in the feed
+    :param new_zip: :zipfile.ZipFile: open for writing to write the table to
+    :param transforms: List of :Transform:s to pass the table's rows through
+    """
+    with feedzip.open(info.filename) as table_file:
+        reader = csv.reader(table_file, skipinitialspace=True)
+        header = read_header(reader) or []
+        rows = (dict(zip(header, row)) for row in reader if row)
+        for transform in transforms:
+            rows = transform.rows(info.filename, rows)
+        write_zip_member(new_zip, info.filename, csv_chunks(header, rows), info.file_size)
+
+
+def csv_chunks(header, rows):
+    """Write rows as CSV, in chunks of around :CHUNK_SIZE: bytes.
+
+    :param header: List of column names
+    :param rows: Iterable of dictionaries of { column name: value }
+    :returns: Generator of strings of CSV
+    """
+    buf = StringIO()
+    writer = csv.DictWriter(buf, fieldnames=header, extrasaction='ignore')
+    writer.writeheader()
+    for row in rows:
+        writer.writerow(row)
+        if buf.tell() >= CHUNK_SIZE:
+            yield buf.getvalue()
+            buf.seek(0)
+            buf.truncate()
+    yield buf.getvalue()
+
+
+def write_zip_member(new_zip, name, chunks, size_hint=0):
+    """Compress data into a new zip member as it is produced, without holding all of it.
+
+    The member's CRC and sizes are written after its data, once they are known. As the local
+    header is written first, whether the member needs ZIP64 sizes is decided up front from
+    :size_hint:, with the same :ZIP64_MARGIN: as :zipfile.ZipFile.write: allows.
+
+    :param new_zip: :zipfile.ZipFile: open for writing
+    :param name: Name of the new member
+    :param chunks: Iterable of strings of the member's data
+    :param size_hint: Expected bytes of data, such as the size of the table it is made from
+    :raises zipfile.LargeZipFile: if the data outgrows the ZIP64 limit when not expected to
+    """
+    info = zipfile.ZipInfo(name, time.localtime(time.time())[:6])
+    info.compress_type = zipfile.ZIP_DEFLATED
+    info.external_attr = 0o600 << 16
+    info.flag_bits |= DATA_DESCRIPTOR_FLAG
+    zip64 = size_hint * ZIP64_MARGIN > zipfile.ZIP64_LIMIT
+    if zip64:
+        # the local header then carries a ZIP64 extra field, and the data descriptor 8-byte sizes
+        info.extract_version = info.create_version = max(45, info.extract_version)
+    info.header_offset = new_zip.fp.tell()
+    new_zip.fp.write(info.FileHeader(zip64))
+
+    compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -15)
+    crc = file_size = compress_size = 0
+    for chunk in chunks:
+        crc = zlib.crc32(chunk, crc) & 0xffffffff
+        file_size += len(chunk)
+        data = compressor.compress(chunk)
+        compress_size += len(data)
+        new_zip.fp.write(data)
+    data = compressor.flush()
+    compress_size += len(data)
+    new_zip.fp.write(data)
+
+    info.CRC = crc
+    info.file_size = file_size
+    info.compress_size = compress_size
+    if not zip64 and max(file_size, compress_size) > zipfile.ZIP64_LIMIT:
+        raise zipfile.LargeZipFile('%s grew past the ZIP64 limit while being written' % name)
+    new_zip.fp.write(struct.pack('<LLQQ' if zip64 else '<LLLL', DATA_DESCRIPTOR_SIGNATURE,
+                                 crc, compress_size, file_size))
+    _add_member(new_zip, info)
+
+
+def copy_zip_member(feed_file, info, new_zip):
+    """Copy a zip member's compressed bytes into another zip, without decompressing them.
+
+    :param feed_file: Zip file the member is in, open for reading in binary mode
+    :param info: :zipfile.ZipInfo: of the member to copy
+    :param new_zip: :zipfile.ZipFile: open for writing to copy the member into
+    """
+    # skip past the member's local header, to where its compressed data starts
+    feed_file.seek(info.header_offset)
+    header = struct.unpack(zipfile.structFileHeader, feed_file.read(zipfile.sizeFileHeader))
+    if header[0] != zipfile.stringFileHeader:
+        raise zipfile.BadZipfile('Bad local header for %s' % info.filename)
+    feed_file.seek(header[FH_FILENAME_LENGTH] + header[FH_EXTRA_FIELD_LENGTH], os.SEEK_CUR)
+
+    copied = zipfile.ZipInfo(info.filename, info.date_time)
+    copied.compress_type = info.compress_type
+    copied.CRC = info.CRC
+    copied.compress_size = info.compress_size
+    copied.file_size = info.file_size
+    copied.external_attr = info.external_attr
+    # sizes are known up front, so no data descriptor follows the copied data
+    copied.flag_bits = info.flag_bits & ~DATA_DESCRIPTOR_FLAG
+    copied.header_offset = new_zip.fp.tell()
+    new_zip.fp.write(copied.FileHeader())
+
+    remaining = info.compress_size
+    while remaining:
+        chunk = feed_file.read(min(CHUNK_SIZE, remaining))
+        if not chunk:
+            raise zipfile.BadZipfile('Truncated data for %s' % info.filename)
+        new_zip.fp.write(chunk)
+        remaining -= len(chunk)
+    _add_member(new_zip, copied)
+
+
+def _add_member(new_zip, info):
+    """List a member written straight to a zip's file in its central directory."""
+    new_zip.filelist.append(info)
+    new_zip.NameToInfo[info.filename] = info
+    # zipfile only writes the central directory on close if it wrote a member itself
+    new_zip._didModify = True  # pylint: disable=protected-access
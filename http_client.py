@@ -0,0 +1,436 @@
+"""Helpers for the HTTP requests feed sources make to agency servers."""
+from contextlib import contextmanager
+from datetime import datetime
+from email.utils import parsedate
+import logging
+import random
+import threading
+import time
+import urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from deadlines import DeadlineError
+
+LOG = logging.getLogger(__name__)
+
+# default number of requests allowed in flight to any one host at a time
+MAX_PER_HOST = 2
+# number of hosts to keep a pool of open connections to
+HOST_POOLS = 64
+# seconds to wait for a connection to a host, and for each read from it
+CONNECT_TIMEOUT = 10
+READ_TIMEOUT = 60
+# default number of requests per second allowed to any one host; 0 for no limit
+RATE_LIMIT = 2.0
+# number of requests that may be made to a host at once before the rate limit applies
+RATE_BURST = 4
+# default number of times to retry a request that failed with a connection error or timeout,
+# or one of :RETRY_STATUSES:
+RETRIES = 3
+# response status codes for server trouble that may clear up if the request is retried
+RETRY_STATUSES = frozenset([429, 500, 502, 503, 504])
+# seconds to wait before the first retry of a request; doubled for each retry after that
+BACKOFF = 1.0
+# most seconds to wait before retrying a request, including for a Retry-After header
+MAX_BACKOFF = 60.0
+# response status codes meaning the host as a whole is in trouble, not just one of its URLs
+HOST_DOWN_STATUSES = frozenset([502, 503, 504])
+# number of requests to a host in a row that fail, once out of retries, after which it is
+# taken to be down
+FAILURE_THRESHOLD = 5
+# seconds to fail requests to a host that is down, before trying it again
+BREAKER_RESET = 300
+
+
+class HostDownError(requests.ConnectionError):
+    """Raised instead of making a request to a host that has failed too many requests in a row."""
+    pass
+
+
+def make_session(pool_size=MAX_PER_HOST):
+    """Create a session to share across all the feed sources in a run.
+
+    The session keeps connections alive between requests, so each host's connection setup
+    (and TLS handshake) is paid once per run instead of once per request.
+
+    :param pool_size: Number of connections to keep open to each host;
+                      should be at least the number of requests made to a host at once
+    :returns: :requests.Session: with a connection pool sized for the run
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=HOST_POOLS, pool_maxsize=pool_size)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def parse_http_date(value):
+    """Parse a date from an HTTP header, such as Last-Modified.
+
+    :param value: Header value, formatted like 'Wed, 21 Oct 2015 07:28:00 GMT'
+    :returns: Parsed :datetime:, or None if value is missing or could not be parsed
+    """
+    if not value:
+        return None
+    parsed = parsedate(value)
+    if not parsed:
+        return None
+    return datetime(*parsed[:6])
+
+
+def iter_body(response, chunk_size):
+    """Iterate over the body of a streamed response, checking that none of it went missing.
+
+    urllib3 does not complain if the connection closes before the whole body was sent,
+    so the bytes received are checked against Content-Length (when it is not compressed).
+
+    :param response: Streamed :requests.Response:
+    :param chunk_size: Number of bytes to read at a time
+    :raises IOError: if the body ended before Content-Length bytes were received
+    """
+    expected = response.headers.get('content-length', '')
+    if response.headers.get('content-encoding', 'identity').lower() != 'identity':
+        expected = ''
+    received = 0
+    for chunk in response.iter_content(chunk_size=chunk_size):
+        received += len(chunk)
+        yield chunk
+    if expected.isdigit() and received < int(expected):
+        raise IOError('Connection closed after %s of %s bytes' % (received, expected))
+
+
+def range_validator(headers):
+    """Get the validator to send in If-Range when resuming a download of this response's body.
+
+    Only strong ETags may be used with If-Range, so Last-Modified is used when the ETag is weak.
+
+    :param headers: Headers of the response being downloaded
+    :returns: ETag or Last-Modified value, or None if the server will not resume the download
+    """
+    if headers.get('accept-ranges', '').lower() == 'none':
+        return None
+    etag = headers.get('etag')
+    if etag and not etag.startswith('W/'):
+        return etag
+    return headers.get('last-modified')
+
+
+def range_start(headers):
+    """Get the offset of the first byte of a partial (206) response.
+
+    :param headers: Response headers, with Content-Range like 'bytes 200-999/1000'
+    :returns: Offset of the first byte sent, or None if Content-Range is missing or malformed
+    """
+    content_range = headers.get('content-range', '')
+    unit, _, byte_range = content_range.partition(' ')
+    if unit.lower() != 'bytes':
+        return None
+    try:
+        return int(byte_range.split('-')[0])
+    except ValueError:
+        return None
+
+
+def url_host(url):
+    """Get the host name (lower-cased, without port) from a URL."""
+    return (urlparse.urlparse(url).hostname or '').lower()
+
+
+def backoff(attempt, response=None):
+    """Get how long to wait before retrying a request.
+
+    Waits exponentially longer after each attempt, moved earlier at random by up to half,
+    so requests that failed together are not all retried together. A Retry-After header
+    giving a number of seconds is honored instead.
+
+    :param attempt: Number of attempts made so far, less one
+    :param response: Response to the failed attempt, if there was one
+    :returns: Seconds to wait, at most :MAX_BACKOFF:
+    """
+    retry_after = response.headers.get('retry-after', '') if response is not None else ''
+    if retry_after.isdigit():
+        return min(float(retry_after), MAX_BACKOFF)
+    wait = min(BACKOFF * 2 ** attempt, MAX_BACKOFF)
+    return wait * random.uniform(0.5, 1.0)
+
+
+class TokenBucket(object):
+    """Limit the rate of requests made to a host, allowing short bursts.
+
+    Safe to share across threads.
+    """
+    def __init__(self, rate=RATE_LIMIT, burst=RATE_BURST):
+        """Start with a full bucket.
+
+        :param rate: Requests per second allowed; 0 for no limit
+        :param burst: Number of requests that may be made at once
+        """
+        self.rate = rate
+        self.burst = burst
+        self._tokens = float(burst)
+        self._updated = time.time()
+        self._lock = threading.Lock()
+
+    def take(self):
+        """Wait until a request may be made, and count it against the limit."""
+        if not self.rate:
+            return
+        with self._lock:
+            now = time.time()
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            # tokens may go negative, which reserves a place in line for each waiting request
+            self._tokens -= 1
+            wait = -self._tokens / self.rate if self._tokens < 0 else 0
+        if wait:
+            LOG.debug('Waiting %.2f seconds to stay under the rate limit...', wait)
+            time.sleep(wait)
+
+
+class CircuitBreaker(object):
+    """Fail requests to a host fast once it is clearly down.
+
+    Opens after :FAILURE_THRESHOLD: failed requests in a row, after which requests fail
+    without being made. After :BREAKER_RESET: seconds, one request is let through to see if
+    the host is back, while the others keep failing; if it fails too, the breaker opens again.
+    Each request is counted once, however many times it was retried. Safe to share across
+    threads.
+    """
+    def __init__(self, host, threshold=FAILURE_THRESHOLD, reset=BREAKER_RESET):
+        self.host = host
+        self.threshold = threshold
+        self.reset = reset
+        self._failures = 0
+        self._opened = None
+        # whether a request is trying the host to see if it is back
+        self._probing = False
+        self._lock = threading.Lock()
+
+    def check(self):
+        """Check a request may be made to the host.
+
+        Once the breaker has been open for :reset: seconds, lets the first request through;
+        its outcome must be noted with :succeeded:, :failed: or :abandoned:.
+
+        :raises HostDownError: if the breaker is open
+        """
+        with self._lock:
+            if self._opened is None:
+                return
+            if self._probing or time.time() - self._opened < self.reset:
+                raise HostDownError('%s is down; not trying it again until %s' %
+                                    (self.host, time.ctime(self._opened + self.reset)))
+            LOG.info('Trying %s again to see if it is back up.', self.host)
+            self._probing = True
+
+    def succeeded(self):
+        """Note a request to the host succeeded."""
+        with self._lock:
+            self._failures = 0
+            self._opened = None
+            self._probing = False
+
+    def failed(self):
+        """Note a request to the host failed, opening the breaker if it has failed too often."""
+        with self._lock:
+            self._failures += 1
+            if self._probing:
+                LOG.error('%s is still down; failing requests to it for another %s seconds.',
+                          self.host, self.reset)
+                self._opened = time.time()
+                self._probing = False
+            elif self._failures >= self.threshold and self._opened is None:
+                LOG.error('%s failed %s requests in a row; failing requests to it for %s ' +
+                          'seconds.', self.host, self._failures, self.reset)
+                self._opened = time.time()
+
+    def abandoned(self):
+        """Note a request to the host was given up on without telling if the host is up,
+        such as by running out of time, so another may try the host if this one was."""
+        with self._lock:
+            self._probing = False
+
+
+def hold_slot(response, release):
+    """Keep a request slot taken until a streamed response is closed.
+
+    :param response: Streamed :requests.Response:
+    :param release: Function that frees the slot, as returned by :HostLimiter.acquire:
+    """
+    close = response.close
+
+    def close_and_release():
+        """Close the response, then free its slot."""
+        try:
+            close()
+        finally:
+            release()
+    response.close = close_and_release
+
+
+class HostLimiter(object):
+    """Cap the number and rate of requests made to each host, retrying those that fail,
+    and failing fast once a host is down.
+
+    Shared by all the feed sources in a run, so feeds from different sources
+    hosted on the same server (such as data.trilliumtransit.com) count against the same limits.
+    """
+    def __init__(self, max_per_host=MAX_PER_HOST, rate_limit=RATE_LIMIT, retries=RETRIES,
+                 timeout=(CONNECT_TIMEOUT, READ_TIMEOUT)):
+        """Set the limits for every host.
+
+        :param max_per_host: Maximum number of requests to make to any one host at the same time
+        :param rate_limit: Requests per second to make to any one host; 0 for no limit
+        :param retries: Number of times to retry a request that failed
+        :param timeout: Tuple of seconds to wait to connect, and for each read
+        """
+        self.max_per_host = max_per_host
+        self.rate_limit = rate_limit
+        self.retries = retries
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        self._semaphores = {}
+        self._buckets = {}
+        self._breakers = {}
+
+    def semaphore(self, host):
+        """Get the semaphore guarding requests to the given host."""
+        with self._lock:
+            if host not in self._semaphores:
+                self._semaphores[host] = threading.BoundedSemaphore(self.max_per_host)
+            return self._semaphores[host]
+
+    def bucket(self, host):
+        """Get the :TokenBucket: limiting the rate of requests to the given host."""
+        with self._lock:
+            if host not in self._buckets:
+                self._buckets[host] = TokenBucket(self.rate_limit)
+            return self._buckets[host]
+
+    def breaker(self, host):
+        """Get the :CircuitBreaker: for the given host."""
+        with self._lock:
+            if host not in self._breakers:
+                self._breakers[host] = CircuitBreaker(host)
+            return self._breakers[host]
+
+    def acquire(self, url):
+        """Wait for a free request slot for the host of the given URL, and take it.
+
+        :returns: Function that frees the slot; only the first call to it has any effect
+        """
+        host = url_host(url)
+        semaphore = self.semaphore(host)
+        if not semaphore.acquire(False):
+            LOG.debug('Waiting for a free connection slot for %s...', host)
+            semaphore.acquire()
+        lock = threading.Lock()
+        held = [True]
+
+        def release():
+            """Free the slot, unless it already has been."""
+            with lock:
+                if held[0]:
+                    held[0] = False
+                    semaphore.release()
+        return release
+
+    @contextmanager
+    def slot(self, url):
+        """Context manager that waits for a free request slot for the host of the given URL."""
+        release = self.acquire(url)
+        try:
+            yield
+        finally:
+            release()
+
+    def request(self, session, method, url, deadline=None, **kwargs):
+        """Make a request within the limits for its host, retrying it if the host has trouble.
+
+        Requests that fail with a connection error or timeout, or one of :RETRY_STATUSES:,
+        are retried up to :retries: times, after a :backoff:, as long as that would not go past
+        the deadline. Once out of retries, a request that still failed with a connection error
+        or timeout, or one of :HOST_DOWN_STATUSES:, counts once against the host's
+        :CircuitBreaker:.
+
+        :param session: :requests.Session: to make the request with
+        :param method: HTTP method, such as 'get' or 'head'
+        :param url: URL to request
+        :param deadline: :deadlines.Deadline: to give up on the request at, if any; waiting
+                         to connect or for each read is cut short to not go past it
+        :param **kwargs: Additional arguments for :requests.Session.request:; the :timeout:
+                         is used unless one is given
+        :returns: :requests.Response:, which may be for a failed request once out of retries.
+                  A streamed response (with stream=True) keeps its host's slot until it is
+                  closed, so the caller must close it once done reading the body.
+        :raises HostDownError: if the host is down, according to its :CircuitBreaker:
+        :raises DeadlineError: if the deadline passes before the request succeeds
+        :raises requests.RequestException: if the last attempt failed with a connection error
+                                           or timeout
+        """
+        breaker = self.breaker(url_host(url))
+        breaker.check()
+        try:
+            response = self._request_with_retries(session, method, url, deadline, **kwargs)
+        except (requests.ConnectionError, requests.Timeout):
+            breaker.failed()
+            raise
+        except BaseException:
+            breaker.abandoned()
+            raise
+        if response.status_code in HOST_DOWN_STATUSES:
+            breaker.failed()
+        else:
+            # the host answered, even if with an error for this URL
+            breaker.succeeded()
+        return response
+
+    def _request_with_retries(self, session, method, url, deadline=None, **kwargs):
+        """Make a request within the limits for its host, retrying it if the host has trouble;
+        see :request:."""
+        host = url_host(url)
+        timeout = kwargs.pop('timeout', self.timeout)
+        attempt = 0
+        while True:
+            response = error = None
+            # wait for the rate limit before taking a slot, so waiting does not hold one up
+            self.bucket(host).take()
+            release = self.acquire(url)
+            try:
+                if deadline:
+                    deadline.check()
+                    kwargs['timeout'] = deadline.timeout(timeout)
+                else:
+                    kwargs['timeout'] = timeout
+                response = session.request(method, url, **kwargs)
+            except (requests.ConnectionError, requests.Timeout) as ex:
+                if deadline and deadline.expired():
+                    raise DeadlineError('%s ran out of time requesting %s: %s' %
+                                        (deadline.what, url, ex))
+                error = ex
+            finally:
+                if response is None or not kwargs.get('stream'):
+                    release()
+            if response is not None and kwargs.get('stream'):
+                # the body is still to be read; the slot is held until the response is closed
+                hold_slot(response, release)
+            if response is not None and response.status_code not in RETRY_STATUSES:
+                return response
+            if attempt >= self.retries:
+                if error:
+                    raise error
+                return response
+            wait = backoff(attempt, response)
+            if deadline and deadline.remaining() is not None and deadline.remaining() <= wait:
+                if response is not None:
+                    return response
+                raise DeadlineError('%s ran out of time to retry %s: %s' %
+                                    (deadline.what, url, error))
+            LOG.warn('%s %s failed (%s); retrying in %.1f seconds.', method.upper(), url,
+                     error or response.status_code, wait)
+            if response is not None:
+                response.close()
+            time.sleep(wait)
+            attempt += 1
@@ -0,0 +1,160 @@
+"""Timing of the stages of fetching each feed, such as scraping, downloading and validating it.
+
+Each stage run for a feed adds its duration, and the number of bytes it handled, to that feed's
+:Timings:. Optionally, each stage is also run under cProfile, with its profile written out to
+a file named after the source, feed and stage.
+"""
+from contextlib import contextmanager
+import cProfile
+import logging
+import os
+import threading
+import time
+
+LOG = logging.getLogger(__name__)
+
+# looking up where to download a feed from
+SCRAPE = 'scrape'
+# parsing the page scraped for the download link
+PARSE = 'parse'
+# checking headers to see if there is a new download
+HEAD = 'head'
+# requesting and saving the download
+DOWNLOAD = 'download'
+# validating the downloaded feed
+VALIDATE = 'validate'
+STAGES = (SCRAPE, PARSE, HEAD, DOWNLOAD, VALIDATE)
+
+# extension of the cProfile output files
+PROFILE_SUFFIX = '.prof'
+
+
+class StageCounter(object):
+    """Count of bytes handled in a timed stage, which the code being timed adds to."""
+    def __init__(self):
+        self.bytes = 0
+
+    def count(self, chunks):
+        """Count the bytes in data as it is iterated over.
+
+        :param chunks: Iterable of data
+        :returns: Generator of the same data
+        """
+        for chunk in chunks:
+            self.bytes += len(chunk)
+            yield chunk
+
+
+class Timings(object):
+    """Durations and byte counts of the stages of fetching each of a source's feeds.
+
+    Safe to share across threads.
+    """
+    def __init__(self, name, profile_dir=None):
+        """Start with no stages timed.
+
+        :param name: Name of the source, used to name profile output files
+        :param profile_dir: Directory to write a cProfile output file to for each stage;
+                            if None, stages are not profiled
+        """
+        self.name = name
+        self.profile_dir = profile_dir
+        self._lock = threading.Lock()
+        # { file name: { stage: { seconds, bytes, calls } } }
+        self._feeds = {}
+
+    @contextmanager
+    def timed(self, file_name, stage):
+        """Time a stage of fetching a feed, adding to any time already spent on it this run.
+
+        :param file_name: Name of the feed the stage is for
+        :param stage: One of :STAGES:
+        :returns: Context manager giving a :StageCounter: to count the bytes the stage handles
+        """
+        counter = StageCounter()
+        profiler = None
+        if self.profile_dir:
+            profiler = cProfile.Profile()
+            profiler.enable()
+        start = time.time()
+        try:
+            yield counter
+        finally:
+            seconds = time.time() - start
+            if profiler:
+                profiler.disable()
+                profiler.dump_stats(self.profile_path(file_name, stage))
+            self.add(file_name, stage, seconds, counter.bytes)
+
+    def profile_path(self, file_name, stage):
+        """Get the path to write the cProfile output of a feed's stage to."""
+        return os.path.join(self.profile_dir, '%s.%s.%s%s' % (self.name, file_name, stage,
+                                                              PROFILE_SUFFIX))
+
+    def add(self, file_name, stage, seconds, nbytes=0):
+        """Add to the time spent, and bytes handled, in a stage of fetching a feed.
+
+        :param file_name: Name of the feed the stage is for
+        :param stage: One of :STAGES:
+        :param seconds: Time spent in the stage
+        :param nbytes: Number of bytes the stage handled
+        """
+        LOG.debug('%s %s for %s took %.3f seconds (%s bytes).', self.name, stage, file_name,
+                  seconds, nbytes)
+        with self._lock:
+            timing = self._feeds.setdefault(file_name, {}).setdefault(
+                stage, {'seconds': 0.0, 'bytes': 0, 'calls': 0})
+            timing['seconds'] += seconds
+            timing['bytes'] += nbytes
+            timing['calls'] += 1
+
+    def share(self, from_file_name, to_file_names):
+        """Add the time spent on one feed's stages to other feeds.
+
+        For sources where one download holds several feeds.
+
+        :param from_file_name: Name of the feed whose stages were timed
+        :param to_file_names: Names of the feeds to add the stages to
+        """
+        for stage, timing in self.get(from_file_name).items():
+            for file_name in to_file_names:
+                with self._lock:
+                    self._feeds.setdefault(file_name, {})[stage] = dict(timing)
+
+    def get(self, file_name):
+        """Get the times spent in each stage of fetching a feed.
+
+        :param file_name: Name of the feed
+        :returns: Dictionary of { stage: { seconds, bytes, calls } }; empty if none were timed
+        """
+        with self._lock:
+            return dict((stage, dict(timing))
+                        for stage, timing in self._feeds.get(file_name, {}).items())
+
+    def file_names(self):
+        """Get the names of all the feeds with stages timed."""
+        with self._lock:
+            return list(self._feeds)
+
+
+def stage_seconds(stat, *stages):
+    """Get the total time spent in stages of fetching a feed, from its status.
+
+    :param stat: Status dictionary for the feed
+    :param stages: Stages to add up the time for; defaults to all of them
+    :returns: Seconds, or None if none of the stages were timed
+    """
+    timings = stat.get('timings') or {}
+    seconds = [timings[stage]['seconds'] for stage in stages or STAGES if stage in timings]
+    return sum(seconds) if seconds else None
+
+
+def stage_bytes(stat, stage):
+    """Get the number of bytes handled in a stage of fetching a feed, from its status.
+
+    :param stat: Status dictionary for the feed
+    :param stage: One of :STAGES:
+    :returns: Number of bytes, or None if the stage was not timed
+    """
+    timing = (stat.get('timings') or {}).get(stage)
+    return timing['bytes'] if timing else None
@@ -0,0 +1,76 @@
+"""Scraping of the pages some feed sources look their download URLs up on.
+
+Pages are requested conditionally, with the validators the server sent for them last time, and
+what was found on each page is kept in the status of the feed it was scraped for. A page that
+has not changed costs a single 304 response (or, from servers that send no validators, a
+download with the same digest as before), and is not parsed again. When a page is parsed, only
+the parts of it picked out by a :SoupStrainer: are.
+"""
+import logging
+
+from bs4 import BeautifulSoup
+
+from digests import new_digest
+from instrumentation import PARSE, SCRAPE
+
+LOG = logging.getLogger(__name__)
+
+# parser for scraped pages; part of the standard library, so needs no extra dependencies
+PARSER = 'html.parser'
+# key in a feed's status for what was found on the page scraped for it
+SCRAPE_KEY = 'scrape'
+
+
+def scrape(source, file_name, url, find, parse_only=None):
+    """Scrape a page for what a feed source needs to fetch a feed, such as its download URL.
+
+    :param source: :FeedSource: scraping the page
+    :param file_name: Name of the feed the page is scraped for; its status keeps what was found
+    :param url: Page to scrape
+    :param find: Function taking the parsed page, as :BeautifulSoup:, and returning what was
+                 found on it, which is kept in the feed's status, or None if nothing was found
+    :param parse_only: :bs4.SoupStrainer: for the parts of the page to parse;
+                       if None, the whole page is parsed
+    :returns: What :find: found on the page, or None if the page could not be fetched or
+              nothing was found
+    :raises requests.RequestException: if the page could not be requested
+    :raises DeadlineError: if the page could not be requested in time
+    """
+    stat = source.status.get(file_name) or {}
+    cached = stat.get(SCRAPE_KEY)
+    if cached and cached['url'] != url:
+        cached = None
+    headers = {}
+    if cached and cached.get('etag'):
+        headers['If-None-Match'] = cached['etag']
+    if cached and cached.get('last_modified'):
+        headers['If-Modified-Since'] = cached['last_modified']
+
+    with source.timings.timed(file_name, SCRAPE) as counter:
+        response = source.request('get', url, headers=headers)
+        counter.bytes = len(response.content)
+    if cached and response.status_code == 304:
+        LOG.debug('Page %s has not changed since it was last scraped.', url)
+        return cached['result']
+    if not response.ok:
+        LOG.error('Could not get %s to scrape: HTTP %s.', url, response.status_code)
+        return None
+
+    digest = new_digest()
+    digest.update(response.content)
+    digest = digest.hexdigest()
+    if cached and cached.get('digest') == digest:
+        LOG.debug('Page %s is the same as when it was last scraped.', url)
+        result = cached['result']
+    else:
+        with source.timings.timed(file_name, PARSE):
+            result = find(BeautifulSoup(response.text, PARSER, parse_only=parse_only))
+        if result is None:
+            return None
+    stat[SCRAPE_KEY] = {'url': url,
+                        'etag': response.headers.get('etag'),
+                        'last_modified': response.headers.get('last-modified'),
+                        'digest': digest,
+                        'result': result}
+    source.status[file_name] = stat
+    return result
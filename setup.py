@@ -8,4 +8,4 @@ setup(name='GtfsFetcher',
       author='Kathryn Killebrew',
       author_email='kathryn.killebrew@gmail.com',
       url='https://github.com/azavea/gtfs-feed-fetcher',
-      py_modules=['fetch_feeds', 'extend_effective_dates', 'check_status'])
+      py_modules=['fetch_feeds', 'feed_daemon', 'extend_effective_dates', 'check_status'])
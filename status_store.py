@@ -0,0 +1,142 @@
+"""Transactional store of feed statuses, shared by all the feed sources in a download directory.
+
+Statuses are kept in an SQLite database, with a row for each key in a source's status dictionary
+(one per feed, plus `last_check`). Saving a source's statuses only writes the rows that changed,
+in a single transaction, and several processes may use the database at once.
+"""
+import logging
+import os
+import pickle
+import sqlite3
+import threading
+
+LOG = logging.getLogger(__name__)
+
+# name of the status database file in the download directory
+STATUS_DB = 'status.db'
+# suffix added to a pickled status file once it has been migrated into the database
+MIGRATED_SUFFIX = '.migrated'
+# seconds to wait for another process to finish writing to the database
+LOCK_TIMEOUT = 60
+
+SCHEMA = '''CREATE TABLE IF NOT EXISTS status (
+    source TEXT NOT NULL,
+    key TEXT NOT NULL,
+    value BLOB NOT NULL,
+    updated TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (source, key)
+)'''
+
+
+class StatusStore(object):
+    """Database of the status dictionaries for each :FeedSource:.
+
+    Safe to share across threads; each read or save holds a lock on the connection.
+    """
+    def __init__(self, path):
+        """Open the database, creating it if it does not exist yet.
+
+        :param path: Full path to the SQLite database file
+        """
+        self.path = path
+        self._lock = threading.Lock()
+        # pickled value of each row last read or written, by (source, key)
+        self._saved = {}
+        self._conn = sqlite3.connect(path, timeout=LOCK_TIMEOUT, check_same_thread=False)
+        # write-ahead log lets readers carry on while another process writes
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        with self._conn:
+            self._conn.execute(SCHEMA)
+
+    def sources(self):
+        """Get the names of all the sources with statuses stored."""
+        with self._lock:
+            rows = self._conn.execute('SELECT DISTINCT source FROM status ORDER BY source')
+            return [row[0] for row in rows]
+
+    def load(self, source):
+        """Read the status dictionary for a source.
+
+        :param source: Name of the :FeedSource: class
+        :returns: Status dictionary; empty if none stored
+        """
+        with self._lock:
+            rows = self._conn.execute('SELECT key, value FROM status WHERE source = ?', (source,))
+            status = {}
+            for key, value in rows:
+                key, value = str(key), str(value)
+                self._saved[(source, key)] = value
+                status[key] = pickle.loads(value)
+            return status
+
+    def load_all(self):
+        """Read the status dictionaries for all sources.
+
+        Reads the whole table in a single query, rather than one for each source.
+
+        :returns: Dictionary of { source name: status dictionary }
+        """
+        with self._lock:
+            rows = self._conn.execute('SELECT source, key, value FROM status')
+            statuses = {}
+            for source, key, value in rows:
+                source, key, value = str(source), str(key), str(value)
+                self._saved[(source, key)] = value
+                statuses.setdefault(source, {})[key] = pickle.loads(value)
+            return statuses
+
+    def save(self, source, status):
+        """Write a source's status dictionary, in one transaction.
+
+        Only rows that changed since they were last read or written are updated,
+        and rows for keys no longer in the status are deleted.
+
+        :param source: Name of the :FeedSource: class
+        :param status: Status dictionary to save
+        """
+        with self._lock:
+            changed = []
+            for key, value in status.items():
+                pickled = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+                if self._saved.get((source, key)) != pickled:
+                    changed.append((key, pickled))
+            removed = [key for (src, key) in self._saved
+                       if src == source and key not in status]
+            if not changed and not removed:
+                return
+
+            with self._conn:
+                self._conn.executemany(
+                    'INSERT OR REPLACE INTO status (source, key, value) VALUES (?, ?, ?)',
+                    [(source, key, sqlite3.Binary(pickled)) for key, pickled in changed])
+                self._conn.executemany('DELETE FROM status WHERE source = ? AND key = ?',
+                                       [(source, key) for key in removed])
+            for key, pickled in changed:
+                self._saved[(source, key)] = pickled
+            for key in removed:
+                del self._saved[(source, key)]
+            LOG.debug('Saved %s changed and %s removed statuses for %s.',
+                      len(changed), len(removed), source)
+
+    def migrate(self, source, pickle_path):
+        """Import a pickled status file written by earlier versions, if there is one.
+
+        The pickle file is renamed with :MIGRATED_SUFFIX: once imported, so it is only read once.
+
+        :param source: Name of the :FeedSource: class the pickle file belongs to
+        :param pickle_path: Full path to the pickled status file
+        :returns: Imported status dictionary, or None if there was no file to migrate
+        """
+        if not os.path.isfile(pickle_path):
+            return None
+        with open(pickle_path, 'rb') as tcf:
+            status = pickle.load(tcf)
+        self.save(source, status)
+        os.rename(pickle_path, pickle_path + MIGRATED_SUFFIX)
+        LOG.info('Migrated status file %s into %s.', pickle_path, self.path)
+        return status
+
+    def close(self):
+        """Close the database connection."""
+        with self._lock:
+            self._conn.close()
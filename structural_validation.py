@@ -0,0 +1,190 @@
+"""Quick structural check of a GTFS feed, as a fast tier before (or instead of) feedvalidator.py.
+
+Streams each table out of the zip once, checking that the required files and columns are there
+and that the IDs trips and stop times refer to exist. Only the ID sets of the tables referred to
+(routes, stops, trips and services) are held in memory, never a whole table.
+"""
+from datetime import datetime
+import logging
+import zipfile
+
+from effective_dates import parse_gtfs_date, SERVICE_ADDED
+from gtfs_tables import read_gtfs_columns, read_gtfs_header
+from validation import ValidatorError
+
+LOG = logging.getLogger(__name__)
+
+# required columns for each required table
+REQUIRED_COLUMNS = {
+    'agency.txt': ('agency_name', 'agency_url', 'agency_timezone'),
+    'stops.txt': ('stop_id', 'stop_name', 'stop_lat', 'stop_lon'),
+    'routes.txt': ('route_id', 'route_type'),
+    'trips.txt': ('route_id', 'service_id', 'trip_id'),
+    'stop_times.txt': ('trip_id', 'arrival_time', 'departure_time', 'stop_id', 'stop_sequence')
+}
+# required columns for the service calendar tables; a feed must have at least one of them
+CALENDAR_COLUMNS = {
+    'calendar.txt': ('service_id', 'monday', 'tuesday', 'wednesday', 'thursday', 'friday',
+                     'saturday', 'sunday', 'start_date', 'end_date'),
+    'calendar_dates.txt': ('service_id', 'date', 'exception_type')
+}
+# number of problems of each kind to describe in the results; the rest are only counted
+MAX_EXAMPLES = 5
+
+
+class StructureReport(object):
+    """Problems found checking a feed's structure."""
+    def __init__(self):
+        self.errors = 0
+        self.warnings = 0
+        self.problems = []
+        self._counts = {}
+
+    def error(self, kind, message):
+        """Record an error, which makes the feed invalid."""
+        self.errors += 1
+        self._add(kind, 'Error: ' + message)
+
+    def warning(self, kind, message):
+        """Record a warning."""
+        self.warnings += 1
+        self._add(kind, 'Warning: ' + message)
+
+    def _add(self, kind, message):
+        """Keep the first few messages of each kind."""
+        count = self._counts.get(kind, 0) + 1
+        self._counts[kind] = count
+        if count <= MAX_EXAMPLES:
+            self.problems.append(message)
+
+    def summary(self):
+        """Describe the problems found in a line, like feedvalidator.py's summary."""
+        if not self.errors and not self.warnings:
+            return 'feed validated successfully'
+        return 'ERROR: %s error%s and %s warning%s found' % (
+            self.errors, '' if self.errors == 1 else 's',
+            self.warnings, '' if self.warnings == 1 else 's')
+
+
+def check_ids(report, feedzip, table_name, id_column):
+    """Read the set of IDs in a table, reporting IDs that are missing or duplicated.
+
+    :returns: Set of the IDs found
+    """
+    ids = set()
+    for (value,) in read_gtfs_columns(feedzip, table_name, (id_column,)):
+        if not value:
+            report.error('missing_' + id_column, '%s has a row with no %s' %
+                         (table_name, id_column))
+        elif value in ids:
+            report.error('duplicate_' + id_column, '%s has duplicate %s %s' %
+                         (table_name, id_column, value))
+        else:
+            ids.add(value)
+    return ids
+
+
+def check_columns(report, feedzip, required_columns):
+    """Check that each table is in the feed with its required columns.
+
+    :returns: List of the tables found
+    """
+    found = []
+    for table_name, columns in sorted(required_columns.items()):
+        header = read_gtfs_header(feedzip, table_name)
+        if header is None:
+            continue
+        found.append(table_name)
+        for column in columns:
+            if column not in header:
+                report.error('missing_column', '%s is missing required column %s' %
+                             (table_name, column))
+    return found
+
+
+def check_feed(feedzip, report):
+    """Run the structural checks on an open feed zip, recording problems on the report.
+
+    :returns: Earliest date the feed has service on, or None if not found
+    """
+    for table_name in sorted(set(REQUIRED_COLUMNS) - set(feedzip.namelist())):
+        report.error('missing_file', 'Missing required file %s' % table_name)
+    check_columns(report, feedzip, REQUIRED_COLUMNS)
+    if not check_columns(report, feedzip, CALENDAR_COLUMNS):
+        report.error('missing_file', 'Missing calendar.txt and calendar_dates.txt')
+
+    # services, and the earliest date any of them runs on
+    service_ids = set()
+    first_date = None
+    for service_id, start_date in read_gtfs_columns(feedzip, 'calendar.txt',
+                                                    ('service_id', 'start_date')):
+        service_ids.add(service_id)
+        start_date = parse_gtfs_date(start_date)
+        if not start_date:
+            report.error('invalid_date', 'calendar.txt has invalid start_date for service %s' %
+                         service_id)
+        elif not first_date or start_date < first_date:
+            first_date = start_date
+    for service_id, date, exception_type in read_gtfs_columns(
+            feedzip, 'calendar_dates.txt', ('service_id', 'date', 'exception_type')):
+        service_ids.add(service_id)
+        date = parse_gtfs_date(date)
+        if not date:
+            report.error('invalid_date', 'calendar_dates.txt has invalid date for service %s' %
+                         service_id)
+        elif exception_type == SERVICE_ADDED and (not first_date or date < first_date):
+            first_date = date
+    service_ids.discard('')
+
+    route_ids = check_ids(report, feedzip, 'routes.txt', 'route_id')
+    stop_ids = check_ids(report, feedzip, 'stops.txt', 'stop_id')
+
+    trip_ids = set()
+    for trip_id, route_id, service_id in read_gtfs_columns(
+            feedzip, 'trips.txt', ('trip_id', 'route_id', 'service_id')):
+        if not trip_id:
+            report.error('missing_trip_id', 'trips.txt has a row with no trip_id')
+            continue
+        if trip_id in trip_ids:
+            report.error('duplicate_trip_id', 'trips.txt has duplicate trip_id %s' % trip_id)
+        trip_ids.add(trip_id)
+        if route_id not in route_ids:
+            report.error('unknown_route', 'Trip %s refers to unknown route_id %s' %
+                         (trip_id, route_id))
+        if service_id not in service_ids:
+            report.error('unknown_service', 'Trip %s refers to unknown service_id %s' %
+                         (trip_id, service_id))
+    route_ids = service_ids = None
+
+    trips_with_stops = set()
+    for trip_id, stop_id in read_gtfs_columns(feedzip, 'stop_times.txt', ('trip_id', 'stop_id')):
+        if trip_id not in trip_ids:
+            report.error('unknown_trip', 'Stop time refers to unknown trip_id %s' % trip_id)
+        else:
+            trips_with_stops.add(trip_id)
+        if stop_id not in stop_ids:
+            report.error('unknown_stop', 'Stop time for trip %s refers to unknown stop_id %s' %
+                         (trip_id, stop_id))
+    for trip_id in trip_ids - trips_with_stops:
+        report.warning('trip_without_stops', 'Trip %s has no stop times' % trip_id)
+    return first_date
+
+
+def validate_structure(feed_path):
+    """Check the structure of a GTFS feed, reading each of its tables once.
+
+    :param feed_path: Full path to the GTFS to check
+    :returns: Dictionary of validation results, with the keys described for
+              :ValidatorService.validate:, plus `problems`: a list of some of the problems found
+    :raises ValidatorError: if the feed could not be read
+    """
+    report = StructureReport()
+    try:
+        with zipfile.ZipFile(feed_path) as feedzip:
+            first_date = check_feed(feedzip, report)
+    except (IOError, zipfile.BadZipfile) as ex:
+        raise ValidatorError('Could not read feed: %s' % ex)
+    return {'summary': report.summary(),
+            'has_errors': report.errors > 0,
+            'in_future': bool(first_date and first_date > datetime.today()),
+            'problems': report.problems}
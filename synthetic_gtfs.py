@@ -0,0 +1,209 @@
+#!/usr/bin/env python
+"""Generate synthetic GTFS feeds of a given size, for benchmarking.
+
+Feeds are written a table at a time, with stop_times.txt streamed into the zip as it is generated,
+so even the largest feeds are generated without holding them in memory.
+"""
+import argparse
+from collections import OrderedDict
+import csv
+from datetime import date, timedelta
+import logging
+import os
+import random
+from StringIO import StringIO
+import sys
+import time
+import zipfile
+
+from gtfs_transforms import write_zip_member, CHUNK_SIZE, GTFS_DATE_FMT, PARTIAL_SUFFIX
+
+# (routes, trips per route, stops per trip) for each size of feed
+FEED_SIZES = OrderedDict([
+    # 200 stop times
+    ('tiny', (2, 5, 10)),
+    # 60 thousand stop times
+    ('small', (20, 50, 30)),
+    # 1.6 million stop times
+    ('medium', (100, 200, 40)),
+    # 6 million stop times; about the size of LA Metro's bus feed
+    ('large', (150, 450, 45)),
+])
+# days before today service in the generated feeds starts
+PAST_DAYS = 30
+# days after today service in the generated feeds ends
+FUTURE_DAYS = 90
+# seconds after midnight the first trip of the day leaves
+FIRST_DEPARTURE = 5 * 60 * 60
+# seconds from the first trip of the day to the last
+SERVICE_SPAN = 18 * 60 * 60
+# seconds between consecutive stops on a trip
+STOP_INTERVAL = 2 * 60
+# degrees of latitude and longitude between consecutive stops on a route; about 400 meters
+STOP_SPACING = 0.004
+# the routes are split between this many agencies
+AGENCIES = 2
+# service ids for weekday and weekend trips
+WEEKDAY_SERVICE = 'WK'
+WEEKEND_SERVICE = 'WE'
+
+logging.basicConfig()
+LOG = logging.getLogger()
+LOG.setLevel(logging.INFO)
+
+
+def table_chunks(header, rows):
+    """Write rows as CSV, in chunks of around :CHUNK_SIZE: bytes.
+
+    :param header: List of column names
+    :param rows: Iterable of sequences of values
+    :returns: Generator of strings of CSV
+    """
+    buf = StringIO()
+    writer = csv.writer(buf)
+    writer.writerow(header)
+    for row in rows:
+        writer.writerow(row)
+        if buf.tell() >= CHUNK_SIZE:
+            yield buf.getvalue()
+            buf.seek(0)
+            buf.truncate()
+    yield buf.getvalue()
+
+
+def gtfs_time(seconds):
+    """Format seconds after midnight as a GTFS time, which may be past 24:00:00."""
+    return '%02d:%02d:%02d' % (seconds // 3600, seconds // 60 % 60, seconds % 60)
+
+
+def write_feed(feed_path, routes, trips_per_route, stops_per_trip, seed=0, today=None):
+    """Write a synthetic GTFS feed.
+
+    Each route has its own stops, along a straight line, and its own shape, and runs evenly
+    spaced trips on weekdays and weekends. Service runs from :PAST_DAYS: before today
+    to :FUTURE_DAYS: after.
+
+    :param feed_path: Full path to write the feed zip to
+    :param routes: Number of routes
+    :param trips_per_route: Number of trips on each route, each on weekdays and on weekends
+    :param stops_per_trip: Number of stops each trip makes
+    :param seed: Seed for the random stop locations and patterns, so feeds can be reproduced
+    :param today: Date to center the service dates on; defaults to today
+    :returns: Number of rows written to stop_times.txt
+    """
+    rnd = random.Random(seed)
+    today = today or date.today()
+    start_date = (today - timedelta(days=PAST_DAYS)).strftime(GTFS_DATE_FMT)
+    end_date = (today + timedelta(days=FUTURE_DAYS)).strftime(GTFS_DATE_FMT)
+    stops = []
+    patterns = []
+    for _ in range(routes):
+        lat, lon = rnd.uniform(33.7, 34.3), rnd.uniform(-118.6, -117.9)
+        lat_step, lon_step = rnd.choice(((STOP_SPACING, 0), (0, STOP_SPACING),
+                                         (-STOP_SPACING, 0), (0, -STOP_SPACING)))
+        patterns.append(range(len(stops), len(stops) + stops_per_trip))
+        for idx in range(stops_per_trip):
+            stop = len(stops)
+            stops.append(('S%d' % stop, 'Stop %d' % stop,
+                          '%.6f' % (lat + idx * lat_step), '%.6f' % (lon + idx * lon_step)))
+    headway = max(SERVICE_SPAN // max(trips_per_route, 1), 1)
+
+    def trips():
+        """Two services' worth of trips on each route, each following its route's shape."""
+        for route in range(routes):
+            for service in (WEEKDAY_SERVICE, WEEKEND_SERVICE):
+                for trip in range(trips_per_route):
+                    yield ('R%d' % route, service, 'T%d_%s_%d' % (route, service, trip),
+                           'SH%d' % route)
+
+    def stop_times():
+        """Stop times for every trip, made as they are written out."""
+        for route_id, service, trip_id, _ in trips():
+            route = int(route_id[1:])
+            trip = int(trip_id.rsplit('_', 1)[1])
+            departure = FIRST_DEPARTURE + trip * headway
+            for sequence, stop in enumerate(patterns[route]):
+                stop_time = gtfs_time(departure + sequence * STOP_INTERVAL)
+                yield (trip_id, stop_time, stop_time, stops[stop][0], sequence + 1)
+
+    def shapes():
+        """A shape point at each stop of each route's pattern."""
+        for route, pattern in enumerate(patterns):
+            for sequence, stop in enumerate(pattern):
+                yield ('SH%d' % route, stops[stop][2], stops[stop][3], sequence + 1)
+
+    tables = [
+        ('agency.txt', ['agency_id', 'agency_name', 'agency_url', 'agency_timezone'],
+         [('A%d' % idx, 'Agency %d' % idx, 'http://example.com/%d' % idx, 'America/Los_Angeles')
+          for idx in range(AGENCIES)]),
+        ('stops.txt', ['stop_id', 'stop_name', 'stop_lat', 'stop_lon'], stops),
+        ('routes.txt', ['route_id', 'agency_id', 'route_short_name', 'route_long_name',
+                        'route_type'],
+         [('R%d' % idx, 'A%d' % (idx % AGENCIES), str(idx), 'Route %d' % idx, 3)
+          for idx in range(routes)]),
+        ('calendar.txt', ['service_id', 'monday', 'tuesday', 'wednesday', 'thursday', 'friday',
+                          'saturday', 'sunday', 'start_date', 'end_date'],
+         [(WEEKDAY_SERVICE, 1, 1, 1, 1, 1, 0, 0, start_date, end_date),
+          (WEEKEND_SERVICE, 0, 0, 0, 0, 0, 1, 1, start_date, end_date)]),
+        ('calendar_dates.txt', ['service_id', 'date', 'exception_type'],
+         [(WEEKDAY_SERVICE, start_date, 2), (WEEKEND_SERVICE, start_date, 1)]),
+        ('trips.txt', ['route_id', 'service_id', 'trip_id', 'shape_id'], trips()),
+        ('stop_times.txt', ['trip_id', 'arrival_time', 'departure_time', 'stop_id',
+                            'stop_sequence'], stop_times()),
+        ('shapes.txt', ['shape_id', 'shape_pt_lat', 'shape_pt_lon', 'shape_pt_sequence'],
+         shapes()),
+    ]
+
+    partial_path = feed_path + PARTIAL_SUFFIX
+    with zipfile.ZipFile(partial_path, 'w', zipfile.ZIP_DEFLATED, allowZip64=True) as new_zip:
+        for table_name, header, rows in tables:
+            write_zip_member(new_zip, table_name, table_chunks(header, rows))
+    os.rename(partial_path, feed_path)
+    return routes * 2 * trips_per_route * stops_per_trip
+
+
+def write_sized_feed(feed_path, size, seed=0):
+    """Write a synthetic GTFS feed of one of the :FEED_SIZES:.
+
+    :param feed_path: Full path to write the feed zip to
+    :param size: Name of the size of feed, as in :FEED_SIZES:
+    :param seed: Seed for the random stop locations and patterns, so feeds can be reproduced
+    :returns: Number of rows written to stop_times.txt
+    """
+    routes, trips_per_route, stops_per_trip = FEED_SIZES[size]
+    return write_feed(feed_path, routes, trips_per_route, stops_per_trip, seed)
+
+
+def main():
+    """Main entry point for command line interface."""
+    parser = argparse.ArgumentParser(description='Generate a synthetic GTFS feed.')
+    parser.add_argument('feed_path', help='File to write the feed zip to')
+    parser.add_argument('--size', '-s', choices=FEED_SIZES.keys(), default='small',
+                        help='Size of feed to generate (default: small)')
+    parser.add_argument('--routes', type=int,
+                        help='Number of routes (default: set by --size)')
+    parser.add_argument('--trips-per-route', type=int,
+                        help='Number of trips on each route, each on weekdays and on ' +
+                        'weekends (default: set by --size)')
+    parser.add_argument('--stops-per-trip', type=int,
+                        help='Number of stops each trip makes (default: set by --size)')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='Seed for the random stops and patterns (default: 0)')
+
+    args = parser.parse_args()
+    routes, trips_per_route, stops_per_trip = FEED_SIZES[args.size]
+    routes = args.routes or routes
+    trips_per_route = args.trips_per_route or trips_per_route
+    stops_per_trip = args.stops_per_trip or stops_per_trip
+    if min(routes, trips_per_route, stops_per_trip) < 1:
+        LOG.error('--routes, --trips-per-route and --stops-per-trip must be positive integers. ' +
+                  'Exiting.')
+        sys.exit(2)
+
+    start = time.time()
+    stop_times = write_feed(args.feed_path, routes, trips_per_route, stops_per_trip, args.seed)
+    LOG.info('Wrote %s with %s stop times (%s bytes) in %.2f seconds.', args.feed_path,
+             stop_times, os.path.getsize(args.feed_path), time.time() - start)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,63 @@
+"""Tests for how feed statuses are kept when a run goes over its deadline; run with
+`python -m unittest discover tests`."""
+from datetime import datetime, timedelta
+import shutil
+import tempfile
+import unittest
+
+from deadlines import TimeBudget
+from FeedSource import FeedSource
+from update_cadence import is_check_due
+
+# where the feed would be downloaded from; never requested, as the run is out of time
+URL = 'http://127.0.0.1:1/feed.zip'
+FILE_NAME = 'feed.zip'
+
+
+class RunDeadlineTest(unittest.TestCase):
+    """A feed the run never got to before its deadline keeps what is known about it."""
+    def setUp(self):
+        self.ddir = tempfile.mkdtemp()
+        # a run with no time at all, so its deadline has passed before any feed is checked
+        self.source = FeedSource(ddir=self.ddir, time_budget=TimeBudget(deadline=0))
+
+    def tearDown(self):
+        self.source.status_store.close()
+        shutil.rmtree(self.ddir)
+
+    def test_existing_status_kept(self):
+        today = datetime.today()
+        previous = {'etag': '"abc123"',
+                    'last_modified': 'Mon, 05 Oct 2026 10:00:00 GMT',
+                    'posted_date': 'Mon, 05 Oct 2026 10:00:00 GMT',
+                    'digest': 'abc123',
+                    'is_valid': True,
+                    'effective_from': today - timedelta(days=30),
+                    'effective_to': today + timedelta(days=90),
+                    'last_checked': today - timedelta(days=1)}
+        self.source.status = {FILE_NAME: dict(previous)}
+
+        self.assertFalse(self.source.fetchone(FILE_NAME, URL))
+
+        stat = self.source.status[FILE_NAME]
+        self.assertNotIn('error', stat)
+        self.assertTrue(stat['timed_out'])
+        self.assertFalse(stat['is_new'])
+        self.assertTrue(stat['is_current'])
+        for key, value in previous.items():
+            self.assertEqual(stat[key], value, key)
+        # skipped this time, so checked first thing next time
+        self.assertTrue(is_check_due(stat))
+
+    def test_new_feed_set_to_error(self):
+        self.source.status = {}
+
+        self.assertFalse(self.source.fetchone(FILE_NAME, URL))
+
+        stat = self.source.status[FILE_NAME]
+        self.assertTrue(stat['timed_out'])
+        self.assertIn('error', stat)
+
+
+if __name__ == '__main__':
+    unittest.main()
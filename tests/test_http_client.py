@@ -0,0 +1,76 @@
+"""Tests for the per-host limits on requests; run with `python -m unittest discover tests`."""
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+from benchmark import make_source_class, FeedServer
+from fetch_feeds import fetch_all
+from http_client import HostLimiter, iter_body, make_session
+from synthetic_gtfs import write_sized_feed
+from validation import FAST_VALIDATION
+
+# requests allowed to the test server at once
+MAX_PER_HOST = 2
+# feeds downloaded at once from the test server; more than :MAX_PER_HOST:
+WORKERS = 6
+# bytes per second the test server sends each feed at, so bodies take a while to stream;
+# a small feed is several of its send chunks
+BANDWIDTH = 2 * 1024 * 1024
+
+
+class HostSlotTest(unittest.TestCase):
+    """A streamed response holds its host's slot until its body is read and it is closed."""
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.served = os.path.join(self.directory, 'served')
+        os.makedirs(self.served)
+        self.file_names = ['feed%d.zip' % idx for idx in range(WORKERS)]
+        for idx, file_name in enumerate(self.file_names):
+            write_sized_feed(os.path.join(self.served, file_name), 'small', seed=idx)
+        self.ddir = os.path.join(self.directory, 'gtfs')
+        os.makedirs(self.ddir)
+        self.server = FeedServer(self.served, bandwidth=BANDWIDTH).start()
+
+    def tearDown(self):
+        self.server.close()
+        shutil.rmtree(self.directory)
+
+    def test_streamed_bodies_within_cap(self):
+        limiter = HostLimiter(MAX_PER_HOST, rate_limit=0)
+        session = make_session(WORKERS)
+
+        def download(file_name):
+            response = limiter.request(session, 'get', self.server.url(file_name), stream=True)
+            try:
+                for _ in iter_body(response, 1024):
+                    pass
+            finally:
+                response.close()
+
+        threads = [threading.Thread(target=download, args=(file_name,))
+                   for file_name in self.file_names]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        session.close()
+        self.assertEqual(self.server.stats['bytes_sent'],
+                         sum(os.path.getsize(os.path.join(self.served, file_name))
+                             for file_name in self.file_names))
+        self.assertEqual(self.server.stats['peak_sending'], MAX_PER_HOST)
+
+    def test_feed_downloads_within_cap(self):
+        source = make_source_class(dict((file_name, self.server.url(file_name))
+                                        for file_name in self.file_names))
+        statuses = fetch_all([source], workers=WORKERS, max_per_host=MAX_PER_HOST,
+                             validation_mode=FAST_VALIDATION, rate_limit=0,
+                             ddir=self.ddir)
+        for file_name in self.file_names:
+            self.assertTrue(statuses[file_name].get('is_valid'), statuses[file_name])
+        self.assertEqual(self.server.stats['peak_sending'], MAX_PER_HOST)
+
+
+if __name__ == '__main__':
+    unittest.main()
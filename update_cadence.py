@@ -0,0 +1,98 @@
+"""How often each feed gets updated, learned from the posted dates of its past updates.
+
+Feeds unlikely to have changed since they were last checked are not checked again yet. A feed is
+checked every :CHECK_FRACTION: of the typical time between its updates, but no more often than
+every :MIN_CHECK_INTERVAL:, and at least every :MAX_CHECK_INTERVAL:. Feeds with too few updates
+seen to tell how often they change; feeds that had an error, were skipped at a run's deadline,
+or are not valid and current; and feeds within :EXPIRY_WINDOW: of their effective_to date are
+checked every time.
+"""
+from datetime import datetime, timedelta
+
+from http_client import parse_http_date
+
+# shortest time to wait between checks of a feed for updates
+MIN_CHECK_INTERVAL = timedelta(hours=1)
+# longest time to wait between checks of a feed for updates, however rarely it is updated
+MAX_CHECK_INTERVAL = timedelta(days=7)
+# fraction of the typical time between a feed's updates to wait between checks of it
+CHECK_FRACTION = 0.1
+# number of past updates to keep the posted dates of for each feed
+HISTORY_LENGTH = 12
+# number of updates that must have been seen before a feed's cadence is estimated
+MIN_UPDATES = 3
+# feeds are checked every time once they are this close to their effective_to date
+EXPIRY_WINDOW = timedelta(days=14)
+
+
+def record_update(stat, posted_date):
+    """Add a new version of a feed to its update history.
+
+    :param stat: Status dictionary for the feed, to keep the history on
+    :param posted_date: Date string formatted like a Last-Modified header when the new version
+                        was posted
+    """
+    history = stat.get('update_history') or []
+    if history and history[-1] == posted_date:
+        return
+    history.append(posted_date)
+    stat['update_history'] = history[-HISTORY_LENGTH:]
+
+
+def update_cadence(stat):
+    """Estimate the typical time between a feed's updates, as the median gap between them.
+
+    :param stat: Status dictionary for the feed
+    :returns: :timedelta:, or None if too few updates have been seen to tell
+    """
+    dates = sorted(posted for posted in (parse_http_date(value)
+                                         for value in stat.get('update_history') or [])
+                   if posted)
+    gaps = sorted(later - earlier for earlier, later in zip(dates, dates[1:]) if later > earlier)
+    if len(gaps) < MIN_UPDATES - 1:
+        return None
+    return gaps[len(gaps) // 2]
+
+
+def check_interval(stat):
+    """Get how long to wait between checks of a feed for updates.
+
+    :param stat: Status dictionary for the feed
+    :returns: :timedelta: between :MIN_CHECK_INTERVAL: and :MAX_CHECK_INTERVAL:, or None if
+              the feed's cadence is not known yet
+    """
+    cadence = update_cadence(stat)
+    if not cadence:
+        return None
+    interval = timedelta(seconds=cadence.total_seconds() * CHECK_FRACTION)
+    return min(max(interval, MIN_CHECK_INTERVAL), MAX_CHECK_INTERVAL)
+
+
+def next_check(stat):
+    """Get when a feed is next due to be checked for updates.
+
+    :param stat: Status dictionary for the feed, or None if it has none yet
+    :returns: :datetime:, or None if the feed should be checked every time
+    """
+    if (not isinstance(stat, dict) or stat.has_key('error') or stat.get('timed_out') or
+            not stat.get('is_valid') or not stat.get('is_current') or
+            not stat.get('last_checked')):
+        return None
+    interval = check_interval(stat)
+    if not interval:
+        return None
+    due = stat['last_checked'] + interval
+    if isinstance(stat.get('effective_to'), datetime):
+        due = min(due, stat['effective_to'] - EXPIRY_WINDOW)
+    return due
+
+
+def is_check_due(stat, now=None):
+    """Check if a feed should be checked for updates now.
+
+    :param stat: Status dictionary for the feed, or None if it has none yet
+    :param now: Time to compare to; defaults to now
+    :returns: True if the feed is due to be checked
+    """
+    due = next_check(stat)
+    return due is None or due <= (now or datetime.now())
@@ -0,0 +1,519 @@
+"""Validate downloaded feeds in the background, while downloads continue.
+
+Feeds are validated with Google's feedvalidator.py, either by starting it as a new process
+for each feed, or on a :ValidatorService: of long-running worker processes that load it once.
+Workers are started as new interpreters running this module, rather than forked, so they may
+be started or replaced while other threads are running.
+As feedvalidator.py holds the whole feed in memory, a :MemoryBudget: limits how many feeds
+it validates at once by their size.
+"""
+from collections import deque
+from contextlib import contextmanager
+from distutils.spawn import find_executable
+import imp
+import logging
+import optparse
+import os
+import pickle
+import Queue
+import select
+import signal
+import struct
+import subprocess
+import sys
+import threading
+import time
+import zipfile
+
+from deadlines import DeadlineError
+
+LOG = logging.getLogger(__name__)
+
+FEEDVALIDATOR = 'feedvalidator.py'
+# default number of feeds to validate at the same time
+VALIDATORS = 1
+# default number of downloaded feeds allowed to wait for validation before downloads pause
+QUEUE_SIZE = 4
+# restart a validator worker after it has validated this many feeds, to hand back its memory
+MAX_TASKS_PER_WORKER = 20
+# seconds to wait for a validator worker to exit once told to stop, before killing it
+WORKER_STOP_TIMEOUT = 5
+# this module's source, run by each validator worker process
+WORKER_SCRIPT = os.path.splitext(os.path.abspath(__file__))[0] + '.py'
+# estimated bytes of memory feedvalidator.py uses before loading a feed, and per uncompressed
+# feed byte with --memory_db. Peak RSS measured on synthetic feeds of 2 to 60 MB was about
+# 21 MB plus 4.2 bytes per byte; these leave deliberate headroom over that (about 50% on the
+# base, 20% per byte), as real feeds have longer, more varied values than synthetic ones.
+VALIDATION_BASE_MEMORY = 32 * 1024 * 1024
+VALIDATION_MEMORY_FACTOR = 5
+# default bytes of memory that validations running at the same time may use between them
+VALIDATION_MEMORY = 2048 * 1024 * 1024
+
+# ways to validate feeds:
+#   - full: run feedvalidator.py on every feed
+#   - fast: only check the structure of each feed (see structural_validation)
+#   - tiered: check the structure of each feed, and also run feedvalidator.py on feeds
+#     that fail the check, or were not valid (or not validated) before
+FULL_VALIDATION = 'full'
+FAST_VALIDATION = 'fast'
+TIERED_VALIDATION = 'tiered'
+VALIDATION_MODES = (TIERED_VALIDATION, FULL_VALIDATION, FAST_VALIDATION)
+VALIDATION_MODE = TIERED_VALIDATION
+
+
+class ValidatorError(Exception):
+    """Raised when the validator could not be run on a feed."""
+    pass
+
+
+def estimate_validation_memory(feed_path):
+    """Estimate how much memory feedvalidator.py will use to validate a feed.
+
+    Only reads the sizes of the feed's files from the zip's central directory.
+
+    :param feed_path: Full path to the GTFS to validate
+    :returns: Estimated bytes of memory
+    """
+    try:
+        with zipfile.ZipFile(feed_path) as feedzip:
+            uncompressed = sum(info.file_size for info in feedzip.infolist())
+    except (IOError, zipfile.BadZipfile) as ex:
+        LOG.warn('Could not read file sizes of %s to estimate validation memory: %s',
+                 feed_path, ex)
+        uncompressed = 0
+    return VALIDATION_BASE_MEMORY + VALIDATION_MEMORY_FACTOR * uncompressed
+
+
+class MemoryBudget(object):
+    """Admits validations while their estimated memory use fits within a budget.
+
+    Validations are admitted in the order they ask, so a large feed waiting for memory
+    is not passed over by a stream of small ones. A feed estimated to need more than the
+    whole budget is validated on its own. Safe to share across threads.
+    """
+    def __init__(self, budget=VALIDATION_MEMORY):
+        """Start with the whole budget free.
+
+        :param budget: Bytes of memory the admitted validations may use between them
+        """
+        self.budget = budget
+        self.in_use = 0
+        self._cond = threading.Condition()
+        # validations waiting to be admitted, in order of asking
+        self._waiting = deque()
+
+    @contextmanager
+    def admit(self, cost, name=None):
+        """Wait until there is memory free for a validation, and hold it while it runs.
+
+        :param cost: Estimated bytes of memory the validation will use
+        :param name: Name of the feed, for logging
+        """
+        cost = min(cost, self.budget)
+        with self._cond:
+            ticket = object()
+            self._waiting.append(ticket)
+            if self._waiting[0] is not ticket or not self._fits(cost):
+                LOG.info('Waiting for %.0f MB of validation memory to validate %s...',
+                         cost / 1048576.0, name)
+            while self._waiting[0] is not ticket or not self._fits(cost):
+                self._cond.wait()
+            self._waiting.popleft()
+            self.in_use += cost
+            # the next in line may fit too
+            self._cond.notify_all()
+        try:
+            yield
+        finally:
+            with self._cond:
+                self.in_use -= cost
+                self._cond.notify_all()
+
+    def _fits(self, cost):
+        """Check if a validation using :cost: bytes would fit in the budget now."""
+        return not self.in_use or self.in_use + cost <= self.budget
+
+
+def run_feedvalidator(feed_path, output_path, deadline=None):
+    """Validate a feed by running feedvalidator.py in a new process.
+
+    :param feed_path: Full path to the GTFS to validate
+    :param output_path: Full path to write the HTML validation report to
+    :param deadline: :deadlines.Deadline: to kill the process at, if it is still running
+    :returns: Dictionary of validation results, as described for :ValidatorService.validate:
+    :raises DeadlineError: if the process was killed at the deadline
+    """
+    process_cmd = [FEEDVALIDATOR,
+                   '--output=' + output_path,
+                   '--memory_db',
+                   '--noprompt',
+                   feed_path]
+    try:
+        process = subprocess.Popen(process_cmd, stdout=subprocess.PIPE)
+    except Exception as ex:
+        raise ValidatorError(str(ex))
+
+    def kill():
+        """Stop the validator once out of time, unless it has already finished."""
+        if process.returncode is None:
+            try:
+                process.kill()
+            except OSError:
+                pass  # reaped in the meantime
+
+    timer = None
+    if deadline and deadline.remaining() is not None:
+        timer = threading.Timer(max(deadline.remaining(), 0), kill)
+        timer.daemon = True
+        timer.start()
+    try:
+        out = process.communicate()
+    finally:
+        if timer:
+            timer.cancel()
+    # only out of time if it was killed before it finished; the timer may fire just after
+    if timer and process.returncode == -signal.SIGKILL and deadline.expired():
+        raise DeadlineError('%s ran out of time; stopped %s' % (deadline.what, FEEDVALIDATOR))
+
+    summary = out[0].split('\n')[-2:-1][0] # output line with count of errors/warnings
+    return {'summary': summary,
+            'has_errors': summary.find('error') > -1,
+            'in_future': out[0].find('this feed is in the future,') > -1}
+
+
+def validate_in_process(feedvalidator, feed_path, output_path):
+    """Validate a feed with an already-loaded feedvalidator module.
+
+    Does the same as running feedvalidator.py with --memory_db and --noprompt, but
+    does not check online for a newer transitfeed release for every feed.
+
+    :param feedvalidator: feedvalidator.py, loaded as a module
+    :param feed_path: Full path to the GTFS to validate
+    :param output_path: Full path to write the HTML validation report to
+    :returns: Dictionary of validation results, as described for :ValidatorService.validate:
+    """
+    transitfeed = feedvalidator.transitfeed
+    options = optparse.Values({'manual_entry': False,
+                               'output': output_path,
+                               'performance': False,
+                               'memory_db': True,
+                               'check_duplicate_trips': False,
+                               'limit_per_type': 5,
+                               'latest_version': transitfeed.__version__,
+                               'service_gap_interval': 13,
+                               'extension': None,
+                               'error_types_ignore_list': None})
+    accumulator = feedvalidator.HTMLCountingProblemAccumulator(options.limit_per_type)
+    problems = transitfeed.ProblemReporter(accumulator)
+    schedule, _ = feedvalidator.RunValidation(feed_path, options, problems)
+    with open(output_path, 'w') as output_file:
+        accumulator.WriteOutput(feed_path, output_file, schedule, options.extension)
+
+    if accumulator.HasIssues():
+        summary = 'ERROR: %s found' % accumulator.FormatCount()
+    else:
+        summary = 'feed validated successfully'
+    warnings = accumulator.ProblemListMap(transitfeed.TYPE_WARNING)
+    return {'summary': summary,
+            'has_errors': accumulator.ErrorCount() > 0,
+            'in_future': 'FutureService' in warnings}
+
+
+def _write_message(fd, message):
+    """Send a message to the other end of a pipe, as a length-prefixed pickle."""
+    data = pickle.dumps(message, pickle.HIGHEST_PROTOCOL)
+    data = struct.pack('!I', len(data)) + data
+    while data:
+        data = data[os.write(fd, data):]
+
+
+def _read_exactly(fd, size):
+    """Read :size: bytes from a pipe.
+
+    :raises EOFError: if the other end closed the pipe first
+    """
+    chunks = []
+    while size:
+        chunk = os.read(fd, size)
+        if not chunk:
+            raise EOFError()
+        chunks.append(chunk)
+        size -= len(chunk)
+    return ''.join(chunks)
+
+
+def _read_message(fd):
+    """Receive a message sent with :_write_message: from the other end of a pipe.
+
+    :raises EOFError: if the other end closed the pipe
+    """
+    size, = struct.unpack('!I', _read_exactly(fd, 4))
+    return pickle.loads(_read_exactly(fd, size))
+
+
+def _serve_validations():
+    """Main loop for a validator worker process.
+
+    Loads feedvalidator.py once, then validates each (feed path, output path) received
+    on stdin, writing back a (result, error message) pair to stdout, until sent None.
+    """
+    # keep stdout for results; feedvalidator prints progress to it, which would garble them
+    results = os.dup(sys.stdout.fileno())
+    devnull = os.open(os.devnull, os.O_WRONLY)
+    os.dup2(devnull, sys.stdout.fileno())
+    os.close(devnull)
+    tasks = sys.stdin.fileno()
+
+    feedvalidator_path = find_executable(FEEDVALIDATOR)
+    if not feedvalidator_path:
+        _write_message(results, (None, '%s not found on PATH' % FEEDVALIDATOR))
+        return
+    try:
+        feedvalidator = imp.load_source('feedvalidator', feedvalidator_path)
+    except Exception as ex:  # pylint: disable=broad-except
+        _write_message(results, (None, 'Could not load %s: %s' % (FEEDVALIDATOR, ex)))
+        return
+    _write_message(results, (True, None))
+
+    while True:
+        try:
+            task = _read_message(tasks)
+        except EOFError:
+            return
+        if task is None:
+            return
+        feed_path, output_path = task
+        try:
+            result = (validate_in_process(feedvalidator, feed_path, output_path), None)
+        except Exception as ex:  # pylint: disable=broad-except
+            result = (None, '%s: %s' % (ex.__class__.__name__, ex))
+        _write_message(results, result)
+
+
+class ValidatorWorker(object):
+    """A long-running process that validates feeds sent to it over a pipe.
+
+    The process is a new interpreter, not a fork, so it inherits none of the threads, locks
+    or open files of the process starting it.
+    """
+    def __init__(self):
+        self.tasks = 0
+        try:
+            self._process = subprocess.Popen([sys.executable, WORKER_SCRIPT],
+                                             stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                             close_fds=True)
+        except OSError as ex:
+            raise ValidatorError('Could not start validator worker: %s' % ex)
+        _, err = self._receive()
+        if err:
+            self.close()
+            raise ValidatorError(err)
+
+    def _send(self, message):
+        """Send a message to the worker process."""
+        try:
+            _write_message(self._process.stdin.fileno(), message)
+        except (IOError, OSError) as ex:
+            raise ValidatorError('Could not send to validator worker process: %s' % ex)
+
+    def _receive(self):
+        """Wait for the next message from the worker process."""
+        try:
+            return _read_message(self._process.stdout.fileno())
+        except (EOFError, IOError, OSError):
+            raise ValidatorError('Validator worker process exited unexpectedly')
+
+    def validate(self, feed_path, output_path, deadline=None):
+        """Validate a feed on this worker; see :ValidatorService.validate:.
+
+        The worker process is killed if it is still validating at the deadline.
+        """
+        self.tasks += 1
+        self._send((feed_path, output_path))
+        remaining = deadline.remaining() if deadline else None
+        if remaining is not None:
+            ready, _, _ = select.select([self._process.stdout], [], [], max(remaining, 0))
+            if not ready:
+                self.kill()
+                raise DeadlineError('%s ran out of time; stopped validator worker' %
+                                    deadline.what)
+        result, err = self._receive()
+        if err:
+            raise ValidatorError(err)
+        return result
+
+    def is_alive(self):
+        """Check if the worker process is still running."""
+        return self._process.poll() is None
+
+    def kill(self):
+        """Stop the worker process in the middle of a task."""
+        if self.is_alive():
+            try:
+                self._process.kill()
+            except OSError:
+                pass  # exited in the meantime
+        self._process.wait()
+
+    def close(self):
+        """Stop the worker process."""
+        if self.is_alive():
+            try:
+                self._send(None)
+            except ValidatorError:
+                pass
+            stop_by = time.time() + WORKER_STOP_TIMEOUT
+            while self.is_alive() and time.time() < stop_by:
+                time.sleep(0.05)
+        self.kill()
+        self._process.stdin.close()
+        self._process.stdout.close()
+
+
+class ValidatorService(object):
+    """Pool of warm validator worker processes.
+
+    Each worker loads feedvalidator.py and transitfeed once, so validating a feed does not pay
+    for interpreter startup and imports every time. Workers are restarted if they die,
+    and after every :max_tasks: feeds.
+
+    The pool has a fixed number of slots, each holding a worker, or None once its worker is
+    retired. A slot's new worker is started when the slot is next taken; if it cannot be,
+    that feed is validated by running feedvalidator.py in a new process instead.
+    """
+    def __init__(self, processes=VALIDATORS, max_tasks=MAX_TASKS_PER_WORKER):
+        self.max_tasks = max_tasks
+        self._idle = Queue.Queue()
+        self._workers = []
+        try:
+            for _ in range(processes):
+                self._idle.put(self._add_worker())
+        except ValidatorError:
+            self.close()
+            raise
+
+    def _add_worker(self):
+        """Start a new worker.
+
+        :returns: The :ValidatorWorker:
+        :raises ValidatorError: if the worker could not be started
+        """
+        worker = ValidatorWorker()
+        self._workers.append(worker)
+        return worker
+
+    def _replace_worker(self):
+        """Start a new worker for an empty slot.
+
+        :returns: The :ValidatorWorker:, or None if it could not be started
+        """
+        try:
+            return self._add_worker()
+        except ValidatorError as ex:
+            LOG.warn('Could not start a new validator worker: %s', ex)
+            return None
+
+    def _retire_worker(self, worker):
+        """Stop a worker that has died or done its share of tasks."""
+        self._workers.remove(worker)
+        worker.close()
+
+    def validate(self, feed_path, output_path, start_deadline=None):
+        """Validate a feed on the next free worker; blocks until one is free.
+
+        :param feed_path: Full path to the GTFS to validate
+        :param output_path: Full path to write the HTML validation report to
+        :param start_deadline: Function returning the :deadlines.Deadline: to stop validating
+                               at, called once a worker is free, so that time spent waiting
+                               for one does not count; the worker is killed, and replaced with
+                               a new one, if it is still validating then
+        :returns: Dictionary of validation results, with keys:
+            - summary: feedvalidator's line with the count of errors and warnings
+            - has_errors: True if feedvalidator found any errors
+            - in_future: True if the feed does not go into service until a future date
+        :raises ValidatorError: if the feed could not be validated
+        :raises DeadlineError: if the feed was not validated by the deadline
+        """
+        worker = self._idle.get()
+        if worker is None:
+            worker = self._replace_worker()
+        try:
+            deadline = start_deadline() if start_deadline else None
+            if worker is None:
+                LOG.info('Running %s in a new process for %s.', FEEDVALIDATOR, feed_path)
+                return run_feedvalidator(feed_path, output_path, deadline)
+            return worker.validate(feed_path, output_path, deadline)
+        finally:
+            if worker and worker.is_alive() and worker.tasks < self.max_tasks:
+                self._idle.put(worker)
+            else:
+                if worker:
+                    self._retire_worker(worker)
+                # the slot is kept, and given a new worker when it is next taken
+                self._idle.put(None)
+
+    def close(self):
+        """Stop all the workers."""
+        for worker in list(self._workers):
+            self._retire_worker(worker)
+
+
+class ValidationPipeline(object):
+    """Validation stage for a run, fed by the download stage through a bounded queue.
+
+    Each of the :validators: threads takes a downloaded feed off the queue and calls
+    :FeedSource.verify: for it, which runs the validator in its own process, so up to
+    :validators: validator processes run at once, as long as the source's :MemoryBudget:
+    has room for them. When the queue is full, :submit: blocks until a validator frees up,
+    so downloads never get too far ahead of validation.
+    """
+    def __init__(self, validators=VALIDATORS, queue_size=QUEUE_SIZE):
+        self._queue = Queue.Queue(maxsize=queue_size)
+        self._threads = []
+        for idx in range(validators):
+            thread = threading.Thread(target=self._work, name='validator-%s' % idx)
+            thread.daemon = True
+            self._threads.append(thread)
+
+    def start(self):
+        """Start the validator threads."""
+        for thread in self._threads:
+            thread.start()
+        return self
+
+    def submit(self, source, file_name):
+        """Queue a downloaded feed for validation; blocks while the queue is full.
+
+        :param source: :FeedSource: the feed was downloaded by
+        :param file_name: Name of the feed to verify, relative to the source's :ddir:
+        """
+        LOG.debug('Queueing %s for validation...', file_name)
+        self._queue.put((source, file_name))
+
+    def join(self):
+        """Wait for all queued feeds to be validated, then stop the validator threads."""
+        for _ in self._threads:
+            self._queue.put(None)
+        for thread in self._threads:
+            thread.join()
+
+    def _work(self):
+        """Validate queued feeds until told to stop."""
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            source, file_name = item
+            try:
+                if source.verify(file_name):
+                    LOG.info('GTFS verification succeeded.')
+                else:
+                    LOG.error('GTFS verification failed.')
+            except Exception as ex:  # pylint: disable=broad-except
+                LOG.exception('Validation of %s failed unexpectedly.', file_name)
+                source.set_error(file_name, 'Validation failed: %s' % ex)
+            source.write_status()
+
+
+if __name__ == '__main__':
+    _serve_validations()